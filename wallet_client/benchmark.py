@@ -0,0 +1,463 @@
+import argparse
+import atexit
+import binascii
+import io
+import multiprocessing
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import requests
+import ujson
+
+#the tracked data/wallet.db and log.txt are left alone: importing lib.config opens the database of WALLET_DATA_PATH
+DATA_PATH = tempfile.mkdtemp(prefix='wallet-bench-')
+atexit.register(shutil.rmtree, DATA_PATH, True)
+os.environ.setdefault('WALLET_DATA_PATH', DATA_PATH)
+os.environ.setdefault('WALLET_LOG_FILE', os.path.join(DATA_PATH, 'log.txt'))
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from lib.db import Database
+from lib.api import NaiveCoinApi, TranscationUpdater
+from lib.wallet import Wallet, DERIVATION_CHAIN, DERIVATION_INDEX
+from lib.wallet.manager import WalletManager, CACHE_HITS, CACHE_MISSES
+from lib.balance import BalanceCache
+from lib.history import TransactionHistory
+from lib.rescan import ChainRescan
+from lib.utxo import UtxoIndex
+from lib.watch import AddressFilter, watched_addresses
+from lib.config import CLIENT_CONFIG, HISTORY_PAGE_SIZE, RESCAN_WINDOW
+from stub_node import StubNode
+from lib.transaction import Transaction
+from lib.cryptoUtil import CryptoUtil, Ed25519Util
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PrivateFormat, PublicFormat, NoEncryption
+
+ROWS = 2000
+HTTP_REQUESTS = 1000
+KDF_ROUNDS = 20
+ADDRESSES = 50
+UTXO_COUNTS = (10, 100, 1000)
+PENDING_SIZES = (100, 1000, 10000)
+BLOCK_TRANSACTIONS = 1000
+BALANCE_ADDRESSES = 500
+HISTORY_ROWS = 100000
+RESCAN_BLOCKS = 1000
+WATCH_ADDRESSES = 100000
+WATCH_LOOKUPS = 100000
+CACHED_WALLETS = 200
+CACHED_WALLET_KEYS = 100
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(fn):
+    """
+        Register a bench_<name> function, it is run with `python benchmark.py <name>`
+    """
+    BENCHMARKS[fn.__name__[len('bench_'):]] = fn
+    return fn
+
+class Recorder():
+    """
+        Print every measurement as a table row and keep it for the json report
+    """
+    def __init__(self, stream=sys.stdout) -> None:
+        self.stream = stream
+        self.benchmark = None
+        self.results = []
+
+    def report(self, name, count, elapsed, unit='stmt/s', **params):
+        self.results.append(dict({'benchmark': self.benchmark, 'name': name, 'count': count,
+            'seconds': elapsed, 'rate': count / elapsed, 'unit': unit}, **params))
+        print("{:<45} {:>12.0f} {}".format(name, count / elapsed, unit), file=self.stream)
+
+    def run(self, name):
+        self.benchmark = name
+        print("== {}".format(name), file=self.stream)
+        BENCHMARKS[name](self)
+
+    def to_json(self) -> dict:
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': self.results
+        }
+
+def compare(results, baseline, threshold):
+    """
+        Return the (result, baseline rate) pairs whose rate dropped more than threshold (0.2 = 20%) from the baseline report
+    """
+    baseline_rate = {(result["benchmark"], result["name"]): result["rate"] for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        rate = baseline_rate.get((result["benchmark"], result["name"]))
+        if rate and result["rate"] < rate * (1 - threshold):
+            regressions.append((result, rate))
+    return regressions
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def tx_rows(count, first=0):
+    return [{'transaction_id': str(i), 'hash': 'h', 'type': 'regular', 'data': '{}', 'confirmed': False} for i in range(first, first + count)]
+
+class LegacyDatabase():
+    #the previous Database behaviour, a new connection and a commit for every statement
+    def __init__(self, path) -> None:
+        self.path = path
+
+    def exec(self, sql, param, commit=False):
+        connection = sqlite3.connect(self.path)
+        cursor = connection.execute(sql, param)
+        if commit:
+            connection.commit()
+            connection.close()
+        return connection, cursor
+
+    def fetch_one(self, sql, param):
+        connection, cursor = self.exec(sql, param)
+        result = cursor.fetchone()
+        connection.close()
+        return result
+
+@benchmark
+def bench_database(out):
+    insert_sql = 'insert into tx (transaction_id, hash, type, data, confirmed) values(:transaction_id, :hash, :type, :data, :confirmed)'
+    select_sql = 'select * from tx where transaction_id=:transaction_id'
+    rows = tx_rows(ROWS)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = LegacyDatabase(tmp + '/legacy.db')
+        legacy.exec("create table tx (transaction_id, hash, type, data, confirmed)", (), commit=True)
+        out.report('legacy insert (connect + commit each)', ROWS, timed(lambda: [legacy.exec(insert_sql, r, commit=True) for r in rows]))
+        out.report('legacy select (connect each)', ROWS, timed(lambda: [legacy.fetch_one(select_sql, r) for r in rows]))
+
+        db = Database.create_schema('pooled.db', path=tmp + '/')
+        out.report('pooled insert (commit each)', ROWS, timed(lambda: [db.exec(insert_sql, r, commit=True) for r in rows]))
+        out.report('pooled select', ROWS, timed(lambda: [db.fetch_one(select_sql, r) for r in rows]))
+
+        #transaction_id is the primary key, the batch inserts other ids
+        batch_rows = tx_rows(ROWS, ROWS)
+        def batched():
+            with db.transaction():
+                db.exec_many(insert_sql, batch_rows)
+        out.report('pooled exec_many in one transaction', ROWS, timed(batched))
+        db.close()
+
+class StubNodeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #keep-alive, like the node
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = b'{"balance":100}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@benchmark
+def bench_http(out):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubNodeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    node = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        url = node + '/operator/{}/balance'.format('0' * 64)
+        out.report('bare requests.get', HTTP_REQUESTS, timed(lambda: [requests.get(url).json() for _ in range(HTTP_REQUESTS)]), 'req/s')
+        out.report('NaiveCoinApi pooled session', HTTP_REQUESTS, timed(lambda: [NaiveCoinApi.get_address_balance('0' * 64, node) for _ in range(HTTP_REQUESTS)]), 'req/s')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@benchmark
+def bench_kdf(out):
+    password_hash = CryptoUtil.hash('this is my strong password')
+    secret = Ed25519Util.generate_secret(password_hash)
+    out.report('Ed25519Util.generate_secret', KDF_ROUNDS, timed(lambda: [Ed25519Util.generate_secret(password_hash) for _ in range(KDF_ROUNDS)]), 'call/s')
+    out.report('Ed25519Util.generate_secret_at', KDF_ROUNDS, timed(lambda: [Ed25519Util.generate_secret_at(secret, index) for index in range(KDF_ROUNDS)]), 'call/s')
+
+@benchmark
+def bench_address(out):
+    for derivation in (DERIVATION_CHAIN, DERIVATION_INDEX):
+        wallet = Wallet.from_password('this is my strong password', derivation)
+        out.report('generate_address ({})'.format(derivation), ADDRESSES, timed(lambda: [wallet.generate_address() for _ in range(ADDRESSES)]), 'addr/s')
+
+@benchmark
+def bench_sign(out):
+    wallet = Wallet.from_password('this is my strong password')
+    address = wallet.generate_address()
+    secret_key = wallet.get_signing_key(address)
+    for count in UTXO_COUNTS:
+        uxto = [{'transaction': '{:064x}'.format(i), 'index': 0, 'amount': 10, 'address': address} for i in range(count)]
+        out.report('sign_per_uxto ({} utxo)'.format(count), count, timed(lambda: wallet.sign_per_uxto(uxto, secret_key)), 'sig/s', utxo=count)
+
+@benchmark
+def bench_coin_selection(out):
+    wallet = Wallet.from_password('this is my strong password')
+    address = wallet.generate_address()
+    for count in (10, 100, 1000, 5000):
+        uxto = [{'transaction': '{:064x}'.format(i), 'index': 0, 'amount': 10, 'address': address} for i in range(count)]
+        for selection, kwargs in (('every output', {'selection': lambda uxto, target: uxto}), ('largest_first', {})):
+            transaction = None
+            def sign():
+                nonlocal transaction
+                transaction = wallet.sign_and_create_transaction(uxto, 'b' * 64, address, 25, 1, **kwargs)
+            elapsed = timed(sign)
+            out.report('sign transaction, {} utxo {}'.format(count, selection), 1, elapsed, 'tx/s',
+                utxo=count, bytes=len(ujson.dumps(transaction)), inputs=len(transaction["data"]["inputs"]))
+
+def signed_transactions(count, inputs=4):
+    wallet = Wallet.from_password('this is my strong password')
+    address = wallet.generate_address()
+    transactions = []
+    for i in range(count):
+        uxto = [{'transaction': '{:064x}'.format(i * inputs + j), 'index': 0, 'amount': 10, 'address': address} for j in range(inputs)]
+        transactions.append(wallet.sign_and_create_transaction(uxto, 'b' * 64, address, 10 * inputs - 5, 1))
+    return transactions
+
+@benchmark
+def bench_transaction(out):
+    transactions = signed_transactions(500)
+    out.report('Transaction.from_json', len(transactions), timed(lambda: [Transaction.from_json(t) for t in transactions]), 'tx/s')
+    tx_objs = [Transaction.from_json(t) for t in transactions]
+
+    def uncached():
+        for tx_obj in tx_objs:
+            tx_obj._invalidate()
+            tx_obj.calc_hash()
+    out.report('calc_hash (serialize + hash)', len(tx_objs), timed(uncached), 'tx/s')
+    out.report('calc_hash (cached)', len(tx_objs), timed(lambda: [tx_obj.calc_hash() for tx_obj in tx_objs]), 'tx/s')
+    out.report('Transaction.verify', len(tx_objs), timed(lambda: [Transaction.verify(tx_obj) for tx_obj in tx_objs]), 'tx/s')
+
+@benchmark
+def bench_verify(out):
+    tx_objs = [Transaction.from_json(t) for t in signed_transactions(500)]
+    signatures = sum(len(tx_obj.data["inputs"]) for tx_obj in tx_objs)
+
+    cpus = os.cpu_count()
+    out.report('serial Transaction.verify', signatures, timed(lambda: [Transaction.verify(tx_obj) for tx_obj in tx_objs]), 'sig/s')
+    out.report('verify_many default', signatures, timed(lambda: Transaction.verify_many(tx_objs)), 'sig/s', cpus=cpus)
+    #the pools are forced, at least 2 workers, so VERIFY_WORKERS can be set from what they give on this machine
+    workers = max(cpus or 1, 2)
+    out.report('verify_many thread pool ({} workers)'.format(workers), signatures,
+        timed(lambda: Transaction.verify_many(tx_objs, max_workers=workers, parallel_min=0)), 'sig/s', cpus=cpus)
+    out.report('verify_many process pool ({} workers)'.format(workers), signatures,
+        timed(lambda: Transaction.verify_many(tx_objs, max_workers=workers, use_processes=True, parallel_min=0)), 'sig/s', cpus=cpus)
+
+@benchmark
+def bench_updater(out):
+    #half of the block transactions are ours, the pending set is much larger than the block
+    blocks = [{'index': 1, 'hash': 'b', 'previousHash': 'a', 'transactions': [{'id': '{:064x}'.format(i * 2)} for i in range(BLOCK_TRANSACTIONS)]}]
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database.create_schema('updater.db', path=tmp + '/')
+        updater = TranscationUpdater(multiprocessing.Queue(), db)
+        for pending in PENDING_SIZES:
+            with db.transaction():
+                db.exec('delete from tx')
+                db.exec_many('insert into tx (transaction_id, hash, type, data, confirmed) values(:transaction_id, :hash, :type, :data, :confirmed)',
+                    ({'transaction_id': '{:064x}'.format(i), 'hash': 'h', 'type': 'regular', 'data': '{}', 'confirmed': False} for i in range(pending)))
+            def match():
+                with db.transaction():
+                    updater.include_transactions(blocks)
+                    updater.confirm_transactions(1, depth=1)
+            out.report('include and confirm transactions ({} pending)'.format(pending), pending, timed(match), 'pending/s', pending=pending)
+        db.close()
+
+@benchmark
+def bench_history(out):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database.create_schema('history.db', path=tmp + '/')
+        with db.transaction():
+            db.exec_many('insert into tx (transaction_id, hash, type, data, confirmed, created_at) values(:transaction_id, :hash, :type, :data, :confirmed, :created_at)',
+                (dict(row, created_at=float(index)) for index, row in enumerate(tx_rows(HISTORY_ROWS))))
+        history = TransactionHistory(db)
+        pages = HISTORY_ROWS // HISTORY_PAGE_SIZE
+        def walk():
+            cursor = None
+            for _ in range(pages):
+                cursor = history.page(cursor=cursor)["next_cursor"]
+        out.report('history keyset pages ({} rows)'.format(HISTORY_ROWS), pages, timed(walk), 'page/s')
+        def offset_walk():
+            #what limit/offset paging would cost
+            for page in range(0, pages, 10):
+                db.fetch_all('select transaction_id from tx order by created_at desc limit :limit offset :offset', {'limit': HISTORY_PAGE_SIZE, 'offset': page * HISTORY_PAGE_SIZE})
+        out.report('history offset pages ({} rows)'.format(HISTORY_ROWS), pages // 10, timed(offset_walk), 'page/s')
+        out.report('history csv export ({} rows)'.format(HISTORY_ROWS), HISTORY_ROWS, timed(lambda: history.export(io.StringIO(), 'csv')), 'row/s')
+        db.close()
+
+@benchmark
+def bench_rescan(out):
+    ours = CryptoUtil.random_id()
+    with tempfile.TemporaryDirectory() as tmp, StubNode(latency=0.002, block_interval=None) as node:
+        #every 100th block pays us, the chain is built without mining so it does not cost the measure
+        for index in range(1, RESCAN_BLOCKS + 1):
+            transactions = [{'id': CryptoUtil.random_id(), 'hash': 'h', 'type': 'reward', 'data': {'inputs': [],
+                'outputs': [{'amount': 1, 'address': ours if index % 100 == 0 and i == 0 else CryptoUtil.random_id()}]}} for i in range(4)]
+            node.blocks.append(node.make_block(index, node.blocks[-1]["hash"], transactions))
+        db = Database.create_schema('rescan.db', path=tmp + '/')
+        for window in (1, RESCAN_WINDOW):
+            rescan = ChainRescan([ours], db, node=node.url, window=window, checkpoint='bench-{}'.format(window))
+            report = rescan.run()
+            out.report('rescan window {} ({} blocks, 2ms latency)'.format(window, RESCAN_BLOCKS), report["blocks"], report["seconds"], 'block/s', window=window)
+        db.close()
+
+def allocated(fn):
+    tracemalloc.start()
+    try:
+        result = fn()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+@benchmark
+def bench_watch(out):
+    addresses = [CryptoUtil.random_id() for _ in range(WATCH_ADDRESSES)]
+    #1% of the block outputs pay a watched address
+    outputs = [addresses[i] if i % 100 == 0 else CryptoUtil.random_id() for i in range(WATCH_LOOKUPS)]
+    #the strings are copied so their memory is counted, as when they are read from the database
+    hex_set, hex_bytes = allocated(lambda: set(bytes.fromhex(address).hex() for address in addresses))
+    keys, key_bytes = allocated(lambda: AddressFilter(addresses))
+    bloom, bloom_bytes = allocated(lambda: AddressFilter(addresses, bloom=True))
+    #memory as addresses per MiB so a regression is a lower rate like every other measure
+    out.report('hex string set memory ({} addresses)'.format(WATCH_ADDRESSES), WATCH_ADDRESSES, hex_bytes / 2 ** 20, 'address/MiB')
+    out.report('AddressFilter memory ({} addresses)'.format(WATCH_ADDRESSES), WATCH_ADDRESSES, key_bytes / 2 ** 20, 'address/MiB')
+    out.report('AddressFilter + bloom memory ({} addresses)'.format(WATCH_ADDRESSES), WATCH_ADDRESSES, bloom_bytes / 2 ** 20, 'address/MiB',
+        bloom_bytes=bloom.bloom.nbytes)
+    out.report('AddressFilter build ({} addresses)'.format(WATCH_ADDRESSES), WATCH_ADDRESSES, timed(lambda: AddressFilter(addresses)), 'address/s')
+    out.report('AddressFilter + bloom build ({} addresses)'.format(WATCH_ADDRESSES), WATCH_ADDRESSES, timed(lambda: AddressFilter(addresses, bloom=True)), 'address/s')
+
+    some = tuple(addresses[:1000])
+    out.report('tuple lookup (1000 addresses)', 1000, timed(lambda: [address in some for address in outputs[:1000]]), 'lookup/s')
+    out.report('hex string set lookup ({} addresses)'.format(WATCH_ADDRESSES), WATCH_LOOKUPS, timed(lambda: [address in hex_set for address in outputs]), 'lookup/s')
+    out.report('AddressFilter lookup ({} addresses)'.format(WATCH_ADDRESSES), WATCH_LOOKUPS, timed(lambda: [address in keys for address in outputs]), 'lookup/s')
+    out.report('AddressFilter + bloom lookup ({} addresses)'.format(WATCH_ADDRESSES), WATCH_LOOKUPS, timed(lambda: [address in bloom for address in outputs]), 'lookup/s')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database.create_schema('watch.db', path=tmp + '/')
+        UtxoIndex(db).watch(addresses)
+        blocks = 20
+        #what UtxoIndex.watched_addresses cost per ingested block before the shared filter
+        out.report('reload watched set per block ({} addresses)'.format(WATCH_ADDRESSES), blocks,
+            timed(lambda: [set(row["address"] for row in db.fetch_all('select address from utxo_address')) for _ in range(blocks)]), 'block/s')
+        out.report('first sync of shared filter ({} addresses)'.format(WATCH_ADDRESSES), WATCH_ADDRESSES, timed(lambda: watched_addresses(db)), 'address/s')
+        out.report('incremental sync per block ({} addresses)'.format(WATCH_ADDRESSES), blocks,
+            timed(lambda: [watched_addresses(db) for _ in range(blocks)]), 'block/s')
+        db.close()
+
+def random_key_pairs(count):
+    key_pairs = []
+    for index in range(count):
+        priv = Ed25519PrivateKey.generate()
+        key_pairs.append(Wallet.make_key_pair(index,
+            priv.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption()).hex(),
+            priv.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw).hex()))
+    return key_pairs
+
+@benchmark
+def bench_key_lookup(out):
+    wallet = Wallet(CryptoUtil.random_id(), '', '', random_key_pairs(10000))
+    last_address = wallet.key_pairs[-1]["publicKey"]
+    lookups = 2000
+
+    def linear_scan():
+        #the previous get_secret_key_by_address plus parsing the key for every signature
+        for _ in range(lookups):
+            secret_key = next(p["privateKey"] for p in wallet.key_pairs if p["publicKey"] == last_address)
+            Ed25519PrivateKey.from_private_bytes(binascii.unhexlify(secret_key))
+    out.report('linear scan + key parse (10k addresses)', lookups, timed(linear_scan), 'lookup/s')
+    out.report('indexed cached signing key (10k addresses)', lookups, timed(lambda: [wallet.get_signing_key(last_address) for _ in range(lookups)]), 'lookup/s')
+    out.report('addresses property (10k addresses)', lookups, timed(lambda: [wallet.addresses for _ in range(lookups)]), 'call/s')
+
+    verf_data = [{'address': last_address, 'data': str(i)} for i in range(lookups)]
+    out.report('sign_verification_data, same address', lookups, timed(lambda: wallet.sign_verification_data(verf_data)), 'item/s')
+
+@benchmark
+def bench_wallet_cache(out):
+    passwords = ['cached wallet {}'.format(i) for i in range(CACHED_WALLETS)]
+    default_db = CLIENT_CONFIG.db
+    with tempfile.TemporaryDirectory() as tmp:
+        CLIENT_CONFIG.config_database(Database.create_schema('wallets.db', path=tmp + '/'))
+        try:
+            for password in passwords:
+                wallet = Wallet.from_password(password)
+                wallet.key_pairs = random_key_pairs(CACHED_WALLET_KEYS)
+                wallet.save()
+            def load():
+                #what every request paid before the cache: lookup and key list of the wallet
+                for password in passwords:
+                    Wallet.load_wallet_from_password(password).addresses
+            out.report('load_wallet_from_password ({} keys)'.format(CACHED_WALLET_KEYS), CACHED_WALLETS, timed(load), 'login/s')
+            manager = WalletManager(size=CACHED_WALLETS)
+            hits, misses = CACHE_HITS.value, CACHE_MISSES.value
+            login = lambda: [manager.login(password).addresses for password in passwords]
+            out.report('WalletManager cold login ({} keys)'.format(CACHED_WALLET_KEYS), CACHED_WALLETS, timed(login), 'login/s')
+            out.report('WalletManager warm login ({} keys)'.format(CACHED_WALLET_KEYS), CACHED_WALLETS, timed(login), 'login/s',
+                hits=CACHE_HITS.value - hits, misses=CACHE_MISSES.value - misses)
+            #half the working set fits, every login of a round robin misses
+            small = WalletManager(size=CACHED_WALLETS // 2)
+            out.report('WalletManager thrashing login ({} keys)'.format(CACHED_WALLET_KEYS), CACHED_WALLETS * 2,
+                timed(lambda: [small.login(password).addresses for _ in range(2) for password in passwords]), 'login/s')
+            manager.clear()
+            small.clear()
+        finally:
+            CLIENT_CONFIG.db.close()
+            CLIENT_CONFIG.config_database(default_db)
+
+@benchmark
+def bench_balance(out):
+    addresses = [CryptoUtil.random_id() for _ in range(BALANCE_ADDRESSES)]
+    with tempfile.TemporaryDirectory() as tmp, StubNode(latency=0.002, block_interval=None) as node:
+        cache = BalanceCache(Database.create_schema('balance.db', path=tmp + '/'))
+        latest_block = NaiveCoinApi.get_latest_block(node.url)
+        out.report('serial get_address_balance ({} addresses)'.format(BALANCE_ADDRESSES), BALANCE_ADDRESSES,
+            timed(lambda: [NaiveCoinApi.get_address_balance(address, node.url) for address in addresses]), 'address/s')
+        out.report('BalanceCache cold ({} addresses)'.format(BALANCE_ADDRESSES), BALANCE_ADDRESSES,
+            timed(lambda: cache.balances(addresses, latest_block, node.url)), 'address/s')
+        out.report('BalanceCache warm ({} addresses)'.format(BALANCE_ADDRESSES), BALANCE_ADDRESSES,
+            timed(lambda: cache.balances(addresses, latest_block, node.url)), 'address/s')
+        cache.db.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the wallet client hot paths')
+    parser.add_argument('benchmarks', nargs='*', metavar='name', help='benchmarks to run (default all): ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--json', metavar='PATH', help="write the results as json to PATH, '-' for stdout")
+    parser.add_argument('--compare', metavar='PATH', help='json report of a previous run, exit with 1 if a rate dropped')
+    parser.add_argument('--threshold', type=float, default=0.2, help='rate drop reported as a regression (default 0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmark {}'.format(', '.join(unknown)))
+    #keep stdout clean for the json
+    out = Recorder(sys.stderr if args.json == '-' else sys.stdout)
+    for name in args.benchmarks or BENCHMARKS:
+        out.run(name)
+
+    report = out.to_json()
+    if args.json == '-':
+        print(ujson.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as report_file:
+            ujson.dump(report, report_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(out.results, ujson.load(baseline_file), args.threshold)
+        for result, rate in regressions:
+            print("regression {} / {}: {:.0f} {} (baseline {:.0f})".format(result["benchmark"], result["name"], result["rate"], result["unit"], rate), file=out.stream)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,16 @@
+import os
+import asyncio
+import aiohttp
+import datetime
 import requests
 import re
 import multiprocessing
 
-from lib.config import CLIENT_CONFIG
+from lib.config import CONFIRMATION_DEPTH, RESCAN_CHECKPOINT
 from lib.api.exception import TransactionRequestException, WalletLinkException
 from lib.api import NaiveCoinApi
+from lib.history import TransactionHistory
+from lib.rescan import ChainRescan
 from lib.wallet import Wallet
 from PyInquirer import prompt
 from lib.wallet.exception import WalletException
@@ -20,7 +26,13 @@ class Client():
 
     def print_nofity(self):
         while not self.queue.empty():
-            print('## Transaction confirmed {} ##'.format(self.queue.get()))
+            for transaction_id, confirmations in self.queue.get():
+                if confirmations == 0:
+                    print('## Transaction {} dropped by a chain reorganisation, pending again ##'.format(transaction_id))
+                elif confirmations >= CONFIRMATION_DEPTH:
+                    print('## Transaction confirmed {} ({} confirmations) ##'.format(transaction_id, confirmations))
+                else:
+                    print('## Transaction {} included in a block ({} confirmation(s)) ##'.format(transaction_id, confirmations))
 
     def link_request(self):
 
@@ -54,28 +66,19 @@ class Client():
             print(wallet_ex)
 
     def check_balance(self):
-
-        from examples import custom_style_1
-
-        choice = self.wallet.addresses
-        choice.append('Back')
-        question = [
-            {
-                'type': 'list',
-                'message': 'Select your input addresses',
-                'name': 'address',
-                'choices': choice,
-            }
-        ]
-        result = prompt(question, style=custom_style_1)
-        if result["address"] == 'Back':
+        try:
+            balances = self.wallet.balances()
+        except requests.exceptions.RequestException as req_ex:
+            print("Balance request timeout Error: {}".format(req_ex))
             return
-        else:
-            balance_info = NaiveCoinApi.get_address_balance(result["address"])
-            if balance_info["balance"] > 0:
-                print("Address: {} Balance: {}".format(result["address"], balance_info["balance"]))
+        print("**************Balance at block {}**************".format(balances["block_index"]))
+        for address in self.wallet.addresses:
+            if address in balances["errors"]:
+                print("Address: {} Balance: -1 Status: {}".format(address, balances["errors"][address]))
             else:
-                print("Address: {} Balance: {} Status: {}".format(result["address"], balance_info["balance"], balance_info["status"]))
+                print("Address: {} Balance: {}".format(address, balances["addresses"][address]))
+        print("Total: {} ({} cached, {} from node)".format(balances["total"], balances["cached"], balances["fetched"]))
+        print("*************************************")
 
     def create_transaction(self):
 
@@ -97,8 +100,7 @@ class Client():
                     raise ValidationError(
                         message="Invalid address format", cursor_position=len(document.text))
 
-        choice = self.wallet.addresses
-        choice.append('Back')
+        choice = list(self.wallet.addresses) + ['Back']
         q_select_from_address = [
             {
                 'type': 'list',
@@ -136,12 +138,100 @@ class Client():
                 print("Failed to create transaction Error: {}".format(wallet_ex))
 
 
+    def bulk_send(self):
+
+        from examples import custom_style_1
+        from prompt_toolkit.validation import Validator, ValidationError
+
+        class PaymentFileValidator(Validator):
+            def validate(self, document):
+                if not os.path.isfile(document.text):
+                    raise ValidationError(
+                        message="File not found", cursor_position=len(document.text))
+
+        choice = list(self.wallet.addresses) + ['Back']
+        q_select_from_address = [
+            {
+                'type': 'list',
+                'message': 'Select your input addresses',
+                'name': 'input_address',
+                'choices': choice,
+            }
+        ]
+        r_input_address = prompt(q_select_from_address, style=custom_style_1)
+        if r_input_address["input_address"] == 'Back':
+            return
+        q_payment_file = [
+            {
+                'type': 'input',
+                'message': 'Enter the payment file (csv: address,amount or jsonl)',
+                'name': 'path',
+                'validate': PaymentFileValidator
+            }
+        ]
+        r_payment_file = prompt(q_payment_file, style=custom_style_1)
+        try:
+            transactions, results = self.wallet.send_many(Wallet.read_payments(r_payment_file["path"]), r_input_address["input_address"])
+        except (ValueError, KeyError) as file_ex:
+            print("Failed to read payment file Error: {}".format(file_ex))
+            return
+        for transaction in transactions:
+            print("Transaction created {}".format(transaction.id))
+            transaction.save()
+        for result in results:
+            if result["error"]:
+                print("Address: {} Amount: {} Error: {}".format(result["address"], result["amount"], result["error"]))
+        print("{} of {} payment(s) sent in {} transaction(s)".format(sum(1 for result in results if not result["error"]), len(results), len(transactions)))
+
     def transaction_history(self):
-        transactions = CLIENT_CONFIG.db.fetch_all('select transaction_id, confirmed from tx', param={})
-        print("**************Trasction**************")
-        for tx in transactions:
-            print("Id: {} Confirmed: {}".format(tx["transaction_id"], tx["confirmed"]))
-        print("*************************************")
+        from examples import custom_style_1
+
+        history = TransactionHistory()
+        cursor = None
+        while True:
+            page = history.page(cursor=cursor)
+            print("**************Trasction**************")
+            for tx in page["transactions"]:
+                print("Id: {} Status: {} Confirmations: {} Created: {}".format(tx["transaction_id"], tx["status"], tx["confirmations"],
+                    datetime.datetime.fromtimestamp(tx["created_at"]).strftime('%Y-%m-%d %H:%M:%S')))
+            print("*************************************")
+            choices = (['Next page'] if page["next_cursor"] else []) + ['Export history', 'Back']
+            result = prompt([{'type': 'list', 'message': 'History', 'name': 'action', 'choices': choices}], style=custom_style_1)
+            if result["action"] == 'Next page':
+                cursor = page["next_cursor"]
+            elif result["action"] == 'Export history':
+                self.export_history(history)
+                return
+            else:
+                return
+
+    def rescan(self):
+        def progress(report):
+            print("Block {}/{} {:.1f} blocks/s, {} transaction(s) found".format(report["block_index"], report["to_index"], report["blocks_per_second"], report["found"]))
+        try:
+            report = ChainRescan(self.wallet.addresses, checkpoint='{}:{}'.format(RESCAN_CHECKPOINT, self.wallet.id)).run(progress=progress)
+        except (TransactionRequestException, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            print("Rescan interrupted, it resumes from the last block saved Error: {}".format(ex))
+            return
+        print("{} block(s) rescanned in {:.1f}s ({:.1f} blocks/s), {} transaction(s) found".format(
+            report["blocks"], report["seconds"], report["blocks_per_second"], report["found"]))
+
+    def export_history(self, history):
+        from examples import custom_style_1
+
+        result = prompt([{
+            'type': 'input',
+            'message': 'Enter the export file (.jsonl or .csv)',
+            'name': 'path',
+        }], style=custom_style_1)
+        path = result["path"]
+        try:
+            with open(path, 'w', newline='') as export_file:
+                count = history.export(export_file, 'csv' if path.endswith('.csv') else 'jsonl')
+        except OSError as file_ex:
+            print("Failed to write export file Error: {}".format(file_ex))
+            return
+        print("{} transaction(s) exported to {}".format(count, path))
 
     def wallet_option(self):
         from examples import custom_style_2
@@ -153,9 +243,11 @@ class Client():
                 'message': 'What do you want to do?',
                 'choices': [
                     'Send balance',
+                    'Bulk send',
                     'Check balance',
                     'Transaction history',
                     'Generate new address',
+                    'Rescan chain for payments',
                     'Accept wallet link request',
                     'Exit'
                 ]
@@ -167,8 +259,12 @@ class Client():
             result = prompt(questions, style=custom_style_2)
             if result["wallet_option"] == 'Send balance':
                 self.create_transaction()
+            if result["wallet_option"] == 'Bulk send':
+                self.bulk_send()
             if result["wallet_option"] == 'Check balance':
                 self.check_balance()
+            if result["wallet_option"] == 'Rescan chain for payments':
+                self.rescan()
             if result["wallet_option"] == 'Transaction history':
                 self.transaction_history()
             if result["wallet_option"] == 'Generate new address':
@@ -224,6 +320,21 @@ class Client():
             wallet.save()
             return wallet
 
+    def restore_wallet(self):
+        from examples import custom_style_2
+        questions = [
+            {
+                'type': 'password',
+                'message': 'Enter your wallet password',
+                'name': 'password'
+            }
+        ]
+        result = prompt(questions, style=custom_style_2)
+        wallet = Wallet.restore_from_password(result["password"])
+        wallet.save()
+        print("Wallet restored with {} address(es)".format(len(wallet.key_pairs)))
+        return wallet
+
     def load_wallet(self):
         from examples import custom_style_2
         questions = [
@@ -248,6 +359,7 @@ class Client():
                 'choices': [
                     'Login',
                     'Create wallet',
+                    'Restore wallet',
                     'Exit'
                 ]
             },
@@ -269,5 +381,14 @@ class Client():
                 if self.wallet:
                     self.wallet_option()
 
+            if result["option"] == 'Restore wallet':
+                try:
+                    self.wallet = self.restore_wallet()
+                    if self.wallet:
+                        self.wallet_option()
+                except (WalletException, aiohttp.ClientError, asyncio.TimeoutError, requests.exceptions.RequestException) as restore_ex:
+                    print("Failed to restore wallet Error:", restore_ex)
+                    continue
+
             if result["option"] == 'Exit':
                 return ECLIENT_EXIT, None
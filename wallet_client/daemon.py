@@ -0,0 +1,40 @@
+import argparse
+import asyncio
+import logging
+import signal
+
+from lib.api import NaiveCoinApi
+from lib.config import DAEMON_HOST, DAEMON_PORT, DAEMON_WORKERS, SUBSCRIBE_BLOCKS, METRICS_PATH
+from lib.config.log import LOG_FILE
+from lib.metrics import METRICS
+from lib.rpc import JsonRpcServer
+
+logging.basicConfig(format="%(asctime)s-[%(levelname)s]:%(message)s", filename=LOG_FILE)
+
+async def serve(host, port, workers, subscribe):
+    server = await JsonRpcServer(workers=workers, subscribe=subscribe).start(host, port)
+    logging.info('Wallet daemon listening on http://%s:%s', host, port)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await server.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the wallet over json-rpc 2.0 (HTTP POST /) without the interactive menu')
+    parser.add_argument('--host', default=DAEMON_HOST)
+    parser.add_argument('--port', type=int, default=DAEMON_PORT)
+    parser.add_argument('--workers', type=int, default=DAEMON_WORKERS, help='threads running the wallet calls')
+    parser.add_argument('--node', help='url of the naivecoin node (default CURRENT_NODE)')
+    parser.add_argument('--no-subscribe', action='store_true', help='poll the node for blocks instead of subscribing as a peer')
+    args = parser.parse_args(argv)
+
+    if args.node:
+        NaiveCoinApi.configure(node=args.node)
+    asyncio.run(serve(args.host, args.port, args.workers, SUBSCRIBE_BLOCKS and not args.no_subscribe))
+    if METRICS_PATH:
+        METRICS.write(METRICS_PATH.format(process='daemon'))
+
+if __name__ == "__main__":
+    main()
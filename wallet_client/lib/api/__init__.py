@@ -1,71 +1,90 @@
+import asyncio
 import multiprocessing
-import requests
+import threading
 import time
-import itertools
+import requests
+import sqlite3
 
 from multiprocessing import Queue
 from lib.config.log import Logger
 from json.decoder import JSONDecodeError
-from lib.api.exception import TransactionRequestException, WalletLinkException
-from lib.config import CURRENT_NODE, CLIENT_CONFIG
+from lib.api.exception import TransactionRequestException, WalletLinkException, NodePeerException
+from lib.api.session import HttpClient
+from lib.api.aio import AsyncNaiveCoinApi, ApiResult, NO_TRANSACTIONS
+from lib.api.subscription import BlockSubscription
+from lib.config import CURRENT_NODE, CLIENT_CONFIG, METRICS_PATH
+from lib.config import SUBSCRIBE_BLOCKS, POLL_INTERVAL, SUBSCRIBED_POLL_INTERVAL, SUBSCRIPTION_CHECK_INTERVAL
+from lib.config import CONFIRMATION_DEPTH, REORG_MAX_DEPTH, UPDATER_BACKOFF
+from lib.metrics import METRICS
+from lib.utxo import UtxoIndex
+from lib.balance import BalanceCache
+
+TICK_ERRORS = METRICS.counter('wallet_updater_tick_errors_total', 'Updater ticks that failed and were retried')
 
 class NaiveCoinApi():
+    client = HttpClient()
+    node = CURRENT_NODE #used by the calls without a node argument
+
     def __init__(self) -> None:
         pass
 
     @classmethod
-    def get_address_balance(cls, address, node = CURRENT_NODE):
-        res = requests.get(node + '/operator/{}/balance'.format(address))
+    def configure(cls, client: HttpClient = None, node = None):
+        if client is not None:
+            cls.client = client
+        if node is not None:
+            cls.node = node
+        return cls
+
+    @classmethod
+    def url(cls, node, path) -> str:
+        return (node or cls.node) + path
+
+    @classmethod
+    def get_address_balance(cls, address, node = None):
+        res = cls.client.get('get_address_balance', cls.url(node, '/operator/{}/balance'.format(address)))
+        if res.status_code == 404 and res.text.startswith(NO_TRANSACTIONS):
+            return {'balance': 0}
         try: 
             return res.json()
         except JSONDecodeError:
             return {'balance': -1, 'status': res.text}
 
     @classmethod
-    def query_blockchain_transactions_id_from_node(cls, transaction_id = [], node = CURRENT_NODE):
+    def query_blockchain_transactions_id_from_node(cls, transaction_id = [], node = None):
         #we use async io here to query multiple transaction request from the serer
-        import aiohttp
-        import asyncio
-        loop = asyncio.get_event_loop()
-
-        async def fetch(session, url):
-            async with session.get(url) as response:
-                try:
-                    return await response.json()
-                #we return the plaintext of the respond if something happend during the query
-                except aiohttp.ContentTypeError:
-                    return await response.text()
-
-        async def fetch_all(urls, loop):
-            async with aiohttp.ClientSession(loop=loop) as session:
-                results = await asyncio.gather(*[fetch(session, url) for url in urls], return_exceptions=False)
-                return results
-        
-        urls = [node + "/blockchain/blocks/transactions/{}".format(id) for id in transaction_id]
-        tx_id_from_block = loop.run_until_complete(fetch_all(urls, loop))
+        async def query():
+            async with AsyncNaiveCoinApi(node or cls.node) as api:
+                return await api.query_blockchain_transactions_id(transaction_id)
+        return asyncio.run(query())
 
-        def parse_block_input(block_data):
-            block_tx_id = []
-            if type(block_data) == str:
-                return ''
-            else:
-                for transaction in block_data["transactions"]:
-                    block_tx_id.append(transaction["id"])
-                return block_tx_id
+    @classmethod
+    def query_blocks_of_transactions_from_node(cls, transaction_id = [], node = None):
+        async def query():
+            async with AsyncNaiveCoinApi(node or cls.node) as api:
+                return await api.query_blocks_of_transactions(transaction_id)
+        return asyncio.run(query())
 
-        tx_id_from_block = list(map(parse_block_input, tx_id_from_block))
-        return list(dict.fromkeys(itertools.chain(*tx_id_from_block))) #remove duplicate transaction id
+    @classmethod
+    def get_latest_block(cls, node = None):
+        res = cls.client.get('get_latest_block', cls.url(node, '/blockchain/blocks/latest'))
+        return res.json()
+
+    @classmethod
+    def get_block_by_index(cls, index, node = None):
+        res = cls.client.get('get_block_by_index', cls.url(node, '/blockchain/blocks/{}'.format(index)))
+        return res.json()
 
     @classmethod
-    def get_unspent_transaction_for_address(cls, address, node = CURRENT_NODE):
+    def get_unspent_transaction_for_address(cls, address, node = None):
         payload = {'address': address}
-        res = requests.get(node + '/blockchain/transactions/unspent', params=payload)
+        res = cls.client.get('get_unspent_transaction_for_address', cls.url(node, '/blockchain/transactions/unspent'), params=payload)
         return res.json()
 
     @classmethod
     def get_link_wallet_request(cls, addresses, link_request):
         data = {'addresses': addresses }
-        res = requests.post(link_request, data)
+        res = cls.client.post('get_link_wallet_request', link_request, data=data)
         try:
             res_data = res.json()
             if res.status_code == 200:
@@ -76,9 +95,9 @@ class NaiveCoinApi():
             return res.text
         
     @classmethod
-    def send_verification_data(cls, wallet_id, verf_data, node = CURRENT_NODE):
+    def send_verification_data(cls, wallet_id, verf_data, node = None):
         data = { 'walletId': wallet_id, 'verf_data': verf_data }
-        res = requests.post(node + '/shop/cart/wallet/anonymous/verify', json=data)
+        res = cls.client.post('send_verification_data', cls.url(node, '/shop/cart/wallet/anonymous/verify'), json=data)
         try:
             res_data = res.json()
             if res.status_code == 201:
@@ -89,38 +108,246 @@ class NaiveCoinApi():
             return res.text
         
     @classmethod
-    def send_transaction(cls, signed_transaction: dict, node = CURRENT_NODE):
-        res = requests.post(node + '/blockchain/transactions', json=signed_transaction)
+    def send_transaction(cls, signed_transaction: dict, node = None):
+        res = cls.client.post('send_transaction', cls.url(node, '/blockchain/transactions'), json=signed_transaction)
         
         if res.status_code == 201:
             return res.json()
         else:
             raise TransactionRequestException('Failed to send transacion to node error: {}'.format(res.text))
 
-#transation updater job is to check new transaction 
-#for every 10 seconds, and match it with local db to confirm the transaction
+    @classmethod
+    def get_peers(cls, node = None):
+        res = cls.client.get('get_peers', cls.url(node, '/node/peers'))
+        return res.json()
+
+    @classmethod
+    def connect_peer(cls, peer_url, node = None):
+        """
+            Register peer_url as a peer of the node, the node then pushes its new blocks and transactions to it
+        """
+        res = cls.client.post('connect_peer', cls.url(node, '/node/peers'), json={'url': peer_url})
+        if res.status_code != 201:
+            raise NodePeerException('Failed to connect peer {} to node error: {}'.format(peer_url, res.text))
+        return res.json()
+
+#transation updater job is to check new blocks as soon as the node pushes them (or every 10 seconds without subscription),
+#and match their transactions with local db to confirm the transaction
 class TranscationUpdater(multiprocessing.Process):
-    def __init__(self, queue: Queue):
+    CURSOR_NAME = 'last_scanned_block'
+
+    def __init__(self, queue: Queue, db = None, subscribe = SUBSCRIBE_BLOCKS):
         super(TranscationUpdater, self).__init__()
         self.queue = queue
+        self.db = db if db is not None else CLIENT_CONFIG.db
+        self.utxo = UtxoIndex(self.db)
+        self.balances = BalanceCache(self.db)
+        self.subscribe = subscribe
+        self.subscription = None
+        self.pushed_block = None
+        self.wake = None #threading.Event created in the updater process, it can not be pickled
+
+    def load_cursor(self):
+        cursor = self.db.fetch_one('select value from sync_state where name=:name', {'name': self.CURSOR_NAME})
+        return None if cursor is None else cursor["value"]
+
+    def save_cursor(self, block_index):
+        self.db.exec('insert or replace into sync_state values(:name, :value)', {'name': self.CURSOR_NAME, 'value': block_index})
+
+    def pending_transactions_id(self):
+        """
+            Transactions not seen in any block yet
+        """
+        return [row["transaction_id"] for row in self.db.fetch_all('select transaction_id from tx where confirmed=:confirmed and block_index is null', {'confirmed': False})]
+
+    def scan_new_blocks(self, cursor, latest_block):
+        """
+            Return every block after the cursor up to the latest block
+        """
+        return [latest_block if index == latest_block["index"] else NaiveCoinApi.get_block_by_index(index)
+            for index in range(cursor + 1, latest_block["index"] + 1)]
+
+    def include_transactions(self, blocks):
+        """
+            Record the block of every pending transaction found in blocks and return their (id, block index),
+            the updates join the caller transaction if there is one
+        """
+        pending_id = set(self.pending_transactions_id())
+        rows = [{'transaction_id': transaction["id"], 'block_index': block["index"], 'block_hash': block["hash"]}
+            for block in blocks for transaction in block["transactions"] if transaction["id"] in pending_id]
+        if rows:
+            self.db.exec_many('update tx set block_index=:block_index, block_hash=:block_hash where transaction_id=:transaction_id', rows)
+            Logger.info('%s transaction(s) included in a block', len(rows))
+        return [(row["transaction_id"], row["block_index"]) for row in rows]
+
+    def confirm_transactions(self, tip_index, depth = CONFIRMATION_DEPTH):
+        """
+            Mark confirmed the transactions whose block is depth blocks deep at tip_index and return their (id, confirmations),
+            one indexed range query whatever the number of tracked transactions
+        """
+        max_index = tip_index - depth + 1
+        rows = self.db.fetch_all('select transaction_id, block_index from tx where confirmed=:confirmed and block_index<=:max_index',
+            {'confirmed': False, 'max_index': max_index})
+        if rows:
+            self.db.exec('update tx set confirmed=:is_confirmed, confirmed_at=:confirmed_at where confirmed=:confirmed and block_index<=:max_index',
+                {'is_confirmed': True, 'confirmed_at': time.time(), 'confirmed': False, 'max_index': max_index})
+            Logger.info('%s transaction(s) confirmed', len(rows))
+        return [(row["transaction_id"], tip_index - row["block_index"] + 1) for row in rows]
+
+    def save_headers(self, blocks):
+        self.db.exec_many('insert or replace into block_header values(:index, :hash, :previousHash)',
+            ({'index': block["index"], 'hash': block["hash"], 'previousHash': block["previousHash"]} for block in blocks))
+
+    def header_hash(self, index):
+        row = self.db.fetch_one('select hash from block_header where block_index=:block_index', {'block_index': index})
+        return None if row is None else row["hash"]
+
+    def find_fork(self, cursor, latest_block, blocks):
+        """
+            Return None if the node chain extends the scanned one, else the index of the last block both chains share
+            (-1 when it is not found within REORG_MAX_DEPTH blocks)
+        """
+        if latest_block["index"] <= cursor:
+            known_hash = self.header_hash(latest_block["index"])
+            if known_hash is None or known_hash == latest_block["hash"]:
+                return None
+            index = latest_block["index"] - 1
+        else:
+            known_hash = self.header_hash(cursor)
+            if known_hash is None or known_hash == blocks[0]["previousHash"]:
+                return None
+            index = cursor - 1
+        for index in range(index, max(cursor - REORG_MAX_DEPTH, -1), -1):
+            known_hash = self.header_hash(index)
+            if known_hash is not None and known_hash == NaiveCoinApi.get_block_by_index(index)["hash"]:
+                return index
+        return -1
+
+    def rollback(self, fork_index):
+        """
+            Forget everything scanned after fork_index, return the ids of the transactions whose block was replaced
+        """
+        rows = self.db.fetch_all('select transaction_id from tx where block_index>:block_index', {'block_index': fork_index})
+        self.db.exec('update tx set block_index=null, block_hash=null, confirmed=:confirmed, confirmed_at=null where block_index>:block_index',
+            {'confirmed': False, 'block_index': fork_index})
+        self.db.exec('delete from block_header where block_index>:block_index', {'block_index': fork_index})
+        #outputs of the replaced blocks may not exist anymore
+        self.utxo.invalidate()
+        self.balances.invalidate()
+        if fork_index < 0:
+            self.db.exec('delete from sync_state where name=:name', {'name': self.CURSOR_NAME})
+        else:
+            self.save_cursor(fork_index)
+        Logger.warning('Chain reorganised after block %s, %s transaction(s) back to pending', fork_index, len(rows))
+        METRICS.counter('wallet_updater_reorgs_total', 'Replaced chains detected by the updater').inc()
+        return [row["transaction_id"] for row in rows]
+
+    @METRICS.timed('wallet_updater_tick_seconds', 'Time of an updater tick, from asking the latest block to the commit')
+    def tick(self, latest_block = None):
+        """
+            Scan the blocks after the cursor up to latest_block, the node is asked for its latest block when it is not given.
+            The queue gets one list of (transaction id, confirmations) per tick, 0 confirmations when the block was replaced
+        """
+        latest_block = latest_block or NaiveCoinApi.get_latest_block()
+        cursor = self.load_cursor()
+        events = {}
+        blocks = []
+        if cursor is None:
+            #no cursor yet, we do not know which blocks the pending transactions may be in so ask the node for each of them once
+            unconfirm_transactions_id = self.pending_transactions_id()
+            blocks = NaiveCoinApi.query_blocks_of_transactions_from_node(unconfirm_transactions_id) if unconfirm_transactions_id else []
+        else:
+            if latest_block["index"] > cursor:
+                blocks = self.scan_new_blocks(cursor, latest_block)
+                METRICS.counter('wallet_updater_blocks_total', 'Blocks scanned by the updater').inc(len(blocks))
+            fork_index = self.find_fork(cursor, latest_block, blocks)
+            if fork_index is not None:
+                with self.db.transaction():
+                    events.update((id, 0) for id in self.rollback(fork_index))
+                if fork_index < 0:
+                    #the chains share nothing we know of, the next tick starts again without a cursor
+                    self.notify(events)
+                    return
+                blocks = self.scan_new_blocks(fork_index, latest_block)
+            if not blocks and not events:
+                return
+
+        with self.db.transaction():
+            for id, block_index in self.include_transactions(blocks):
+                events[id] = latest_block["index"] - block_index + 1
+            events.update(self.confirm_transactions(latest_block["index"]))
+            if cursor is None:
+                #the local outputs and balances missed the blocks before the cursor existed
+                self.utxo.invalidate()
+                self.balances.invalidate()
+            else:
+                self.utxo.ingest_blocks(blocks)
+                self.balances.ingest_blocks(blocks, cursor, latest_block)
+            self.save_headers(blocks + [latest_block])
+            self.save_cursor(latest_block["index"])
+        METRICS.counter('wallet_updater_confirmed_total', 'Transactions confirmed by the updater').inc(
+            sum(1 for confirmations in events.values() if confirmations >= CONFIRMATION_DEPTH))
+        self.notify(events)
+
+    def notify(self, events):
+        #the client is notified once per tick with every change
+        if events:
+            self.queue.put(list(events.items()))
+
+    def on_block(self, block):
+        #called by the listener thread, the tick runs in the updater loop
+        self.pushed_block = block
+        self.wake.set()
+
+    def start_subscription(self, **kwargs):
+        self.wake = self.wake or threading.Event()
+        self.subscription = BlockSubscription(self.on_block, **kwargs).start()
+        self.subscription.subscribe()
+
+    def loop(self, stop = None, interval = None):
+        """
+            Tick when a block is pushed, poll every POLL_INTERVAL while the node does not push blocks to us.
+            A failed tick is logged and retried after a backoff doubling from UPDATER_BACKOFF up to POLL_INTERVAL,
+            the loop only ends with stop. interval replaces both poll intervals, e.g. for the load generator
+        """
+        self.wake = self.wake or threading.Event()
+        next_check = time.monotonic() + SUBSCRIPTION_CHECK_INTERVAL
+        failures = 0
+        while stop is None or not stop.is_set():
+            self.wake.clear()
+            pushed_block, self.pushed_block = self.pushed_block, None
+            try:
+                self.tick(pushed_block)
+                failures = 0
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError, sqlite3.Error) as ex:
+                #the node is down or answered garbage (an error body, a malformed pushed block) or the database is busy,
+                #the next tick polls the node again
+                failures += 1
+                TICK_ERRORS.inc()
+                Logger.warning('Updater tick failed (%s in a row) error: %r', failures, ex)
+            if METRICS_PATH:
+                METRICS.write(METRICS_PATH.format(process='updater'))
+            if self.subscription is not None and time.monotonic() >= next_check:
+                next_check = time.monotonic() + SUBSCRIPTION_CHECK_INTERVAL
+                self.subscription.check()
+            if failures:
+                self.wake.wait(min(UPDATER_BACKOFF * 2 ** (failures - 1), interval or POLL_INTERVAL))
+                continue
+            if interval is None:
+                subscribed = self.subscription is not None and self.subscription.subscribed
+                self.wake.wait(SUBSCRIBED_POLL_INTERVAL if subscribed else min(POLL_INTERVAL, SUBSCRIPTION_CHECK_INTERVAL))
+            else:
+                self.wake.wait(interval)
 
     def run(self) -> None:
         try:
             Logger.info("Transcation updater started")
-            while True:
-                unconfirm_transactions = CLIENT_CONFIG.db.fetch_all('select * from tx where confirmed=:confirmed', {'confirmed': False})
-                unconfirm_transactions_id = list(map(lambda transaction: transaction["transaction_id"], unconfirm_transactions))
-                blocks_transaction_id = NaiveCoinApi.query_blockchain_transactions_id_from_node(unconfirm_transactions_id)
-
-                for unconfirm_id in unconfirm_transactions_id:
-                    if unconfirm_id in blocks_transaction_id:
-                        CLIENT_CONFIG.db.exec('update tx set confirmed=:is_confirmed where transaction_id=:transaction_id', param={'is_confirmed': True, 'transaction_id': unconfirm_id}, commit=True)
-                        Logger.info('Transaction id {} confirmed'.format(unconfirm_id))
-                        #print("# Transaction confirmed {}".format(unconfirm_id))
-                        self.queue.put(unconfirm_id)
-
-                time.sleep(10)
+            #the counters of the parent process were copied by the fork
+            METRICS.reset()
+            if self.subscribe:
+                self.start_subscription()
+            self.loop()
 
         except Exception as e:
-            Logger.error("Transaction updater stopped error: {}".format(e))
+            Logger.error("Transaction updater stopped error: %s", e)
             exit(-1)
\ No newline at end of file
@@ -0,0 +1,158 @@
+import asyncio
+import itertools
+import aiohttp
+
+from lib.api.exception import TransactionRequestException, WalletLinkException
+from lib.config import CURRENT_NODE, HTTP_TIMEOUT, ASYNC_CONCURRENCY
+
+#404 body of the node balance of an address without any unspent output, it holds nothing
+NO_TRANSACTIONS = 'No transactions found for address'
+
+class ApiResult():
+    """
+        Outcome of one call inside a batch, either a value or the error raised by that call
+    """
+    def __init__(self, value=None, error=None) -> None:
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self) -> str:
+        return 'ApiResult(value={!r}, error={!r})'.format(self.value, self.error)
+
+class AsyncNaiveCoinApi():
+    """
+        Coroutine version of NaiveCoinApi, one aiohttp session is shared for the lifetime of the object
+        and at most `concurrency` requests are in flight at the same time.
+        It only covers the calls made in bulk: balances, blocks, unspent outputs, wallet link and sending transactions.
+        The peer calls (get_peers, connect_peer) stay on NaiveCoinApi, they are single operator requests
+
+            async with AsyncNaiveCoinApi() as api:
+                results = await api.get_addresses_balance(addresses)
+    """
+    def __init__(self, node = CURRENT_NODE, concurrency = ASYNC_CONCURRENCY, timeout = HTTP_TIMEOUT) -> None:
+        self.node = node
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        #created lazily so it binds to the running loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request(self, method, url, **kwargs):
+        """
+            Return the status code and the decoded json body, or the plaintext body if it is not json
+        """
+        session = self.session
+        async with self._semaphore:
+            async with session.request(method, url, **kwargs) as response:
+                try:
+                    return response.status, await response.json()
+                except aiohttp.ContentTypeError:
+                    return response.status, await response.text()
+
+    async def gather(self, coroutines) -> list:
+        """
+            Run every coroutine and return an ApiResult per coroutine in the same order,
+            a failing call does not fail the whole batch
+        """
+        async def capture(coroutine):
+            try:
+                return ApiResult(await coroutine)
+            except Exception as ex:
+                return ApiResult(error=ex)
+        return await asyncio.gather(*[capture(coroutine) for coroutine in coroutines])
+
+    async def get_address_balance(self, address):
+        """
+            {'balance': n} of address, 0 when the node has no output for it.
+            Raise a TransactionRequestException for any other error status or body
+        """
+        status, res = await self.request('GET', self.node + '/operator/{}/balance'.format(address))
+        if status == 404 and isinstance(res, str) and res.startswith(NO_TRANSACTIONS):
+            return {'balance': 0}
+        if status != 200 or not isinstance(res, dict) or not isinstance(res.get("balance"), (int, float)):
+            raise TransactionRequestException('Balance of {} not read, node answered {}: {}'.format(address, status, res))
+        return res
+
+    async def get_addresses_balance(self, addresses) -> dict:
+        results = await self.gather(self.get_address_balance(address) for address in addresses)
+        return dict(zip(addresses, results))
+
+    async def get_latest_block(self):
+        _, res = await self.request('GET', self.node + '/blockchain/blocks/latest')
+        return res
+
+    async def get_block_by_index(self, index):
+        _, res = await self.request('GET', self.node + '/blockchain/blocks/{}'.format(index))
+        return res
+
+    async def get_block_by_transaction_id(self, transaction_id):
+        status, res = await self.request('GET', self.node + '/blockchain/blocks/transactions/{}'.format(transaction_id))
+        if status != 200:
+            raise TransactionRequestException('Transaction {} not found in any block: {}'.format(transaction_id, res))
+        return res
+
+    async def query_blocks_of_transactions(self, transaction_id = []):
+        """
+            Return the blocks holding any of transaction_id, without duplicate
+        """
+        results = await self.gather(self.get_block_by_transaction_id(id) for id in transaction_id)
+        return list({result.value["hash"]: result.value for result in results if result.ok}.values())
+
+    async def query_blockchain_transactions_id(self, transaction_id = []):
+        """
+            Return the ids of every transaction in the blocks holding any of transaction_id, without duplicate
+        """
+        blocks = await self.query_blocks_of_transactions(transaction_id)
+        tx_id_from_block = ([transaction["id"] for transaction in block["transactions"]] for block in blocks)
+        return list(dict.fromkeys(itertools.chain(*tx_id_from_block)))
+
+    async def get_unspent_transaction_for_address(self, address):
+        _, res = await self.request('GET', self.node + '/blockchain/transactions/unspent', params={'address': address})
+        return res
+
+    async def get_link_wallet_request(self, addresses, link_request):
+        #form encoded with one field per address, like requests does for a list value
+        status, res = await self.request('POST', link_request, data=[('addresses', address) for address in addresses])
+        if type(res) == str:
+            return res
+        if status == 200:
+            return res
+        raise WalletLinkException('Failed to get wallet link Error: {}'.format(res["status"]))
+
+    async def send_verification_data(self, wallet_id, verf_data):
+        status, res = await self.request('POST', self.node + '/shop/cart/wallet/anonymous/verify', json={'walletId': wallet_id, 'verf_data': verf_data})
+        if type(res) == str:
+            return res
+        if status == 201:
+            return res
+        raise WalletLinkException('Failed to link verify Error: {}'.format(res["status"]))
+
+    async def send_transaction(self, signed_transaction: dict):
+        status, res = await self.request('POST', self.node + '/blockchain/transactions', json=signed_transaction)
+        if status == 201:
+            return res
+        raise TransactionRequestException('Failed to send transacion to node error: {}'.format(res))
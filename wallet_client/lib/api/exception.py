@@ -2,4 +2,7 @@ class WalletLinkException(Exception):
     pass
 
 class TransactionRequestException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class NodePeerException(Exception):
+    pass
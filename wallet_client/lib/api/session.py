@@ -0,0 +1,98 @@
+import os
+import time
+import random
+import threading
+import requests
+
+from requests.adapters import HTTPAdapter
+from lib.config.log import Logger
+from lib.metrics import METRICS
+from lib.config import HTTP_TIMEOUT, HTTP_ENDPOINT_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF, HTTP_POOL_SIZE
+
+RETRY_STATUS = (502, 503, 504)
+
+class HttpClient():
+    """
+        Pooled keep-alive session used by NaiveCoinApi, with per endpoint timeouts,
+        bounded retries with jitter for GET requests and request/latency counters
+    """
+    def __init__(self, timeout=HTTP_TIMEOUT, endpoint_timeout=HTTP_ENDPOINT_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, pool_size=HTTP_POOL_SIZE) -> None:
+        self.timeout = timeout
+        self.endpoint_timeout = dict(endpoint_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._pid = None
+        self._session = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def session(self) -> requests.Session:
+        #a forked process must not share the parent sockets
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def close(self):
+        if self._session is not None and self._pid == os.getpid():
+            self._session.close()
+        self._pid = None
+
+    def get(self, endpoint, url, **kwargs) -> requests.Response:
+        return self.request('GET', endpoint, url, **kwargs)
+
+    def post(self, endpoint, url, **kwargs) -> requests.Response:
+        return self.request('POST', endpoint, url, **kwargs)
+
+    def request(self, method, endpoint, url, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.endpoint_timeout.get(endpoint, self.timeout))
+        attempts = self.retries + 1 if method == 'GET' else 1
+        for attempt in range(attempts):
+            start = time.perf_counter()
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                self._record(endpoint, time.perf_counter() - start, error=True)
+                if attempt + 1 == attempts:
+                    raise
+                Logger.warning('%s %s failed, retrying error: %s', method, url, ex)
+            else:
+                self._record(endpoint, time.perf_counter() - start, error=res.status_code in RETRY_STATUS)
+                if res.status_code not in RETRY_STATUS or attempt + 1 == attempts:
+                    return res
+            self._record_retry(endpoint)
+            #full jitter so clients retrying together do not hit the node at the same time
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _endpoint_stats(self, endpoint):
+        if endpoint not in self._stats:
+            self._stats[endpoint] = {'requests': 0, 'errors': 0, 'retries': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        return self._stats[endpoint]
+
+    def _record(self, endpoint, latency, error=False):
+        METRICS.histogram('wallet_http_request_seconds', 'Latency of the requests to the node', endpoint=endpoint).observe(latency)
+        if error:
+            METRICS.counter('wallet_http_errors_total', 'Failed requests to the node', endpoint=endpoint).inc()
+        with self._lock:
+            stats = self._endpoint_stats(endpoint)
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['latency_total'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+
+    def _record_retry(self, endpoint):
+        METRICS.counter('wallet_http_retries_total', 'Retried requests to the node', endpoint=endpoint).inc()
+        with self._lock:
+            self._endpoint_stats(endpoint)['retries'] += 1
+
+    def stats(self) -> dict:
+        """
+            Snapshot of the counters per endpoint
+        """
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
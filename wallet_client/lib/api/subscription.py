@@ -0,0 +1,124 @@
+import threading
+import requests
+import ujson
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from lib.config.log import Logger
+from lib.config import BLOCK_LISTENER_HOST, BLOCK_LISTENER_PORT, BLOCK_LISTENER_URL
+from lib.api.exception import NodePeerException
+from lib.metrics import METRICS
+
+class BlockListenerHandler(BaseHTTPRequestHandler):
+    """
+        The part of the node peer protocol a listener without a chain needs: new blocks are pushed with
+        PUT /blockchain/blocks/latest, the rest is answered so the node does not try to sync from us
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def respond(self, status, body):
+        data = ujson.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return ujson.loads(self.rfile.read(length)) if length else None
+
+    def do_PUT(self):
+        body = self.read_body()
+        if self.path != '/blockchain/blocks/latest':
+            return self.respond(404, {'status': 'Not found'})
+        #answer first, handling the block may ask the node for the blocks in between
+        self.respond(200, 'Block received')
+        self.server.subscription.push(body)
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path in ('/node/peers', '/blockchain/transactions'):
+            #peers and unconfirmed transactions broadcast by the node are not needed here
+            return self.respond(201, body)
+        self.respond(404, {'status': 'Not found'})
+
+    def do_GET(self):
+        if self.path == '/blockchain/transactions':
+            return self.respond(200, [])
+        #no block here, the node keeps its chain
+        self.respond(404, {'status': 'Listener without blocks'})
+
+    def log_message(self, format, *args):
+        pass
+
+class BlockSubscription():
+    """
+        Listen for the blocks the node pushes to its peers and call on_block(block) for each of them.
+        subscribed is False until the node accepted the listener as a peer and again when it does not list it anymore
+        (e.g. it restarted), the caller polls while it is False
+    """
+    def __init__(self, on_block, node = None, host = BLOCK_LISTENER_HOST, port = BLOCK_LISTENER_PORT, url = BLOCK_LISTENER_URL) -> None:
+        self.on_block = on_block
+        self.node = node
+        self.host = host
+        self.port = port
+        self._url = url
+        self.subscribed = False
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        return self._url or 'http://{}:{}'.format(*self.server.server_address)
+
+    def start(self):
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), BlockListenerHandler)
+        except OSError as ex:
+            #another client already listens on the port
+            Logger.warning('Block listener port %s unavailable, using any port error: %s', self.port, ex)
+            self.server = ThreadingHTTPServer((self.host, 0), BlockListenerHandler)
+        self.server.daemon_threads = True
+        self.server.subscription = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.subscribed = False
+
+    def push(self, block):
+        METRICS.counter('wallet_blocks_pushed_total', 'Blocks pushed by the node').inc()
+        try:
+            self.on_block(block)
+        except Exception as ex:
+            Logger.error('Pushed block %s not handled error: %s', block.get("index") if isinstance(block, dict) else None, ex)
+
+    def subscribe(self) -> bool:
+        from lib.api import NaiveCoinApi
+        try:
+            NaiveCoinApi.connect_peer(self.url, self.node)
+        except (requests.exceptions.RequestException, NodePeerException, ValueError) as ex:
+            Logger.warning('Block subscription to node failed, polling error: %s', ex)
+            self.subscribed = False
+        else:
+            Logger.info('Subscribed to node blocks at %s', self.url)
+            self.subscribed = True
+        return self.subscribed
+
+    def check(self) -> bool:
+        """
+            Subscribe again if the node does not list the listener as a peer anymore
+        """
+        from lib.api import NaiveCoinApi
+        try:
+            peers = NaiveCoinApi.get_peers(self.node)
+            self.subscribed = any(peer.get("url") == self.url for peer in peers)
+        except (requests.exceptions.RequestException, ValueError, AttributeError) as ex:
+            Logger.warning('Block subscription check failed error: %s', ex)
+            self.subscribed = False
+        if not self.subscribed:
+            self.subscribe()
+        return self.subscribed
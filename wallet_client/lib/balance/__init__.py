@@ -0,0 +1,98 @@
+import asyncio
+
+from lib.config import CLIENT_CONFIG
+from lib.config.log import Logger
+from lib.metrics import METRICS
+
+CACHE_HITS = METRICS.counter('wallet_balance_cache_hits_total', 'Address balances answered from the cache')
+CACHE_MISSES = METRICS.counter('wallet_balance_cache_misses_total', 'Address balances fetched from the node')
+
+class BalanceCache():
+    """
+        Node balance of the wallet addresses, each one cached with the chain tip it was fetched at.
+        The updater moves the entries to every new tip it scans and drops the addresses its blocks touch,
+        our own sends drop the addresses of the transaction. An entry at another tip than the node one is fetched again
+    """
+    def __init__(self, db = None) -> None:
+        self.db = db if db is not None else CLIENT_CONFIG.db
+
+    def invalidate(self, addresses = None):
+        """
+            Drop the cached balance of addresses, every address when it is None
+        """
+        if addresses is None:
+            self.db.exec('delete from balance_cache', commit=True)
+        else:
+            self.db.exec_many('delete from balance_cache where address=:address', ({'address': address} for address in set(addresses)))
+
+    @staticmethod
+    def transaction_addresses(transaction) -> set:
+        data = transaction["data"]
+        return set(item["address"] for item in list(data["inputs"]) + list(data["outputs"]) if "address" in item)
+
+    def apply_transaction(self, transaction):
+        self.invalidate(self.transaction_addresses(transaction))
+
+    def ingest_blocks(self, blocks, cursor, latest_block):
+        """
+            Drop the addresses touched by blocks, the blocks after cursor up to latest_block, and move every entry fetched
+            at or after cursor to latest_block, they did not change in between
+        """
+        touched = set()
+        for block in blocks:
+            for transaction in block["transactions"]:
+                touched.update(self.transaction_addresses(transaction))
+        with self.db.transaction():
+            self.invalidate(touched)
+            self.db.exec('update balance_cache set block_index=:block_index, block_hash=:block_hash where block_index>=:cursor and block_index<=:block_index',
+                {'block_index': latest_block["index"], 'block_hash': latest_block["hash"], 'cursor': cursor})
+
+    def fetch(self, addresses, node = None) -> dict:
+        """
+            address -> ApiResult of the node balance, every address is asked concurrently
+        """
+        from lib.api import NaiveCoinApi
+        from lib.api.aio import AsyncNaiveCoinApi
+        async def query():
+            async with AsyncNaiveCoinApi(node or NaiveCoinApi.node) as api:
+                return await api.get_addresses_balance(addresses)
+        return asyncio.run(query())
+
+    def balances(self, addresses, latest_block = None, node = None) -> dict:
+        """
+            Balance of every address and their total at the chain tip, only the addresses without an entry at the tip are asked to the node.
+            {'block_index': .., 'total': .., 'addresses': {address: balance}, 'errors': {address: status}, 'cached': n, 'fetched': n}
+        """
+        if latest_block is None:
+            from lib.api import NaiveCoinApi
+            latest_block = NaiveCoinApi.get_latest_block(node)
+        addresses = list(dict.fromkeys(addresses))
+        rows = self.db.fetch_all('select address, balance from balance_cache where block_hash=:block_hash', {'block_hash': latest_block["hash"]})
+        wanted = set(addresses)
+        cached = {row["address"]: row["balance"] for row in rows if row["address"] in wanted}
+        missing = [address for address in addresses if address not in cached]
+        CACHE_HITS.inc(len(cached))
+        CACHE_MISSES.inc(len(missing))
+
+        balances = dict(cached)
+        errors = {}
+        if missing:
+            fetched = []
+            for address, result in self.fetch(missing, node).items():
+                if not result.ok:
+                    errors[address] = str(result.error)
+                elif result.value.get("balance", -1) < 0:
+                    errors[address] = result.value.get("status", 'Unknown balance')
+                else:
+                    balances[address] = result.value["balance"]
+                    fetched.append({'address': address, 'balance': result.value["balance"], 'block_index': latest_block["index"], 'block_hash': latest_block["hash"]})
+            self.db.exec_many('insert or replace into balance_cache values(:address, :balance, :block_index, :block_hash)', fetched)
+            Logger.info('%s balance(s) fetched from node, %s cached, %s error(s)', len(fetched), len(cached), len(errors))
+        return {
+            'block_index': latest_block["index"],
+            'total': sum(balances.values()),
+            'addresses': {address: balances[address] for address in addresses if address in balances},
+            'errors': errors,
+            'cached': len(cached),
+            'fetched': len(missing) - len(errors),
+        }
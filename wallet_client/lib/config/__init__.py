@@ -5,6 +5,77 @@ from lib.db import Database
 CURRENT_NODE = 'http://localhost:3001'
 FEE_PER_TRANSACTION = 1
 
+#coin selection used to pick the inputs of a transaction, see lib.wallet.selection
+COIN_SELECTION = 'largest_first'
+COIN_SELECTION_BNB_MAX_TRIES = 100000
+CONSOLIDATE_MAX_INPUTS = 500
+MAX_OUTPUTS_PER_TRANSACTION = 250 #payments packed into one transaction by Wallet.send_many
+
+#address derivation of new wallets, 'index' or the legacy 'chain'
+DEFAULT_DERIVATION = 'index'
+DERIVED_KEY_CACHE_SIZE = 1024
+GAP_LIMIT = 20 #unused addresses in a row before restore stops
+RESTORE_WORKERS = None #process pool deriving the restore window, None for every cpu
+KEY_PAGE_SIZE = 1000 #wallet_key rows read per query when the key pairs are loaded
+
+#Transaction.verify_many checks signatures serially, the pool never beat it in `benchmark.py verify` (about 4k sig/s both ways).
+#Set workers above 1 (None for every cpu) only where that benchmark shows a gain
+VERIFY_WORKERS = 1
+VERIFY_CHUNK_SIZE = 256 #signatures checked per pool task
+VERIFY_PARALLEL_MIN = 4096 #signatures below which a configured pool is skipped, starting it costs more than it saves
+
+#http client to the node, timeouts are in seconds
+HTTP_TIMEOUT = 10
+HTTP_ENDPOINT_TIMEOUT = {
+    'send_transaction': 30,
+    'get_link_wallet_request': 30,
+}
+HTTP_RETRIES = 3 #only for idempotent GET requests
+HTTP_BACKOFF = 0.2
+HTTP_POOL_SIZE = 10
+ASYNC_CONCURRENCY = 50 #max simultaneous requests of one AsyncNaiveCoinApi
+
+#the transaction updater registers as a peer of the node to get new blocks pushed, it polls when that fails
+SUBSCRIBE_BLOCKS = True
+BLOCK_LISTENER_HOST = '127.0.0.1'
+BLOCK_LISTENER_PORT = 3050 #a fixed port so a restarted client is the same peer for the node, 0 for any port
+BLOCK_LISTENER_URL = None #url the node reaches the listener at, None for http://host:port
+POLL_INTERVAL = 10 #seconds between updater ticks without subscription
+SUBSCRIBED_POLL_INTERVAL = 60 #safety net tick when blocks are pushed
+SUBSCRIPTION_CHECK_INTERVAL = 30 #seconds between checks that the node still has the listener as a peer
+UPDATER_BACKOFF = 1 #seconds before the tick after a failed one, doubled up to POLL_INTERVAL while ticks keep failing
+
+#blocks on top of the including one (itself counted) before a transaction is confirmed
+CONFIRMATION_DEPTH = 6
+REORG_MAX_DEPTH = 100 #blocks walked back to find where a replaced chain forked
+
+#transaction history, see lib.history
+HISTORY_PAGE_SIZE = 20 #transactions per page
+HISTORY_EXPORT_BATCH = 1000 #rows read per query while exporting
+
+#false positive rate of the optional Bloom filter in front of the watched address set, see lib.watch
+WATCH_BLOOM_ERROR_RATE = 0.01
+
+#chain rescan for the payments of our addresses, see lib.rescan
+RESCAN_WINDOW = 50 #blocks fetched concurrently and written with one checkpoint, the most held in memory
+RESCAN_CHECKPOINT = 'rescan_block' #sync_state name of the last block written, suffixed with the wallet id by the client
+
+#headless json-rpc daemon, see daemon.py. It has no authentication, keep it on a local interface
+DAEMON_HOST = '127.0.0.1'
+DAEMON_PORT = 3060
+DAEMON_WORKERS = 16 #threads running the wallet calls
+DAEMON_MAX_BATCH = 100 #requests in one json-rpc batch
+DAEMON_EVENTS = 10000 #confirmation events kept for get_events
+DAEMON_MAX_ADDRESSES = 1000 #addresses create_wallet derives in one call
+
+#unlocked wallets kept in memory by the daemon, see lib.wallet.manager
+WALLET_CACHE_SIZE = 1000 #wallets, the least recently used one is locked past it
+WALLET_CACHE_TTL = 900 #seconds an unlocked wallet stays in memory after its last call
+WALLET_CACHE_PRUNE_INTERVAL = 30 #seconds between two sweeps of the expired wallets
+
+#snapshot file of lib.metrics written by each process, e.g. 'data/metrics-{process}.prom' ('.json' for json), None to disable
+METRICS_PATH = None
+
 class Config():
     def __init__(self) -> None:
         self.db = Database
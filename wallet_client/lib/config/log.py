@@ -1,5 +1,9 @@
 import logging
+import os
 
-logging.basicConfig(format="%(asctime)s-[%(levelname)s]:%(message)s", filename='log.txt')
+#WALLET_LOG_FILE points tests and benchmarks elsewhere
+LOG_FILE = os.environ.get('WALLET_LOG_FILE', 'log.txt')
+
+logging.basicConfig(format="%(asctime)s-[%(levelname)s]:%(message)s", filename=LOG_FILE)
 Logger = logging.getLogger()
 Logger.setLevel(logging.INFO)
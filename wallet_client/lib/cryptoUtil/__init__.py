@@ -1,10 +1,12 @@
 import binascii
 import hashlib
+import logging
 import numpy as np
 
 from ..config.log import Logger
+from ..metrics import METRICS
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
-from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat, PrivateFormat, NoEncryption
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
 
@@ -37,17 +39,37 @@ class Ed25519Util():
         return newbytes
 
     @staticmethod
+    @METRICS.timed('wallet_kdf_seconds', 'Time to derive a secret with PBKDF2', function='generate_secret')
     def generate_secret(password_any, s=default_salt) -> str:
         kdf = PBKDF2HMAC(hashes.SHA512(), 512, s, 10000)
         password_hash_byte = binascii.unhexlify(password_any)
         secret = kdf.derive(password_hash_byte).hex()
         return secret
 
+    @staticmethod
+    @METRICS.timed('wallet_kdf_seconds', function='generate_secret_at')
+    def generate_secret_at(secret: str, index: int, s=default_salt) -> str:
+        """
+            Secret of the address at index, it only depends on the wallet secret and the index
+        """
+        kdf = PBKDF2HMAC(hashes.SHA512(), 64, s + index.to_bytes(4, 'big'), 10000)
+        return kdf.derive(binascii.unhexlify(secret)).hex()
+
+    @staticmethod
+    def generate_key_pair_at(secret: str, index: int):
+        """
+            Hex encoded (private key, public key) of the address at index, picklable so it can run in a process pool
+        """
+        priv_key, pub_key = Ed25519Util.generate_key_pair_from_secret(Ed25519Util.generate_secret_at(secret, index))
+        return (priv_key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption()).hex(),
+            pub_key.public_bytes(Encoding.Raw, PublicFormat.Raw).hex())
+
     @staticmethod
     def generate_key_pair_from_secret(secret: str):
         priv_key = Ed25519Util.key_from_secret(binascii.unhexlify(secret))
         pub_key = priv_key.public_key()
-        Logger.debug("Public key: {}".format(pub_key.public_bytes(Encoding.Raw, PublicFormat.Raw).hex()))
+        if Logger.isEnabledFor(logging.DEBUG):
+            Logger.debug("Public key: %s", pub_key.public_bytes(Encoding.Raw, PublicFormat.Raw).hex())
         return priv_key, pub_key
 
     #reduce the secret size to 32 byte to create ED25519 key pairs
@@ -56,12 +78,15 @@ class Ed25519Util():
         return Ed25519PrivateKey.from_private_bytes(Ed25519Util.sc_reduce32(secret))
 
     @staticmethod
+    @METRICS.timed('wallet_sign_seconds', 'Time to sign one hash')
     def sign_hash(private_key: Ed25519PrivateKey, message_hash):
         signature = private_key.sign(binascii.unhexlify(message_hash))
-        Logger.debug("Signature {}".format(binascii.hexlify(signature)))
+        if Logger.isEnabledFor(logging.DEBUG):
+            Logger.debug("Signature %s", signature.hex())
         return signature
     
     @staticmethod
+    @METRICS.timed('wallet_verify_seconds', 'Time to verify one signature')
     def verify_signature(public_key: Ed25519PublicKey, signature: str, message_hash: str):
             signature_byte = binascii.unhexlify(signature)
             message_byte = binascii.unhexlify(message_hash)
@@ -1,42 +1,189 @@
+import os
+import time
+import ujson
 import sqlite3
+import threading
+import contextlib
+import functools
 
-LOCAL_DATA_PATH = 'data/'
+from lib.metrics import METRICS
+
+#directory of the wallet database, WALLET_DATA_PATH points tests and benchmarks elsewhere
+LOCAL_DATA_PATH = os.path.join(os.environ.get('WALLET_DATA_PATH', 'data'), '')
+BUSY_TIMEOUT = 5.0 #seconds a writer waits for the other process to release the lock
+STATEMENT_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _statement_histogram(sql):
+    #one series per kind of statement, the sql itself would be too many
+    return METRICS.histogram('wallet_db_statement_seconds', 'Time to execute a statement on the local database', operation=sql.split(None, 1)[0].lower())
+
+#block_index and block_hash are the block a transaction was included in, its depth is computed from the scanned chain tip.
+#Times are unix seconds, created_at defaults to the insert time
+TX_COLUMNS = ("(transaction_id primary key, hash, type, data, confirmed default 0, block_index, block_hash,"
+    " created_at default ((julianday('now') - 2440587.5) * 86400.0), confirmed_at)")
+
+#sync_state row telling tx_input and tx_output were filled from tx.data
+TX_ITEMS_MIGRATION = 'tx_items_migrated'
+
+COMMIT_SECONDS = METRICS.histogram('wallet_db_statement_seconds', operation='commit')
 
 class Database():
-    def __init__(self, name, row_format=sqlite3.Row) -> None:
+    """
+        Long-lived connection per process/thread to the local sqlite database.
+        The journal is switched to WAL so the client and the transaction updater process
+        can read while the other one is writing.
+    """
+    def __init__(self, name, row_format=sqlite3.Row, path=LOCAL_DATA_PATH) -> None:
         self.name = name
         self.row_format = row_format
+        self.path = path
+        self._local = threading.local()
 
     @classmethod
-    def create_schema(cls, db_name):
-        with sqlite3.connect(LOCAL_DATA_PATH + db_name) as con:
-            cursor = con.cursor()
-            cursor.execute("create table if not exists tx (transaction_id, hash, type, data, confirmed)")
-            con.commit()
-        return cls(db_name)
+    def create_schema(cls, db_name, path=LOCAL_DATA_PATH):
+        db = cls(db_name, path=path)
+        with db.transaction():
+            db.exec("create table if not exists tx {}".format(TX_COLUMNS))
+            db.migrate_tx()
+            db.exec("create index if not exists tx_confirmed_block_index on tx (confirmed, block_index)")
+            #history pages are ordered by (created_at, rowid), newest first
+            db.exec("create index if not exists tx_created_at on tx (created_at)")
+            db.exec("create index if not exists tx_confirmed_created_at on tx (confirmed, created_at)")
+            db.exec("create table if not exists block_header (block_index primary key, hash, previous_hash)")
+            db.exec("create table if not exists wallet (wallet_id, password_hash, secret, key_pair)")
+            db.exec("create table if not exists sync_state (name primary key, value)")
+            #inputs and outputs of tx.data one row each, source_* is the output an input spends
+            db.exec("create table if not exists tx_input (transaction_id, input_index, source_transaction, source_index, address, amount, primary key (transaction_id, input_index))")
+            db.exec("create index if not exists tx_input_address on tx_input (address)")
+            db.exec("create index if not exists tx_input_source on tx_input (source_transaction, source_index)")
+            db.exec("create table if not exists tx_output (transaction_id, output_index, address, amount, primary key (transaction_id, output_index))")
+            db.exec("create index if not exists tx_output_address on tx_output (address)")
+            db.migrate_tx_items()
+            #wallets created before index derivation derive each key from the previous one
+            db.add_column('wallet', 'derivation', "default 'chain'")
+            db.exec("create table if not exists wallet_key (wallet_id, idx, public_key, private_key, primary key (wallet_id, idx))")
+            db.exec("create index if not exists wallet_key_public_key on wallet_key (public_key)")
+            db.migrate_wallet_key()
+            db.exec("create table if not exists utxo (transaction_id, output_index, address, amount, spent, primary key (transaction_id, output_index))")
+            db.exec("create index if not exists utxo_address_spent on utxo (address, spent)")
+            db.exec("create table if not exists utxo_address (address primary key, synced)")
+            db.exec("create table if not exists balance_cache (address primary key, balance, block_index, block_hash)")
+        return db
+
+    def add_column(self, table, column, definition=''):
+        """
+            Add a column to an existing table if it does not have it yet
+        """
+        columns = [row[1] for row in self.fetch_all('pragma table_info({})'.format(table))]
+        if column not in columns:
+            self.exec('alter table {} add column {} {}'.format(table, column, definition))
+
+    def migrate_wallet_key(self):
+        """
+            Move the key pairs of wallets saved as one json blob in wallet.key_pair into wallet_key rows
+        """
+        for wallet in self.fetch_all("select wallet_id, key_pair from wallet where key_pair is not null"):
+            self.exec_many('insert or ignore into wallet_key values(:wallet_id, :idx, :public_key, :private_key)',
+                ({'wallet_id': wallet["wallet_id"], 'idx': idx, 'public_key': key_pair["publicKey"], 'private_key': key_pair["privateKey"]}
+                    for idx, key_pair in enumerate(ujson.loads(wallet["key_pair"]))))
+            self.exec('update wallet set key_pair=null where wallet_id=:wallet_id', {'wallet_id': wallet["wallet_id"]})
+
+    def migrate_tx(self):
+        """
+            Rebuild a tx table created without a primary key, rows keep their order and the first row of a duplicated id wins.
+            The migrated rows get the migration time as created_at, their real one is not known
+        """
+        columns = {row[1]: row[5] for row in self.fetch_all('pragma table_info(tx)')}
+        if columns.get('transaction_id'):
+            return
+        self.exec('alter table tx rename to tx_legacy')
+        self.exec('create table tx {}'.format(TX_COLUMNS))
+        copied = ', '.join(column for column in ('transaction_id', 'hash', 'type', 'data', 'confirmed', 'block_index', 'block_hash') if column in columns)
+        self.exec('insert or ignore into tx ({0}) select {0} from tx_legacy order by rowid'.format(copied))
+        self.exec('drop table tx_legacy')
+
+    def migrate_tx_items(self):
+        """
+            Fill tx_input and tx_output from the data of the transactions saved before they existed, in one statement each
+        """
+        if self.fetch_one('select value from sync_state where name=:name', {'name': TX_ITEMS_MIGRATION}) is not None:
+            return
+        self.exec("insert or ignore into tx_input select tx.transaction_id, item.key, json_extract(item.value, '$.transaction'), json_extract(item.value, '$.index'),"
+            " json_extract(item.value, '$.address'), json_extract(item.value, '$.amount') from tx, json_each(tx.data, '$.inputs') as item where json_valid(tx.data)")
+        self.exec("insert or ignore into tx_output select tx.transaction_id, item.key, json_extract(item.value, '$.address'), json_extract(item.value, '$.amount')"
+            " from tx, json_each(tx.data, '$.outputs') as item where json_valid(tx.data)")
+        self.exec('insert into sync_state values(:name, 1)', {'name': TX_ITEMS_MIGRATION})
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        #a forked process must not reuse the connection opened by its parent
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.pid = os.getpid()
+            self._local.connection = self.connect()
+            self._local.depth = 0
+        return self._local.connection
 
     def connect(self):
-        connection = sqlite3.connect(LOCAL_DATA_PATH + self.name)
+        connection = sqlite3.connect(self.path + self.name, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
         connection.row_factory = self.row_format
-        return connection, connection.cursor()
-
-    def exec(self, sql, param = ..., commit=False):
-        connection, cursor = self.connect()
-        query_cursor = cursor.execute(sql, param)
-        if commit:
-            connection.commit()
-            connection.close()
+        connection.execute('pragma journal_mode=WAL')
+        #WAL only needs to sync on checkpoint, not on every commit
+        connection.execute('pragma synchronous=NORMAL')
+        connection.execute('pragma busy_timeout={}'.format(int(BUSY_TIMEOUT * 1000)))
+        return connection
+
+    def close(self):
+        if getattr(self._local, 'pid', None) == os.getpid():
+            self._local.connection.close()
+        self._local.pid = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+            Group every statement executed inside the block into a single commit, nested blocks join the outer one
+        """
+        connection = self.connection
+        if self._local.depth == 0:
+            #take the write lock up front, upgrading a read lock later can not wait on the busy timeout
+            connection.execute('begin immediate')
+        self._local.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                connection.rollback()
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            with COMMIT_SECONDS.time():
+                connection.commit()
+
+    def exec(self, sql, param = (), commit=False):
+        connection = self.connection
+        start = time.perf_counter()
+        query_cursor = connection.execute(sql, () if param is ... else param)
+        _statement_histogram(sql).observe(time.perf_counter() - start)
+        if commit and self._local.depth == 0:
+            with COMMIT_SECONDS.time():
+                connection.commit()
         return connection, query_cursor
 
-    def fetch_one(self, select_sql, param = ...) -> sqlite3.Row:
-        connection, cursor = self.exec(select_sql, param)
-        result = cursor.fetchone()
-        connection.close()
-        return result
+    def exec_many(self, sql, params, commit=True):
+        connection = self.connection
+        start = time.perf_counter()
+        query_cursor = connection.executemany(sql, params)
+        _statement_histogram(sql).observe(time.perf_counter() - start)
+        if commit and self._local.depth == 0:
+            with COMMIT_SECONDS.time():
+                connection.commit()
+        return connection, query_cursor
 
+    def fetch_one(self, select_sql, param = ()) -> sqlite3.Row:
+        _, cursor = self.exec(select_sql, param)
+        return cursor.fetchone()
 
-    def fetch_all(self, select_sql, param = ...):
-        connection, cursor = self.exec(select_sql, param)
-        result = cursor.fetchall()
-        connection.close()
-        return result
\ No newline at end of file
+    def fetch_all(self, select_sql, param = ()):
+        _, cursor = self.exec(select_sql, param)
+        return cursor.fetchall()
@@ -0,0 +1,151 @@
+import csv
+import datetime
+import ujson
+
+from lib.config import CLIENT_CONFIG, HISTORY_PAGE_SIZE, HISTORY_EXPORT_BATCH
+
+#pending: not in a block yet, included: in a block not deep enough, confirmed: CONFIRMATION_DEPTH reached
+STATUS_FILTERS = {
+    'pending': 'tx.confirmed=0 and tx.block_index is null',
+    'included': 'tx.confirmed=0 and tx.block_index is not null',
+    'confirmed': 'tx.confirmed=1',
+}
+ADDRESS_FILTER = ("tx.transaction_id in (select transaction_id from tx_input where address in (select value from json_each(:addresses))"
+    " union select transaction_id from tx_output where address in (select value from json_each(:addresses)))")
+ADDRESS_SUMMARY = """select
+    (select coalesce(sum(amount), 0) from tx_output where address=:address) as received,
+    (select coalesce(sum(amount), 0) from tx_input where address=:address) as sent,
+    (select coalesce(sum(output.amount), 0) from tx_output as output where output.address=:address
+        and not exists (select 1 from tx_input where source_transaction=output.transaction_id and source_index=output.output_index)) as balance,
+    (select count(*) from (select transaction_id from tx_input where address=:address union select transaction_id from tx_output where address=:address)) as transactions"""
+EXPORT_FIELDS = ('transaction_id', 'type', 'status', 'confirmations', 'block_index', 'block_hash', 'created_at', 'confirmed_at')
+
+def to_timestamp(value):
+    """
+        Unix seconds from a number or an ISO date ('2021-10-01' or '2021-10-01T12:00:00', local time when no offset)
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+class TransactionHistory():
+    """
+        Transactions of the local database newest first, read with keyset paging on (created_at, rowid)
+        so a page costs the same at the end of millions of rows as at the start
+    """
+    def __init__(self, db = None) -> None:
+        self.db = db if db is not None else CLIENT_CONFIG.db
+
+    def tip_index(self):
+        from lib.api import TranscationUpdater
+        cursor = self.db.fetch_one('select value from sync_state where name=:name', {'name': TranscationUpdater.CURSOR_NAME})
+        return None if cursor is None else cursor["value"]
+
+    @staticmethod
+    def encode_cursor(row) -> str:
+        return '{!r}:{}'.format(row["created_at"], row["rowid"])
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            created_at, rowid = cursor.rsplit(':', 1)
+            return float(created_at), int(rowid)
+        except (AttributeError, ValueError):
+            raise ValueError('Invalid history cursor {!r}'.format(cursor))
+
+    def query(self, status=None, since=None, until=None, address=None, cursor=None):
+        """
+            Where clause and params of the filters. address is one address or a list of them,
+            a transaction matches when one of its inputs or outputs has it, looked up in the tx_input and tx_output address indexes
+        """
+        clauses = []
+        params = {}
+        if status is not None:
+            if status not in STATUS_FILTERS:
+                raise ValueError('Unknown status {!r}, expected one of {}'.format(status, ', '.join(STATUS_FILTERS)))
+            clauses.append(STATUS_FILTERS[status])
+        if since is not None:
+            clauses.append('tx.created_at>=:since')
+            params['since'] = to_timestamp(since)
+        if until is not None:
+            clauses.append('tx.created_at<:until')
+            params['until'] = to_timestamp(until)
+        if address is not None:
+            clauses.append(ADDRESS_FILTER)
+            params['addresses'] = ujson.dumps([address] if isinstance(address, str) else list(address))
+        if cursor is not None:
+            params['created_at'], params['rowid'] = self.decode_cursor(cursor)
+            clauses.append('(tx.created_at<:created_at or (tx.created_at=:created_at and tx.rowid<:rowid))')
+        return (' where ' + ' and '.join(clauses)) if clauses else '', params
+
+    def rows(self, limit, with_data=False, **filters):
+        where, params = self.query(**filters)
+        params['limit'] = limit
+        return self.db.fetch_all('select tx.rowid, tx.transaction_id, tx.type, tx.confirmed, tx.block_index, tx.block_hash, tx.created_at, tx.confirmed_at{} from tx{}'
+            ' order by tx.created_at desc, tx.rowid desc limit :limit'.format(', tx.data' if with_data else '', where), params)
+
+    @staticmethod
+    def to_json(row, tip_index, with_data=False) -> dict:
+        if row["confirmed"]:
+            status = 'confirmed'
+        else:
+            status = 'pending' if row["block_index"] is None else 'included'
+        confirmations = 0 if row["block_index"] is None or tip_index is None else max(tip_index - row["block_index"] + 1, 0)
+        entry = {'transaction_id': row["transaction_id"], 'type': row["type"], 'status': status, 'confirmations': confirmations,
+            'block_index': row["block_index"], 'block_hash': row["block_hash"], 'created_at': row["created_at"], 'confirmed_at': row["confirmed_at"]}
+        if with_data:
+            entry['data'] = ujson.loads(row["data"])
+        return entry
+
+    def page(self, limit=HISTORY_PAGE_SIZE, cursor=None, status=None, since=None, until=None, address=None) -> dict:
+        """
+            {'transactions': [...], 'next_cursor': cursor of the next page or None on the last one}
+        """
+        rows = self.rows(limit + 1, cursor=cursor, status=status, since=since, until=until, address=address)
+        tip_index = self.tip_index()
+        return {
+            'transactions': [self.to_json(row, tip_index) for row in rows[:limit]],
+            'next_cursor': self.encode_cursor(rows[limit - 1]) if len(rows) > limit else None,
+        }
+
+    def iter(self, with_data=False, batch_size=HISTORY_EXPORT_BATCH, **filters):
+        """
+            Every matching transaction, batch_size rows in memory at a time. Each batch is its own query
+            so a long export does not keep a read transaction open on the database
+        """
+        tip_index = self.tip_index()
+        cursor = filters.pop('cursor', None)
+        while True:
+            rows = self.rows(batch_size, with_data=with_data, cursor=cursor, **filters)
+            for row in rows:
+                yield self.to_json(row, tip_index, with_data)
+            if len(rows) < batch_size:
+                return
+            cursor = self.encode_cursor(rows[-1])
+
+    def address_summary(self, address) -> dict:
+        """
+            Totals of address over the transactions of the local database: received by its outputs, sent by its inputs,
+            its outputs no local transaction spends and the number of transactions, in one query on the address indexes
+        """
+        row = self.db.fetch_one(ADDRESS_SUMMARY, {'address': address})
+        return {'address': address, 'received': row["received"], 'sent': row["sent"], 'balance': row["balance"], 'transactions': row["transactions"]}
+
+    def export(self, stream, format='jsonl', **filters) -> int:
+        """
+            Write the matching transactions to a text stream as jsonl (with the inputs and outputs) or csv, return the number written
+        """
+        count = 0
+        if format == 'jsonl':
+            for entry in self.iter(with_data=True, **filters):
+                stream.write(ujson.dumps(entry) + '\n')
+                count += 1
+        elif format == 'csv':
+            writer = csv.DictWriter(stream, EXPORT_FIELDS)
+            writer.writeheader()
+            for entry in self.iter(**filters):
+                writer.writerow(entry)
+                count += 1
+        else:
+            raise ValueError('Unknown export format {!r}, expected jsonl or csv'.format(format))
+        return count
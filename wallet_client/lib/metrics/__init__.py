@@ -0,0 +1,183 @@
+import os
+import bisect
+import time
+import threading
+import contextlib
+import functools
+import ujson
+
+#seconds, from a statement on a warm connection to a slow node request
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter():
+    __slots__ = ('value', '_lock')
+
+    def __init__(self) -> None:
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def reset(self):
+        with self._lock:
+            self.value = 0
+
+    def snapshot(self):
+        return self.value
+
+class Histogram():
+    """
+        Latency histogram with fixed upper bounds, the last bucket counts everything above them
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum', '_lock')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'count': self.count, 'sum': self.sum, 'buckets': dict(zip([repr(bound) for bound in self.buckets] + ['+Inf'], self.counts))}
+
+class Metrics():
+    """
+        Registry of the counters and histograms of this process, keyed by name and labels.
+        Hot paths keep the metric returned by counter()/histogram() instead of looking it up on every call
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._help = {}
+
+    def _get(self, cls, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls()
+                    if help:
+                        self._help[name] = help
+        return metric
+
+    def counter(self, name, help='', **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help='', **labels) -> Histogram:
+        return self._get(Histogram, name, help, labels)
+
+    def timer(self, name, help='', **labels):
+        """
+            with METRICS.timer('wallet_kdf_seconds', function='generate_secret'): ...
+        """
+        return self.histogram(name, help, **labels).time()
+
+    def timed(self, name, help='', **labels):
+        """
+            Decorator observing the duration of every call of the function
+        """
+        def decorator(fn):
+            histogram = self.histogram(name, help, **labels)
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        """
+            Zero every metric, e.g. in a forked process. The metrics stay registered so references kept by hot paths still count
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def snapshot(self) -> dict:
+        """
+            {name: [{'labels': {...}, 'value': n} or {'labels': {...}, 'count', 'sum', 'buckets'}]}
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+        result = {}
+        for (name, labels), metric in metrics:
+            value = metric.snapshot()
+            entry = dict(value, labels=dict(labels)) if isinstance(metric, Histogram) else {'labels': dict(labels), 'value': value}
+            result.setdefault(name, []).append(entry)
+        return result
+
+    def to_prometheus(self) -> str:
+        """
+            Snapshot in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+        lines = []
+        described = set()
+        for (name, labels), metric in metrics:
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append('# HELP {} {}'.format(name, self._help[name]))
+                lines.append('# TYPE {} {}'.format(name, 'histogram' if isinstance(metric, Histogram) else 'counter'))
+            if isinstance(metric, Histogram):
+                value = metric.snapshot()
+                cumulative = 0
+                for bound, count in value["buckets"].items():
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', bound),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), repr(value["sum"])))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), value["count"]))
+            else:
+                lines.append('{}{} {}'.format(name, _labels(labels), metric.snapshot()))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+            Write a snapshot to path, json if it ends with .json else the Prometheus text format.
+            The file is replaced atomically so a scraper never reads half of it
+        """
+        content = ujson.dumps(self.snapshot(), indent=2) if path.endswith('.json') else self.to_prometheus()
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(tmp_path, path)
+
+def _labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+#metrics of this process, the client and the transaction updater each have their own
+METRICS = Metrics()
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from lib.api import NaiveCoinApi
+from lib.api.aio import AsyncNaiveCoinApi
+from lib.api.exception import TransactionRequestException
+from lib.config import CLIENT_CONFIG, CONFIRMATION_DEPTH, RESCAN_WINDOW, RESCAN_CHECKPOINT
+from lib.config.log import Logger
+from lib.metrics import METRICS
+from lib.transaction import Transaction
+from lib.watch import AddressFilter
+
+RESCANNED_BLOCKS = METRICS.counter('wallet_rescan_blocks_total', 'Blocks read by chain rescans')
+
+class ChainRescan():
+    """
+        Walk the node chain block by block for the transactions paying or spending one of addresses and save them to the local history.
+        At most window blocks are in memory, they are fetched concurrently and written with the checkpoint in one commit,
+        an interrupted rescan resumes after the last window written
+    """
+    def __init__(self, addresses, db = None, node = None, window = RESCAN_WINDOW, checkpoint = RESCAN_CHECKPOINT) -> None:
+        self.addresses = addresses if isinstance(addresses, AddressFilter) else AddressFilter(addresses)
+        self.db = db if db is not None else CLIENT_CONFIG.db
+        self.node = node
+        self.window = window
+        self.checkpoint = checkpoint
+
+    def load_checkpoint(self):
+        row = self.db.fetch_one('select value from sync_state where name=:name', {'name': self.checkpoint})
+        return None if row is None else row["value"]
+
+    def save_checkpoint(self, block_index):
+        self.db.exec('insert or replace into sync_state values(:name, :value)', {'name': self.checkpoint, 'value': block_index})
+
+    def matches(self, transaction) -> bool:
+        data = transaction["data"]
+        return any(item.get("address") in self.addresses for item in data["outputs"]) \
+            or any(item.get("address") in self.addresses for item in data["inputs"])
+
+    def save_blocks(self, blocks, tip_index) -> int:
+        """
+            Save the matching transactions of blocks with their block and the checkpoint, return how many matched.
+            A transaction the updater already placed in a block keeps its row as is
+        """
+        rows = []
+        with self.db.transaction():
+            for block in blocks:
+                for transaction in block["transactions"]:
+                    if not self.matches(transaction):
+                        continue
+                    Transaction.from_json(transaction).save(self.db)
+                    confirmed = tip_index - block["index"] + 1 >= CONFIRMATION_DEPTH
+                    rows.append({'transaction_id': transaction["id"], 'block_index': block["index"], 'block_hash': block["hash"],
+                        'created_at': block["timestamp"], 'confirmed': confirmed, 'confirmed_at': block["timestamp"] if confirmed else None})
+            self.db.exec_many('update tx set block_index=:block_index, block_hash=:block_hash, created_at=:created_at, confirmed=:confirmed, confirmed_at=:confirmed_at'
+                ' where transaction_id=:transaction_id and block_index is null', rows)
+            self.save_checkpoint(blocks[-1]["index"])
+        return len(rows)
+
+    async def scan(self, from_index = None, to_index = None, progress = None) -> dict:
+        async with AsyncNaiveCoinApi(self.node or NaiveCoinApi.node) as api:
+            if to_index is None:
+                to_index = (await api.get_latest_block())["index"]
+            if from_index is None:
+                checkpoint = self.load_checkpoint()
+                from_index = 0 if checkpoint is None else checkpoint + 1
+            report = {'from_index': from_index, 'to_index': to_index, 'blocks': 0, 'transactions': 0, 'found': 0}
+            start = time.perf_counter()
+            for first in range(from_index, to_index + 1, self.window):
+                indexes = range(first, min(first + self.window, to_index + 1))
+                results = await api.gather(api.get_block_by_index(index) for index in indexes)
+                blocks = []
+                for index, result in zip(indexes, results):
+                    if not result.ok or not isinstance(result.value, dict) or result.value.get("index") != index:
+                        #the windows before are saved, the next rescan starts again at this one
+                        raise TransactionRequestException('Block {} not read during rescan: {}'.format(index, result.error or result.value))
+                    blocks.append(result.value)
+                report['found'] += self.save_blocks(blocks, to_index)
+                report['blocks'] += len(blocks)
+                report['transactions'] += sum(len(block["transactions"]) for block in blocks)
+                RESCANNED_BLOCKS.inc(len(blocks))
+                report['seconds'] = time.perf_counter() - start
+                report['blocks_per_second'] = report['blocks'] / report['seconds'] if report['seconds'] else 0
+                if progress is not None:
+                    progress(dict(report, block_index=blocks[-1]["index"]))
+        report['seconds'] = time.perf_counter() - start
+        report['blocks_per_second'] = report['blocks'] / report['seconds'] if report['seconds'] and report['blocks'] else 0
+        Logger.info('Rescanned blocks %s to %s, %s transaction(s) found at %.1f blocks/s', from_index, to_index, report['found'], report['blocks_per_second'])
+        return report
+
+    def run(self, from_index = None, to_index = None, progress = None) -> dict:
+        """
+            Scan from the block after the checkpoint (or from_index) to the latest block (or to_index) and return
+            {'from_index', 'to_index', 'blocks', 'transactions', 'found', 'seconds', 'blocks_per_second'}.
+            progress(report) is called after each window with the block_index reached
+        """
+        return asyncio.run(self.scan(from_index, to_index, progress))
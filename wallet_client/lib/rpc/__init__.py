@@ -0,0 +1,299 @@
+import asyncio
+import inspect
+import aiohttp
+import threading
+import requests
+import ujson
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from lib.api import TranscationUpdater
+from lib.api.exception import TransactionRequestException
+from lib.config import HISTORY_PAGE_SIZE, RESCAN_CHECKPOINT, SUBSCRIBE_BLOCKS, DAEMON_WORKERS, DAEMON_MAX_BATCH, DAEMON_EVENTS
+from lib.config import WALLET_CACHE_PRUNE_INTERVAL, DAEMON_MAX_ADDRESSES
+from lib.config.log import Logger
+from lib.history import TransactionHistory
+from lib.rescan import ChainRescan
+from lib.metrics import METRICS
+from lib.rpc.exception import RpcException, PARSE_ERROR, INVALID_REQUEST, METHOD_NOT_FOUND, INVALID_PARAMS, INTERNAL_ERROR
+from lib.rpc.exception import WALLET_ERROR, NODE_ERROR, WALLET_LOCKED
+from lib.wallet import Wallet
+from lib.wallet.manager import WalletManager
+from lib.wallet.exception import WalletException
+
+def check_params(valid, message):
+    """
+        Raise an INVALID_PARAMS RpcException unless valid
+    """
+    if not valid:
+        raise RpcException(INVALID_PARAMS, 'Invalid params: {}'.format(message))
+
+def is_amount(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+def is_index(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+class EventLog():
+    """
+        Queue of the in-process updater, the last events are kept with a sequence number
+        so every caller polls what it missed with get_events(since)
+    """
+    def __init__(self, size=DAEMON_EVENTS) -> None:
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def put(self, events):
+        with self.lock:
+            for transaction_id, confirmations in events:
+                self.seq += 1
+                self.events.append({'seq': self.seq, 'transaction_id': transaction_id, 'confirmations': confirmations})
+
+    def since(self, seq) -> list:
+        with self.lock:
+            return [event for event in self.events if event["seq"] > seq]
+
+class WalletService():
+    """
+        The wallet operations of the menu client for programs. Unlocked wallets stay in a WalletManager by id
+        until they are locked, expire or are pushed out by newer ones,
+        calls on the same wallet run one at a time so two sends never pick the same outputs
+    """
+    def __init__(self, events = None, wallets: WalletManager = None) -> None:
+        self.wallets = wallets if wallets is not None else WalletManager()
+        self.events = events if events is not None else EventLog()
+
+    def unlocked(self, wallet_id) -> Wallet:
+        wallet = self.wallets.get(wallet_id)
+        if wallet is None:
+            raise RpcException(WALLET_LOCKED, 'Wallet {} is not unlocked, call load_wallet first'.format(wallet_id))
+        return wallet
+
+    def unlock(self, wallet) -> dict:
+        wallet = self.wallets.add(wallet)
+        return {'wallet_id': wallet.id, 'addresses': len(wallet.addresses)}
+
+    def create_wallet(self, password, addresses=1):
+        check_params(isinstance(password, str) and password, 'password must be a non empty string')
+        check_params(is_index(addresses) and 1 <= addresses <= DAEMON_MAX_ADDRESSES,
+            'addresses must be an integer from 1 to {}'.format(DAEMON_MAX_ADDRESSES))
+        wallet = Wallet.from_password(password)
+        for _ in range(addresses):
+            wallet.generate_address()
+        wallet.save()
+        return self.unlock(wallet)
+
+    def load_wallet(self, password):
+        check_params(isinstance(password, str) and password, 'password must be a non empty string')
+        wallet = self.wallets.login(password)
+        return {'wallet_id': wallet.id, 'addresses': len(wallet.addresses)}
+
+    def lock_wallet(self, wallet_id):
+        if not self.wallets.remove(wallet_id):
+            raise RpcException(WALLET_LOCKED, 'Wallet {} is not unlocked'.format(wallet_id))
+        return True
+
+    def list_wallets(self):
+        return self.wallets.ids()
+
+    def generate_address(self, wallet_id):
+        address = self.wallets.generate_address(wallet_id)
+        if address is None:
+            raise RpcException(WALLET_LOCKED, 'Wallet {} is not unlocked, call load_wallet first'.format(wallet_id))
+        return address
+
+    def list_addresses(self, wallet_id):
+        return list(self.unlocked(wallet_id).addresses)
+
+    def balance(self, wallet_id):
+        return self.unlocked(wallet_id).balances()
+
+    def send(self, wallet_id, from_address, to_address, amount):
+        check_params(isinstance(from_address, str) and isinstance(to_address, str), 'addresses must be strings')
+        check_params(is_amount(amount), 'amount must be a positive number')
+        transaction = self.unlocked(wallet_id).send(to_address, from_address, amount)
+        transaction.save()
+        return {'transaction_id': transaction.id}
+
+    def send_many(self, wallet_id, from_address, payments):
+        check_params(isinstance(from_address, str), 'from_address must be a string')
+        check_params(isinstance(payments, list) and all(isinstance(payment, dict) for payment in payments),
+            'payments must be a list of {"address": ..., "amount": ...} objects')
+        transactions, results = self.unlocked(wallet_id).send_many(((payment["address"], payment["amount"]) for payment in payments), from_address)
+        for transaction in transactions:
+            transaction.save()
+        return {'transactions': [transaction.id for transaction in transactions], 'results': results}
+
+    def history(self, wallet_id, limit=HISTORY_PAGE_SIZE, cursor=None, status=None, since=None, until=None):
+        """
+            A page of the transactions paying or spending an address of the wallet, see TransactionHistory.page
+        """
+        check_params(is_index(limit) and limit > 0, 'limit must be a positive integer')
+        addresses = self.unlocked(wallet_id).addresses
+        return TransactionHistory().page(limit, cursor, status, since, until, addresses)
+
+    def address_summary(self, wallet_id, address):
+        if address not in self.unlocked(wallet_id).addresses:
+            raise WalletException('Address {} is not in wallet {}'.format(address, wallet_id))
+        return TransactionHistory().address_summary(address)
+
+    def rescan(self, wallet_id, from_index=None):
+        """
+            Save the chain transactions of the wallet addresses to the history, from the block after the last rescan of the wallet
+        """
+        check_params(from_index is None or is_index(from_index), 'from_index must be a block index')
+        addresses = self.unlocked(wallet_id).addresses
+        return ChainRescan(addresses, checkpoint='{}:{}'.format(RESCAN_CHECKPOINT, wallet_id)).run(from_index)
+
+    def get_events(self, since=0):
+        check_params(is_index(since), 'since must be an event sequence number')
+        return self.events.since(since)
+
+    #methods callable over rpc, the ones taking a wallet_id are serialised per wallet
+    METHODS = ('create_wallet', 'load_wallet', 'lock_wallet', 'list_wallets', 'generate_address', 'list_addresses',
+        'balance', 'send', 'send_many', 'history', 'address_summary', 'rescan', 'get_events')
+
+    def call(self, method, params):
+        """
+            Run a method with json-rpc params, a list or an object. Bad params are INVALID_PARAMS,
+            wallet and node failures their own codes, anything else raises on to the server as an internal error
+        """
+        if method not in self.METHODS:
+            raise RpcException(METHOD_NOT_FOUND, 'Method not found: {}'.format(method))
+        fn = getattr(self, method)
+        try:
+            bound = inspect.signature(fn).bind(*params) if isinstance(params, list) else inspect.signature(fn).bind(**params)
+        except TypeError as ex:
+            raise RpcException(INVALID_PARAMS, 'Invalid params: {}'.format(ex))
+        wallet_id = bound.arguments.get('wallet_id')
+        check_params(wallet_id is None or isinstance(wallet_id, str), 'wallet_id must be a string')
+        try:
+            if wallet_id is None:
+                return fn(*bound.args, **bound.kwargs)
+            with self.wallets.wallet_lock(wallet_id):
+                return fn(*bound.args, **bound.kwargs)
+        except WalletException as ex:
+            raise RpcException(WALLET_ERROR, str(ex))
+        except ValueError as ex:
+            #an unknown history status or cursor
+            raise RpcException(INVALID_PARAMS, 'Invalid params: {}'.format(ex))
+        except (TransactionRequestException, requests.exceptions.RequestException, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            raise RpcException(NODE_ERROR, str(ex))
+        finally:
+            if wallet_id is not None:
+                #a wallet locked or evicted during the call is wiped once its lock is free
+                self.wallets.wipe_released()
+
+class JsonRpcServer():
+    """
+        JSON-RPC 2.0 over HTTP POST / for a WalletService, batches are answered as one array.
+        Calls run on a thread pool so a slow node or key derivation does not hold the other callers,
+        the transaction updater runs in a thread of the same process and feeds service.events
+    """
+    def __init__(self, service: WalletService = None, workers=DAEMON_WORKERS, updater=True, subscribe=SUBSCRIBE_BLOCKS) -> None:
+        self.service = service or WalletService()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rpc')
+        self.updater = TranscationUpdater(self.service.events, subscribe=subscribe) if updater else None
+        self._stop = threading.Event()
+        self._updater_thread = None
+        self._prune_task = None
+        self.runner = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        app.router.add_get('/metrics', self.metrics)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+    async def on_startup(self, app):
+        self._prune_task = asyncio.ensure_future(self.prune_wallets())
+        if self.updater is not None:
+            self._stop.clear()
+            self._updater_thread = threading.Thread(target=self.run_updater, daemon=True)
+            self._updater_thread.start()
+
+    async def on_cleanup(self, app):
+        if self._updater_thread is not None:
+            self._stop.set()
+            self.updater.wake.set()
+            await asyncio.get_running_loop().run_in_executor(None, self._updater_thread.join)
+            if self.updater.subscription is not None:
+                self.updater.subscription.stop()
+        self._prune_task.cancel()
+        self.executor.shutdown(wait=True)
+        #no call is running anymore, every unlocked wallet is wiped
+        self.service.wallets.clear()
+
+    async def prune_wallets(self):
+        """
+            Lock the expired wallets even when no call comes in
+        """
+        while True:
+            await asyncio.sleep(WALLET_CACHE_PRUNE_INTERVAL)
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.service.wallets.prune)
+
+    def run_updater(self):
+        self.updater.wake = threading.Event()
+        if self.updater.subscribe:
+            self.updater.start_subscription()
+        Logger.info("Transcation updater started in the daemon")
+        self.updater.loop(self._stop)
+
+    async def start(self, host, port):
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        return self
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def metrics(self, request):
+        return web.Response(text=METRICS.to_prometheus(), content_type='text/plain')
+
+    async def handle(self, request):
+        try:
+            body = ujson.loads(await request.read())
+        except ValueError:
+            return self.respond(self.error(None, PARSE_ERROR, 'Parse error'))
+        if isinstance(body, list):
+            if not body or len(body) > DAEMON_MAX_BATCH:
+                return self.respond(self.error(None, INVALID_REQUEST, 'Batch of 1 to {} requests expected'.format(DAEMON_MAX_BATCH)))
+            responses = await asyncio.gather(*[self.dispatch(item) for item in body])
+            #notifications have no response, a batch of notifications has no body at all
+            responses = [response for response in responses if response is not None]
+            return self.respond(responses or None)
+        return self.respond(await self.dispatch(body))
+
+    @staticmethod
+    def respond(body):
+        if body is None:
+            return web.Response(status=204)
+        return web.json_response(body, dumps=ujson.dumps)
+
+    @staticmethod
+    def error(id, code, message) -> dict:
+        return {'jsonrpc': '2.0', 'error': {'code': code, 'message': message}, 'id': id}
+
+    async def dispatch(self, request):
+        if not isinstance(request, dict) or request.get("jsonrpc") != '2.0' or not isinstance(request.get("method"), str) \
+                or not isinstance(request.get("params", []), (list, dict)):
+            return self.error(request.get("id") if isinstance(request, dict) else None, INVALID_REQUEST, 'Invalid request')
+        id = request.get("id")
+        METRICS.counter('wallet_rpc_requests_total', 'Json-rpc calls', method=request["method"]).inc()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, self.service.call, request["method"], request.get("params", []))
+        except RpcException as ex:
+            response = self.error(id, ex.code, ex.message)
+        except Exception as ex:
+            Logger.error('Rpc %s failed error: %s', request["method"], ex)
+            response = self.error(id, INTERNAL_ERROR, 'Internal error')
+        else:
+            response = {'jsonrpc': '2.0', 'result': result, 'id': id}
+        return response if "id" in request else None
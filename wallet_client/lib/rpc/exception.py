@@ -0,0 +1,15 @@
+#json-rpc 2.0 error codes, -32000 and below are ours
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+WALLET_ERROR = -32000
+NODE_ERROR = -32001
+WALLET_LOCKED = -32002
+
+class RpcException(Exception):
+    def __init__(self, code, message) -> None:
+        super(RpcException, self).__init__(message)
+        self.code = code
+        self.message = message
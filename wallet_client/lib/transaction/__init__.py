@@ -1,26 +1,57 @@
+import os
 import binascii
+import functools
+import itertools
 import ujson
 
-from lib.config import CLIENT_CONFIG
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from lib.config import CLIENT_CONFIG, VERIFY_WORKERS, VERIFY_CHUNK_SIZE, VERIFY_PARALLEL_MIN
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
 from lib.transaction.exception import TransactionInvalidException
 from lib.cryptoUtil import CryptoUtil, Ed25519Util
+from lib.transaction.model import TxInput, TxOutput, TxData
 
 TRANSACTION_TYPE_REGULAR = 'regular'
 TRANSACTION_TYPE_FEE = 'fee'
 TRANSACTION_TYPE_REWARD = 'reward'
 
+@functools.lru_cache(maxsize=4096)
+def _public_key(address) -> Ed25519PublicKey:
+    return Ed25519PublicKey.from_public_bytes(binascii.unhexlify(address))
+
+def _verify_signatures(jobs) -> list:
+    """
+        Check a chunk of (job id, address, signature, input hash), return the ids of the invalid ones.
+        Runs in the worker thread or process, public keys are cached per worker
+    """
+    from cryptography.exceptions import InvalidSignature
+    invalid = []
+    for job_id, address, signature, input_hash in jobs:
+        try:
+            Ed25519Util.verify_signature(_public_key(address), signature, input_hash)
+        except (InvalidSignature, ValueError, TypeError, binascii.Error):
+            invalid.append(job_id)
+    return invalid
+
 class Transaction():
-    def __init__(self, id: str, type: str, inputs = [], outputs = [], hash = None) -> None:
+    """
+        Inputs and outputs are slotted TxInput/TxOutput objects, the serialized data and the hash
+        are computed once and cached until the transaction is modified
+    """
+    __slots__ = ('id', 'hash', 'type', 'data', 'confirmed', '_hash_cache')
+
+    def __init__(self, id: str, type: str, inputs = (), outputs = (), hash = None) -> None:
         self.id = id
         self.hash = hash
         self.type = type
-        self.data = {
-            'inputs': inputs,
-            'outputs': outputs,
-        }
+        self._hash_cache = None
+        self.data = TxData(self, inputs, outputs)
         self.confirmed = False
 
+    def _invalidate(self):
+        self._hash_cache = None
+        self.data._json = None
+
     @staticmethod
     def verify(tx_obj):
         """
@@ -31,44 +62,103 @@ class Transaction():
             raise TransactionInvalidException('Transacion hash invalid got {} expect {}'.format(current_tx_hash, tx_obj.hash))
 
         from cryptography.exceptions import InvalidSignature
-        for input_txs in tx_obj.data["inputs"]:
+        for input_txs in tx_obj.data.inputs:
             try:
-                public_key = Ed25519PublicKey.from_public_bytes(binascii.unhexlify(input_txs["address"]))
-                input_txs_hash = CryptoUtil.hash(ujson.dumps({
-                    'transaction': input_txs["transaction"],
-                    'index': input_txs["index"],
-                    'address': input_txs["address"]
-                }))
-                Ed25519Util.verify_signature(public_key, input_txs["signature"], input_txs_hash)
+                public_key = Ed25519PublicKey.from_public_bytes(binascii.unhexlify(input_txs.address))
+                Ed25519Util.verify_signature(public_key, input_txs.signature, input_txs.input_hash)
             except InvalidSignature:
-                raise TransactionInvalidException('Transation {} signature invalid'.format(input_txs["transaction"]))
+                raise TransactionInvalidException('Transation {} signature invalid'.format(input_txs.transaction))
 
-        inputSum = sum(input["amount"] for input in tx_obj.data["inputs"])
-        outputSum = sum(output["amount"] for output in tx_obj.data["outputs"])
+        #fee and reward transactions create coins, only regular ones must pay a fee like the node checks
+        if tx_obj.type == TRANSACTION_TYPE_REGULAR:
+            inputSum = sum(input.amount for input in tx_obj.data.inputs)
+            outputSum = sum(output.amount for output in tx_obj.data.outputs)
 
-        if outputSum >= inputSum:
-            raise TransactionInvalidException('Transaction invalid got output amount larger than input amount got {}'.format(inputSum))
+            if outputSum >= inputSum:
+                raise TransactionInvalidException('Transaction invalid got output amount larger than input amount got {}'.format(inputSum))
 
         return tx_obj
             
+    @staticmethod
+    def verify_many(tx_objs, max_workers=VERIFY_WORKERS, use_processes=False, chunk_size=VERIFY_CHUNK_SIZE, parallel_min=VERIFY_PARALLEL_MIN) -> list:
+        """
+            Verify many transactions at once, e.g. every transaction of a block or a downloaded history.
+            Signatures are checked serially unless max_workers is above 1 and there are at least parallel_min of them,
+            they are then spread over a thread pool (or a process pool with use_processes).
+            Return a (transaction, [TransactionInvalidException]) pair for every invalid transaction, empty if all are valid
+        """
+        tx_objs = list(tx_objs)
+        errors = [[] for _ in tx_objs]
+        jobs = []
+        for tx_index, tx_obj in enumerate(tx_objs):
+            current_tx_hash = tx_obj.calc_hash()
+            if current_tx_hash != tx_obj.hash:
+                errors[tx_index].append(TransactionInvalidException('Transacion hash invalid got {} expect {}'.format(current_tx_hash, tx_obj.hash)))
+            for input_index, input_txs in enumerate(tx_obj.data.inputs):
+                jobs.append(((tx_index, input_index), input_txs.address, input_txs.signature, input_txs.input_hash))
+            if tx_obj.type == TRANSACTION_TYPE_REGULAR:
+                inputSum = sum(input.amount for input in tx_obj.data.inputs)
+                outputSum = sum(output.amount for output in tx_obj.data.outputs)
+                if outputSum >= inputSum:
+                    errors[tx_index].append(TransactionInvalidException('Transaction invalid got output amount larger than input amount got {}'.format(inputSum)))
+
+        chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+        max_workers = max_workers or os.cpu_count() or 1
+        if len(chunks) <= 1 or max_workers == 1 or len(jobs) < parallel_min:
+            #a pool only adds overhead on a single cpu, a single chunk or a small batch
+            invalid = map(_verify_signatures, chunks)
+        else:
+            executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+            with executor_cls(max_workers=max_workers) as executor:
+                invalid = list(executor.map(_verify_signatures, chunks))
+        for tx_index, input_index in itertools.chain.from_iterable(invalid):
+            errors[tx_index].append(TransactionInvalidException('Transation {} signature invalid'.format(tx_objs[tx_index].data.inputs[input_index].transaction)))
+
+        return [(tx_obj, tx_errors) for tx_obj, tx_errors in zip(tx_objs, errors) if tx_errors]
+
+    @staticmethod
+    def verify_block(block, **kwargs) -> list:
+        """
+            Verify every transaction of a block in the node JSON format, see verify_many
+        """
+        return Transaction.verify_many((Transaction.from_json(transaction) for transaction in block["transactions"]), **kwargs)
+
     @classmethod
     def from_json(cls, json_data):
         if type(json_data) == str:
-            tx = ujson.loads(json_data)
+            json_data = ujson.loads(json_data)
         tx = json_data
-        return cls(tx["id"], tx["type"], tx["data"]["inputs"], tx["data"]["outputs"], tx["hash"])
+        tx_obj = cls(tx["id"], tx["type"], tx["data"]["inputs"], tx["data"]["outputs"], tx["hash"])
+        #serialize the node json while it is at hand, cheaper than rebuilding it from the slots later
+        tx_obj.data._json = ujson.dumps(tx["data"])
+        return tx_obj
 
     def serialize(self):
-        return {'transaction_id': self.id, 'hash': self.hash,'type': self.type ,'data': ujson.dumps(self.data), 'confirmed': self.confirmed}
+        return {'transaction_id': self.id, 'hash': self.hash,'type': self.type ,'data': self.data.json, 'confirmed': self.confirmed}
 
-    def save(self):
-        SQL = 'insert into tx values(:transaction_id, :hash, :type, :data, :confirmed)'
-        CLIENT_CONFIG.db.exec(SQL, param=self.serialize(), commit=True)
+    def save(self, db = None):
+        """
+            Insert the transaction and a tx_input/tx_output row per input and output,
+            saving the same transaction again keeps the first rows and their created_at
+        """
+        db = db if db is not None else CLIENT_CONFIG.db
+        with db.transaction():
+            db.exec('insert or ignore into tx (transaction_id, hash, type, data, confirmed) values(:transaction_id, :hash, :type, :data, :confirmed)', param=self.serialize())
+            db.exec_many('insert or ignore into tx_input values(:transaction_id, :input_index, :source_transaction, :source_index, :address, :amount)',
+                ({'transaction_id': self.id, 'input_index': index, 'source_transaction': tx_input.get("transaction"), 'source_index': tx_input.get("index"),
+                    'address': tx_input.get("address"), 'amount': tx_input.get("amount")} for index, tx_input in enumerate(self.data.inputs)))
+            db.exec_many('insert or ignore into tx_output values(:transaction_id, :output_index, :address, :amount)',
+                ({'transaction_id': self.id, 'output_index': index, 'address': tx_output.get("address"), 'amount': tx_output.get("amount")}
+                    for index, tx_output in enumerate(self.data.outputs)))
         return self
 
     def calc_hash(self) -> str:
-        return CryptoUtil.hash(self.id + self.type + ujson.dumps(self.data))
+        #id and type are plain attributes, keep them in the cache key instead of hooking every assignment
+        key = (self.id, self.type)
+        if self._hash_cache is None or self._hash_cache[0] != key:
+            self._hash_cache = (key, CryptoUtil.hash(self.id + self.type + self.data.json))
+        return self._hash_cache[1]
 
     def confirm(self):
         self.hash = self.calc_hash()
-        return {'id': self.id, 'hash': self.hash, 'type': self.type, 'data': self.data}
+        return {'id': self.id, 'hash': self.hash, 'type': self.type, 'data': self.data.to_json()}
@@ -0,0 +1,259 @@
+import ujson
+
+from lib.cryptoUtil import CryptoUtil
+
+_MISSING = object()
+
+class TxItem():
+    """
+        Slotted input/output of a transaction. It behaves like the node json dict (item["amount"])
+        and tells the owning transaction to drop its cached json and hash when it is modified.
+        Fields are serialized in the order the node and this client write them, unknown fields
+        or a different key order from the node json are kept so the hash never changes
+    """
+    #a field the json did not have is an unset slot, cached values are unset until first used
+    __slots__ = ('_extra', '_order', '_owner')
+    FIELDS = ()
+    #key orders serialized without remembering them
+    CANONICAL = ()
+
+    def __init__(self, data: dict, owner=None) -> None:
+        setattr_ = object.__setattr__
+        setattr_(self, '_owner', owner)
+        keys = tuple(data)
+        if keys in self.CANONICAL:
+            for key in keys:
+                setattr_(self, key, data[key])
+            return
+        extra = {}
+        for key in keys:
+            if key in self.FIELDS:
+                setattr_(self, key, data[key])
+            else:
+                extra[key] = data[key]
+        setattr_(self, '_order', keys)
+        if extra:
+            setattr_(self, '_extra', extra)
+
+    @classmethod
+    def from_json(cls, data):
+        return data if isinstance(data, cls) else cls(data)
+
+    def _changed(self):
+        if self._owner is not None:
+            self._owner._invalidate()
+
+    def _add_key(self, key):
+        order = getattr(self, '_order', None)
+        if order is not None and key not in order:
+            object.__setattr__(self, '_order', order + (key,))
+
+    def __setattr__(self, name, value):
+        if name in self.FIELDS:
+            self._add_key(name)
+            object.__setattr__(self, name, value)
+            self._changed()
+        else:
+            object.__setattr__(self, name, value)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return getattr(self, '_extra', {})[key]
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+            return
+        if getattr(self, '_order', None) is None:
+            #from now on the order of the keys must be remembered
+            object.__setattr__(self, '_order', tuple(self.keys()))
+        self._add_key(key)
+        if getattr(self, '_extra', None) is None:
+            object.__setattr__(self, '_extra', {})
+        self._extra[key] = value
+        self._changed()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.FIELDS:
+            object.__delattr__(self, key)
+        else:
+            del self._extra[key]
+        order = getattr(self, '_order', None)
+        if order is not None:
+            object.__setattr__(self, '_order', tuple(k for k in order if k != key))
+        self._changed()
+
+    def __contains__(self, key):
+        if key in self.FIELDS:
+            return hasattr(self, key)
+        return key in getattr(self, '_extra', ())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        order = getattr(self, '_order', None)
+        if order is not None:
+            return list(order)
+        return [field for field in self.FIELDS if hasattr(self, field)]
+
+    def to_json(self) -> dict:
+        if getattr(self, '_order', None) is None:
+            try:
+                return {field: getattr(self, field) for field in self.FIELDS}
+            except AttributeError:
+                values = ((field, getattr(self, field, _MISSING)) for field in self.FIELDS)
+                return {field: value for field, value in values if value is not _MISSING}
+        return {key: self[key] for key in self._order}
+
+    @property
+    def json(self) -> str:
+        return ujson.dumps(self.to_json())
+
+    def __eq__(self, other):
+        if isinstance(other, TxItem):
+            other = other.to_json()
+        if isinstance(other, dict):
+            return self.to_json() == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return '{}({})'.format(type(self).__name__, self.json)
+
+class TxInput(TxItem):
+    __slots__ = ('transaction', 'index', 'amount', 'address', 'signature', '_input_hash')
+    FIELDS = ('transaction', 'index', 'amount', 'address', 'signature')
+    CANONICAL = (FIELDS, FIELDS[:-1])
+
+    def _changed(self):
+        object.__setattr__(self, '_input_hash', None)
+        super(TxInput, self)._changed()
+
+    @property
+    def input_hash(self) -> str:
+        """
+            Hash signed by the owner of the spent output
+        """
+        cached = getattr(self, '_input_hash', None)
+        if cached is None:
+            cached = CryptoUtil.hash(ujson.dumps({
+                'transaction': self.transaction,
+                'index': self.index,
+                'address': self.address
+            }))
+            object.__setattr__(self, '_input_hash', cached)
+        return cached
+
+class TxOutput(TxItem):
+    __slots__ = ('amount', 'address')
+    FIELDS = ('amount', 'address')
+    CANONICAL = (FIELDS,)
+
+class TxItemList(list):
+    """
+        List of inputs or outputs, items added are converted to the slotted model and owned by the transaction
+    """
+    __slots__ = ('_owner', '_item_cls')
+
+    def __init__(self, owner, item_cls, items=()) -> None:
+        self._owner = owner
+        self._item_cls = item_cls
+        super(TxItemList, self).__init__(map(self._adopt, items))
+
+    def _adopt(self, item):
+        if type(item) is not self._item_cls:
+            return self._item_cls(item, self._owner)
+        if item._owner is not None and item._owner is not self._owner:
+            #an item belongs to one transaction, a copy keeps the cache of the other one valid
+            return self._item_cls(item.to_json(), self._owner)
+        object.__setattr__(item, '_owner', self._owner)
+        return item
+
+    def _changed(self):
+        if self._owner is not None:
+            self._owner._invalidate()
+
+    def append(self, item):
+        super(TxItemList, self).append(self._adopt(item))
+        self._changed()
+
+    def extend(self, items):
+        super(TxItemList, self).extend(map(self._adopt, items))
+        self._changed()
+
+    def insert(self, index, item):
+        super(TxItemList, self).insert(index, self._adopt(item))
+        self._changed()
+
+    def __setitem__(self, index, item):
+        if isinstance(index, slice):
+            super(TxItemList, self).__setitem__(index, [self._adopt(i) for i in item])
+        else:
+            super(TxItemList, self).__setitem__(index, self._adopt(item))
+        self._changed()
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def _mutator(name):
+        def mutate(self, *args, **kwargs):
+            result = getattr(super(TxItemList, self), name)(*args, **kwargs)
+            self._changed()
+            return result
+        mutate.__name__ = name
+        return mutate
+
+    __delitem__ = _mutator('__delitem__')
+    pop = _mutator('pop')
+    remove = _mutator('remove')
+    clear = _mutator('clear')
+    sort = _mutator('sort')
+    reverse = _mutator('reverse')
+    __imul__ = _mutator('__imul__')
+    del _mutator
+
+    def to_json(self) -> list:
+        return [item.to_json() for item in self]
+
+class TxData():
+    """
+        inputs and outputs of a transaction, data["inputs"] works like on the node json
+    """
+    __slots__ = ('inputs', 'outputs', '_json')
+
+    def __init__(self, owner, inputs=(), outputs=()) -> None:
+        self.inputs = TxItemList(owner, TxInput, inputs)
+        self.outputs = TxItemList(owner, TxOutput, outputs)
+        self._json = None
+
+    def __getitem__(self, key) -> TxItemList:
+        if key not in ('inputs', 'outputs'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, items):
+        current = self[key]
+        setattr(self, key, TxItemList(current._owner, current._item_cls, items))
+        current._changed()
+
+    def keys(self):
+        return ['inputs', 'outputs']
+
+    def to_json(self) -> dict:
+        return {'inputs': self.inputs.to_json(), 'outputs': self.outputs.to_json()}
+
+    @property
+    def json(self) -> str:
+        """
+            Same string as ujson.dumps of the node json data, cached until an input or output changes
+        """
+        if self._json is None:
+            self._json = ujson.dumps(self.to_json())
+        return self._json
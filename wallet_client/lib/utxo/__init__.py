@@ -0,0 +1,84 @@
+from lib.config import CLIENT_CONFIG
+from lib.config.log import Logger
+from lib.watch import AddressFilter, WatchedAddresses, watched_addresses
+
+class UtxoIndex():
+    """
+        Local unspent output table of the wallet addresses, kept up to date from the blocks the updater ingests.
+        Rows of an address are only trusted once the address has been reconciled against the node,
+        inputs of our own transactions are marked spent as soon as the node accepts them.
+    """
+    def __init__(self, db = None) -> None:
+        self.db = db if db is not None else CLIENT_CONFIG.db
+
+    def watch(self, addresses):
+        addresses = list(addresses)
+        self.db.exec_many('insert or ignore into utxo_address values(:address, 0)', ({'address': address} for address in addresses))
+        watched_addresses(self.db, sync=False).update(addresses)
+
+    @property
+    def watched_addresses(self) -> WatchedAddresses:
+        #shared by the process, only the addresses added since the last block are read
+        return watched_addresses(self.db)
+
+    def is_synced(self, address) -> bool:
+        row = self.db.fetch_one('select synced from utxo_address where address=:address', {'address': address})
+        return row is not None and bool(row["synced"])
+
+    def invalidate(self):
+        """
+            Force every address to be reconciled again, used when blocks were not ingested
+        """
+        self.db.exec('update utxo_address set synced=0', commit=True)
+
+    def reconcile(self, address, node_unspent = None):
+        """
+            Replace the local outputs of address with the unspent list of the node
+        """
+        if node_unspent is None:
+            from lib.api import NaiveCoinApi
+            node_unspent = NaiveCoinApi.get_unspent_transaction_for_address(address)
+        with self.db.transaction():
+            self.db.exec('delete from utxo where address=:address', {'address': address})
+            self.db.exec_many('insert or replace into utxo values(:transaction, :index, :address, :amount, 0)',
+                ({'transaction': tx["transaction"], 'index': int(tx["index"]), 'address': tx["address"], 'amount': tx["amount"]} for tx in node_unspent))
+            self.db.exec('insert or replace into utxo_address values(:address, 1)', {'address': address})
+        Logger.info('Unspent outputs of %s reconciled with node, %s output(s)', address, len(node_unspent))
+
+    def add_outputs(self, transactions, addresses: AddressFilter):
+        rows = [{'transaction': transaction["id"], 'index': index, 'address': output["address"], 'amount': output["amount"]}
+            for transaction, index, output in addresses.match_outputs(transactions)]
+        self.db.exec_many('insert or ignore into utxo values(:transaction, :index, :address, :amount, 0)', rows)
+
+    def ingest_blocks(self, blocks):
+        """
+            Add the outputs paying a watched address and drop the outputs spent by the blocks
+        """
+        transactions = [transaction for block in blocks for transaction in block["transactions"]]
+        with self.db.transaction():
+            self.add_outputs(transactions, self.watched_addresses)
+            self.db.exec_many('delete from utxo where transaction_id=:transaction and output_index=:index',
+                ({'transaction': tx_input["transaction"], 'index': int(tx_input["index"])} for transaction in transactions for tx_input in transaction["data"]["inputs"]))
+
+    def apply_transaction(self, transaction):
+        """
+            Optimistically spend the inputs of a transaction accepted by the node and keep its outputs to our addresses
+            so they can be chained before the transaction is mined
+        """
+        with self.db.transaction():
+            self.db.exec_many('update utxo set spent=1 where transaction_id=:transaction and output_index=:index',
+                ({'transaction': tx_input["transaction"], 'index': int(tx_input["index"])} for tx_input in transaction["data"]["inputs"]))
+            self.add_outputs([transaction], self.watched_addresses)
+
+    def unspent(self, address) -> list:
+        """
+            Unspent outputs of address in the node format, the address is reconciled first if it never was
+        """
+        if not self.is_synced(address):
+            self.watch([address])
+            self.reconcile(address)
+        rows = self.db.fetch_all('select transaction_id, output_index, amount, address from utxo where address=:address and spent=0', {'address': address})
+        return [{'transaction': row["transaction_id"], 'index': row["output_index"], 'amount': row["amount"], 'address': row["address"]} for row in rows]
+
+    def balance(self, address):
+        return sum(tx["amount"] for tx in self.unspent(address))
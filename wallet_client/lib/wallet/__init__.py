@@ -1,48 +1,167 @@
+import asyncio
 import binascii
+import csv
+import itertools
+import logging
+import requests
 import ujson
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 from lib.api import NaiveCoinApi
-from lib.config import FEE_PER_TRANSACTION, CLIENT_CONFIG
+from lib.api.aio import AsyncNaiveCoinApi
+from lib.config import CURRENT_NODE, FEE_PER_TRANSACTION, COIN_SELECTION, MAX_OUTPUTS_PER_TRANSACTION, CLIENT_CONFIG
+from lib.config import DEFAULT_DERIVATION, DERIVED_KEY_CACHE_SIZE, GAP_LIMIT, RESTORE_WORKERS, KEY_PAGE_SIZE
 from lib.config.log import Logger
-from lib.api.exception import WalletLinkException
-from lib.transaction import TRANSACTION_TYPE_REGULAR, Transaction
+from lib.metrics import METRICS
+from lib.api.exception import WalletLinkException, TransactionRequestException
+from lib.transaction import TRANSACTION_TYPE_REGULAR, Transaction, TxInput
+from lib.utxo import UtxoIndex
+from lib.balance import BalanceCache
+from lib.watch import watched_addresses
 from lib.wallet.exception import WalletException
+from lib.wallet.selection import get_coin_selection
 from lib.cryptoUtil import Ed25519Util, CryptoUtil
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.serialization import Encoding, PrivateFormat, PublicFormat
 
+#key N is derived from the private key N-1, wallets created before index derivation
+DERIVATION_CHAIN = 'chain'
+#key N only depends on the wallet secret and N
+DERIVATION_INDEX = 'index'
+
+SIGNED_INPUTS = METRICS.counter('wallet_signed_inputs_total', 'Transaction inputs signed')
+
 class Wallet():
-    def __init__(self, id, password_hash, secret, key_pairs) -> None:
+    def __init__(self, id, password_hash, secret, key_pairs, derivation=DERIVATION_CHAIN) -> None:
         self.id = id
         self.password_hash = password_hash
         self.secret = secret
-        self.key_pairs = key_pairs
+        self._saved = False
+        self.key_pairs = key_pairs #None loads the key pairs of a saved wallet lazily from wallet_key
+        self.derivation = derivation
+        self.derived_keys = OrderedDict()
+
+    @property
+    def key_pairs(self) -> list:
+        if self._key_pairs is None:
+            saved_key_pairs = list(self.iter_key_pairs())
+            self._key_pairs = saved_key_pairs + self._new_key_pairs
+            self._key_index.update((p["publicKey"], p) for p in saved_key_pairs)
+        return self._key_pairs
+
+    @key_pairs.setter
+    def key_pairs(self, key_pairs):
+        #public key -> key pair, and public key -> parsed private key filled on first signature
+        self._key_index = {}
+        self._signing_keys = {}
+        self._addresses = None
+        #key pairs not in wallet_key yet
+        self._new_key_pairs = []
+        if key_pairs is None:
+            self._key_pairs = None
+            row = CLIENT_CONFIG.db.fetch_one('select max(idx) from wallet_key where wallet_id=:wallet_id', {'wallet_id': self.id})
+            self._key_count = 0 if row[0] is None else row[0] + 1
+        else:
+            self._key_pairs = []
+            self._key_count = 0
+            for key_pair in key_pairs:
+                self._add_key_pair(key_pair)
+
+    def _add_key_pair(self, key_pair):
+        if self._key_pairs is not None:
+            self._key_pairs.append(key_pair)
+        self._new_key_pairs.append(key_pair)
+        self._key_index[key_pair["publicKey"]] = key_pair
+        self._key_count += 1
+        self._addresses = None
+        #blocks scanned in this process match the address before the wallet is saved
+        watched_addresses(CLIENT_CONFIG.db, sync=False).add(key_pair["publicKey"])
+
+    def iter_key_pairs(self, page_size=KEY_PAGE_SIZE):
+        """
+            Key pairs saved in wallet_key, read page_size rows at a time
+        """
+        last_idx = -1
+        while True:
+            rows = CLIENT_CONFIG.db.fetch_all('select idx, public_key, private_key from wallet_key where wallet_id=:wallet_id and idx>:idx order by idx limit :limit',
+                {'wallet_id': self.id, 'idx': last_idx, 'limit': page_size})
+            for row in rows:
+                yield Wallet.make_key_pair(row["idx"], row["private_key"], row["public_key"])
+            if len(rows) < page_size:
+                return
+            last_idx = rows[-1]["idx"]
 
     def serialize(self) -> dict:
-        return {'wallet_id': self.id, 'password_hash': self.password_hash, 'secret': self.secret, 'key_pair': ujson.dumps(self.key_pairs)}
+        return {'wallet_id': self.id, 'password_hash': self.password_hash, 'secret': self.secret, 'derivation': self.derivation}
         
     def save(self):
-        #before save new wallet we have to check our local db already been save
-        sql_param = {}
-        current_wallet = CLIENT_CONFIG.db.fetch_one('select * from wallet where password_hash=:password_hash', param={'password_hash': self.password_hash})
-        if current_wallet == None:
-            SQL = 'insert into wallet values(:wallet_id,:password_hash,:secret,:key_pair)'
-            sql_param = self.serialize()
-        else:
-            #we just append the old key pair with the new one
-            SQL = 'update wallet set key_pair=:key_pair where password_hash=:password_hash'
-            sql_param = {'key_pair': ujson.dumps(self.key_pairs), 'password_hash': self.password_hash }
-        CLIENT_CONFIG.db.exec(SQL, sql_param, commit=True)
-    
+        """
+            Insert the wallet the first time, then only the key pairs added since the last save.
+            A wallet of a password already stored becomes that wallet: its id and derivation are kept,
+            stored keys are never replaced and the key pairs are reloaded from wallet_key
+        """
+        adopted = False
+        with CLIENT_CONFIG.db.transaction():
+            if not self._saved:
+                #before save new wallet we have to check our local db already been save
+                current_wallet = CLIENT_CONFIG.db.fetch_one('select wallet_id, secret, derivation from wallet where password_hash=:password_hash', param={'password_hash': self.password_hash})
+                if current_wallet == None:
+                    SQL = 'insert into wallet (wallet_id, password_hash, secret, derivation) values(:wallet_id,:password_hash,:secret,:derivation)'
+                    CLIENT_CONFIG.db.exec(SQL, self.serialize(), commit=True)
+                else:
+                    self.id = current_wallet["wallet_id"]
+                    adopted = True
+                    if current_wallet["derivation"] != self.derivation:
+                        #keys of another derivation are not the stored ones, the stored wallet is kept as it is
+                        Logger.warning('Wallet %s uses %s derivation, %s key pair(s) of %s derivation dropped',
+                            self.id, current_wallet["derivation"], len(self._new_key_pairs), self.derivation)
+                        self.derivation = current_wallet["derivation"]
+                        self.secret = current_wallet["secret"]
+                        self._new_key_pairs = []
+            if self._new_key_pairs:
+                self.insert_key_pairs(self._new_key_pairs)
+            self._saved = True
+        self._new_key_pairs = []
+        if adopted:
+            self.key_pairs = None
+
+    def insert_key_pairs(self, key_pairs):
+        """
+            Insert the key pairs whose index is not stored yet, a stored key is never replaced.
+            Keys are derived from the password so a stored index must hold the same public key
+        """
+        stored = {row["idx"]: row["public_key"] for row in CLIENT_CONFIG.db.fetch_all('select idx, public_key from wallet_key where wallet_id=:wallet_id and idx>=:idx',
+            {'wallet_id': self.id, 'idx': min(p["index"] for p in key_pairs) - 1})}
+        for p in key_pairs:
+            if stored.get(p["index"] - 1, p["publicKey"]) != p["publicKey"]:
+                raise WalletException("Key {} of wallet {} does not match the stored key".format(p["index"] - 1, self.id))
+        key_pairs = [p for p in key_pairs if p["index"] - 1 not in stored]
+        CLIENT_CONFIG.db.exec_many('insert into wallet_key values(:wallet_id, :idx, :public_key, :private_key)',
+            ({'wallet_id': self.id, 'idx': p["index"] - 1, 'public_key': p["publicKey"], 'private_key': p["privateKey"]} for p in key_pairs))
+        #the updater only keeps outputs of watched addresses in the local utxo table
+        UtxoIndex().watch(p["publicKey"] for p in key_pairs)
+
+    def wipe(self):
+        """
+            Drop the secret, the key pairs and the parsed signing keys so the wallet can no longer sign,
+            e.g. when it leaves the cache of unlocked wallets. Python strings can not be overwritten,
+            the key material is freed once no other reference holds it
+        """
+        self.secret = None
+        self.password_hash = None
+        #an empty list, not None, so nothing is loaded from wallet_key again
+        self.key_pairs = []
+        self.derived_keys.clear()
+
     def sign_verification_data(self, verf_data):
         verf_data_copy = verf_data.copy()
         for v_data in verf_data_copy:
-            _priv_key = self.get_secret_key_by_address(v_data["address"])
+            _priv_key = self.get_signing_key(v_data["address"])
             if _priv_key is not None:
-                v_data["signature"] = Ed25519Util.sign_hash(
-                    Ed25519PrivateKey.from_private_bytes(binascii.unhexlify(_priv_key)), 
-                    CryptoUtil.hash(v_data["data"])).hex()
+                v_data["signature"] = Ed25519Util.sign_hash(_priv_key, CryptoUtil.hash(v_data["data"])).hex()
             else:
                 Logger.error("Private key for address {} not found".format(v_data["address"]))
                 raise WalletLinkException("Wallet link verification failed")
@@ -51,42 +170,148 @@ class Wallet():
     @classmethod
     def load_wallet_from_password(cls, password: str):
         password_hash = CryptoUtil.hash(password)
-        current_wallet = CLIENT_CONFIG.db.fetch_one('select * from wallet where password_hash=:password_hash', param={'password_hash': password_hash})
+        current_wallet = CLIENT_CONFIG.db.fetch_one('select wallet_id, password_hash, secret, derivation from wallet where password_hash=:password_hash', param={'password_hash': password_hash})
         if current_wallet == None:
             raise WalletException("Wallet not found from local storage")
-        return cls(current_wallet["wallet_id"], current_wallet["password_hash"], current_wallet["secret"], ujson.loads(current_wallet["key_pair"]))
+        wallet = cls(current_wallet["wallet_id"], current_wallet["password_hash"], current_wallet["secret"], None, current_wallet["derivation"])
+        wallet._saved = True
+        return wallet
 
     @classmethod 
-    def from_password(cls, password):
-        return cls(CryptoUtil.random_id(), CryptoUtil.hash(password), '', [])
-        
+    def from_password(cls, password, derivation=DEFAULT_DERIVATION):
+        return cls(CryptoUtil.random_id(), CryptoUtil.hash(password), '', [], derivation)
+
+    @staticmethod
+    def used_addresses(addresses) -> set:
+        """
+            Addresses of the local history: in an input or output of a saved transaction or with a local unspent output
+        """
+        rows = CLIENT_CONFIG.db.fetch_all('select address from tx_output where address in (select value from json_each(:addresses))'
+            ' union select address from tx_input where address in (select value from json_each(:addresses))'
+            ' union select address from utxo where address in (select value from json_each(:addresses))', {'addresses': ujson.dumps(list(addresses))})
+        return set(row["address"] for row in rows)
+
+    @classmethod
+    def restore_from_password(cls, password, gap_limit=GAP_LIMIT, max_workers=RESTORE_WORKERS, node=CURRENT_NODE):
+        """
+            Rebuild an index derivation wallet from its password, addresses are derived gap_limit at a time in a process pool
+            until gap_limit addresses in a row are unused. An address is used when the local history has it (a spent out address
+            keeps its transactions) or the node gives it a balance, the node has no history by address.
+            The node answers 404 for an address without outputs, it is unused. Any other error (transport, 5xx, garbage body)
+            raises a WalletException instead of ending the scan early
+        """
+        wallet = cls.from_password(password, DERIVATION_INDEX)
+        wallet.secret = Ed25519Util.generate_secret(wallet.password_hash)
+
+        async def get_balances(addresses):
+            async with AsyncNaiveCoinApi(node) as api:
+                return await api.get_addresses_balance(addresses)
+
+        key_pairs = []
+        last_used = 0
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while len(key_pairs) - last_used < gap_limit:
+                start = len(key_pairs)
+                window = list(executor.map(Ed25519Util.generate_key_pair_at, itertools.repeat(wallet.secret, gap_limit), range(start, start + gap_limit)))
+                addresses = [pub for _, pub in window]
+                balances = asyncio.run(get_balances(addresses))
+                used = cls.used_addresses(addresses)
+                for index, (priv, pub) in enumerate(window, start):
+                    key_pairs.append(Wallet.make_key_pair(index, priv, pub))
+                    result = balances[pub]
+                    if not result.ok:
+                        raise WalletException("Balance of address {} not read during restore: {}".format(pub, result.error or result.value))
+                    if pub in used or result.value["balance"] > 0:
+                        last_used = index + 1
+        #keep every address up to the last used one, and at least the first address
+        wallet.key_pairs = key_pairs[:max(last_used, 1)]
+        Logger.info("Wallet restored with %s address(es)", len(wallet.key_pairs))
+        return wallet
+
     def get_secret_key_by_address(self, address):
-        for p in self.key_pairs:
-            if p["publicKey"] == address:
-                return p["privateKey"]
+        key_pair = self._key_index.get(address)
+        if key_pair is None and self._key_pairs is None:
+            #key pairs not loaded yet, look the single key up by the public key index
+            row = CLIENT_CONFIG.db.fetch_one('select idx, public_key, private_key from wallet_key where wallet_id=:wallet_id and public_key=:public_key',
+                {'wallet_id': self.id, 'public_key': address})
+            if row is not None:
+                key_pair = self._key_index[address] = Wallet.make_key_pair(row["idx"], row["private_key"], row["public_key"])
+        if key_pair is not None:
+            return key_pair["privateKey"]
+
+    def get_signing_key(self, address) -> Ed25519PrivateKey:
+        """
+            Parsed private key of address, None if the address is not in the wallet
+        """
+        signing_key = self._signing_keys.get(address)
+        if signing_key is None:
+            secret_key = self.get_secret_key_by_address(address)
+            if secret_key is None:
+                return None
+            signing_key = self._signing_keys[address] = Ed25519PrivateKey.from_private_bytes(binascii.unhexlify(secret_key))
+        return signing_key
 
     @property
-    def addresses(self):
-        return list(p["publicKey"] for p in self.key_pairs)        
+    def addresses(self) -> tuple:
+        #rebuilt only after a new key pair is added
+        if self._addresses is None:
+            self._addresses = tuple(p["publicKey"] for p in self.key_pairs)
+        return self._addresses
+
+    def get_key_pair_at(self, index) -> dict:
+        if self._key_pairs is not None:
+            return self._key_pairs[index]
+        if index >= self._key_count - len(self._new_key_pairs):
+            return self._new_key_pairs[index - self._key_count]
+        row = CLIENT_CONFIG.db.fetch_one('select idx, public_key, private_key from wallet_key where wallet_id=:wallet_id and idx=:idx', {'wallet_id': self.id, 'idx': index})
+        return Wallet.make_key_pair(row["idx"], row["private_key"], row["public_key"])
+
+    @staticmethod
+    def make_key_pair(index, priv, pub) -> dict:
+        return {
+                'index': index + 1,
+                'publicKey': pub,
+                'privateKey': priv
+            }
+
+    def derive_key_pair(self, index) -> dict:
+        """
+            Key pair at index of an index derivation wallet, derived keys are kept in a bounded cache
+        """
+        if self.derivation != DERIVATION_INDEX:
+            raise WalletException("Random access derivation needs an index derivation wallet")
+        if self.secret == None or self.secret == '':
+            self.secret = Ed25519Util.generate_secret(self.password_hash)
+        if index in self.derived_keys:
+            self.derived_keys.move_to_end(index)
+        else:
+            priv, pub = Ed25519Util.generate_key_pair_at(self.secret, index)
+            self.derived_keys[index] = Wallet.make_key_pair(index, priv, pub)
+            if len(self.derived_keys) > DERIVED_KEY_CACHE_SIZE:
+                self.derived_keys.popitem(last=False)
+        return self.derived_keys[index]
 
     def generate_address(self):
+        if self.derivation == DERIVATION_INDEX:
+            newPair = self.derive_key_pair(self._key_count)
+            self._add_key_pair(newPair)
+            return newPair["publicKey"]
+
         if self.secret == None or self.secret == '':
             self.secret = Ed25519Util.generate_secret(self.password_hash)
         #check if wallet already has previous key or else we take the last private key as the seed to generate new address 
-        if not self.key_pairs:
+        if self._key_count == 0:
             priv, pub = Ed25519Util.generate_key_pair_from_secret(self.secret)
         else:
-            last_key_pair = self.key_pairs[-1]
+            last_key_pair = self.get_key_pair_at(self._key_count - 1)
             seed = Ed25519Util.generate_secret(last_key_pair["privateKey"])
             priv, pub = Ed25519Util.generate_key_pair_from_secret(seed)
 
-        newPair = {
-                'index': len(self.key_pairs) + 1,
-                'publicKey': pub.public_bytes(Encoding.Raw, PublicFormat.Raw).hex(),
-                'privateKey': priv.private_bytes(Encoding.Raw, PrivateFormat.Raw, serialization.NoEncryption()).hex()
-            }
+        newPair = Wallet.make_key_pair(self._key_count,
+            priv.private_bytes(Encoding.Raw, PrivateFormat.Raw, serialization.NoEncryption()).hex(),
+            pub.public_bytes(Encoding.Raw, PublicFormat.Raw).hex())
 
-        self.key_pairs.append(newPair)
+        self._add_key_pair(newPair)
         return newPair["publicKey"]
 
     @staticmethod
@@ -96,54 +321,160 @@ class Wallet():
             amount+=tx['amount']
         return amount
 
+    @METRICS.timed('wallet_sign_per_uxto_seconds', 'Time to sign every input of a transaction')
     def sign_per_uxto(self, utxo, secret_key):
-        utxo_copy = utxo.copy()
-        for tx in utxo_copy:
-            txInputHash = CryptoUtil.hash(ujson.dumps({
-                'transaction': tx["transaction"],
-                'index': tx["index"],
-                'address': tx["address"]
-            }))
-            tx['signature'] = Ed25519Util.sign_hash(secret_key, txInputHash).hex()
-        Logger.debug("Uxto signed: {}".format(ujson.dumps(utxo_copy)))
-        return utxo_copy
-
-    def send(self, to_address, from_address, amount) -> Transaction:
-        uxto = NaiveCoinApi.get_unspent_transaction_for_address(from_address) #get remain output transaction from blockchain
-        signed_transaction = self.sign_and_create_transaction(uxto, to_address, from_address, amount, FEE_PER_TRANSACTION)
+        signed = []
+        for tx in utxo:
+            tx_input = TxInput(tx) #a copy, the caller's unspent outputs are not modified
+            tx_input.signature = Ed25519Util.sign_hash(secret_key, tx_input.input_hash).hex()
+            signed.append(tx_input)
+        SIGNED_INPUTS.inc(len(signed))
+        #dumping every input is costly, only do it when it is logged
+        if Logger.isEnabledFor(logging.DEBUG):
+            Logger.debug("Uxto signed: %s", ujson.dumps([tx_input.to_json() for tx_input in signed]))
+        return signed
+
+    def reconcile_uxto(self):
+        """
+            Resync the local unspent outputs of every address with the node
+        """
+        utxo_index = UtxoIndex()
+        for address in self.addresses:
+            utxo_index.reconcile(address)
+
+    def balances(self, latest_block=None, node=None) -> dict:
+        """
+            Total and per address balance of the wallet at the chain tip, see BalanceCache.balances
+        """
+        return BalanceCache().balances(self.addresses, latest_block, node)
+
+    def send(self, to_address, from_address, amount, selection=COIN_SELECTION) -> Transaction:
+        utxo_index = UtxoIndex()
+        uxto = utxo_index.unspent(from_address) #get remain output transaction from local utxo table
+        signed_transaction = self.sign_and_create_transaction(uxto, to_address, from_address, amount, FEE_PER_TRANSACTION, selection=selection)
         transaction_created = NaiveCoinApi.send_transaction(signed_transaction)
+        utxo_index.apply_transaction(transaction_created)
+        BalanceCache().apply_transaction(transaction_created)
         return Transaction.from_json(transaction_created)
 
-    def sign_and_create_transaction(self, uxto, to_address, from_address, amount, fee, change_address='') -> dict:
-        secret_key = self.get_secret_key_by_address(from_address)
-        ed25519_secret_key_obj = Ed25519PrivateKey.from_private_bytes(binascii.unhexlify(secret_key))
+    @staticmethod
+    def read_payments(path):
+        """
+            Stream (address, amount) pairs from a csv file (address,amount per line, an optional header)
+            or a jsonl file ({"address": ..., "amount": ...} per line).
+            A malformed line raises a ValueError with its line number
+        """
+        with open(path, newline='') as payment_file:
+            if path.endswith('.jsonl'):
+                for line_number, line in enumerate(payment_file, 1):
+                    if line.strip():
+                        payment = ujson.loads(line)
+                        if not isinstance(payment, dict):
+                            raise ValueError('Line {}: expected an object, got {}'.format(line_number, line.strip()))
+                        yield payment["address"], payment["amount"]
+            else:
+                for line_number, row in enumerate(csv.reader(payment_file), 1):
+                    if not row or row[0] == 'address':
+                        continue
+                    if len(row) != 2:
+                        raise ValueError('Line {}: expected address,amount, got {} column(s)'.format(line_number, len(row)))
+                    yield row[0].strip(), float(row[1])
+
+    def send_many(self, payments, from_address, selection=COIN_SELECTION, max_outputs=MAX_OUTPUTS_PER_TRANSACTION):
+        """
+            Pay every (address, amount) of payments from from_address, packing up to max_outputs payments per transaction.
+            payments is consumed lazily so it can stream from read_payments.
+            Return the transactions created and a result per recipient with the transaction id or the error.
+            A node error fails its batch only, the transactions sent are always returned so the caller saves them
+        """
+        utxo_index = UtxoIndex()
+        transactions = []
+        results = []
+        payments = iter(payments)
+        stopped = None
+        while True:
+            try:
+                chunk = list(itertools.islice(payments, max_outputs))
+            except (ValueError, KeyError) as ex:
+                #a malformed line of a payment file ends the payments, the transactions already sent are still returned
+                Logger.error("Failed to read payments after {} transaction(s) Error: {}".format(len(transactions), ex))
+                results.append({'address': None, 'amount': None, 'transaction_id': None, 'error': 'Invalid payment: {}'.format(ex)})
+                break
+            if not chunk:
+                break
+            if stopped is not None:
+                results.extend({'address': to_address, 'amount': amount, 'transaction_id': None, 'error': 'Not sent: {}'.format(stopped)} for to_address, amount in chunk)
+                continue
+            batch = []
+            for to_address, amount in chunk:
+                if not to_address or amount <= 0:
+                    results.append({'address': to_address, 'amount': amount, 'transaction_id': None, 'error': 'Invalid payment'})
+                else:
+                    batch.append((to_address, amount))
+            if not batch:
+                continue
+            try:
+                uxto = utxo_index.unspent(from_address)
+                signed_transaction = self.sign_and_create_payment(uxto, batch, from_address, FEE_PER_TRANSACTION, selection=selection)
+                transaction_created = NaiveCoinApi.send_transaction(signed_transaction)
+                #the change output is spendable right away by the next batch
+                utxo_index.apply_transaction(transaction_created)
+                BalanceCache().apply_transaction(transaction_created)
+                transaction = Transaction.from_json(transaction_created)
+                transactions.append(transaction)
+                results.extend({'address': to_address, 'amount': amount, 'transaction_id': transaction.id, 'error': None} for to_address, amount in batch)
+            except (WalletException, TransactionRequestException, requests.exceptions.RequestException, ValueError) as ex:
+                #a node error only fails this batch, the transactions already sent are still returned to be saved
+                Logger.error("Failed to pay {} recipient(s) Error: {}".format(len(batch), ex))
+                results.extend({'address': to_address, 'amount': amount, 'transaction_id': None, 'error': str(ex)} for to_address, amount in batch)
+            except Exception as ex:
+                #anything else stops the payments, the transactions already sent are returned all the same
+                Logger.error("Stopped paying recipients after {} transaction(s) Error: {}".format(len(transactions), ex))
+                results.extend({'address': to_address, 'amount': amount, 'transaction_id': None, 'error': str(ex)} for to_address, amount in batch)
+                stopped = ex
+        return transactions, results
+
+    def sign_and_create_transaction(self, uxto, to_address, from_address, amount, fee, change_address='', selection=COIN_SELECTION) -> dict:
+        if not to_address:
+            raise WalletException("Transation infomation missing")
+        return self.sign_and_create_payment(uxto, [(to_address, amount)], from_address, fee, change_address, selection)
+
+    def sign_and_create_payment(self, uxto, payments, from_address, fee, change_address='', selection=COIN_SELECTION) -> dict:
+        """
+            Create and sign one transaction with an output per (address, amount) of payments plus the change output
+        """
+        ed25519_secret_key_obj = self.get_signing_key(from_address)
         
-        if not secret_key:
+        if not ed25519_secret_key_obj:
             raise WalletException("Key for address not found") 
-        if not to_address or not from_address:
+        if not payments or not from_address:
             raise WalletException("Transation infomation missing")
         if len(uxto) == 0:
             raise WalletException("Sender address unspent transaction empty")
         if change_address == '':
             change_address = from_address
 
+        amount = sum(payment_amount for _, payment_amount in payments)
+        #only the selected outputs are signed and sent, not every unspent output of the address
+        uxto = get_coin_selection(selection)(uxto, amount + fee)
         totalAmount = Wallet.get_total_amount_from_uxto(uxto)
         changeAmount = totalAmount - amount - fee
         input_tx = self.sign_per_uxto(uxto, ed25519_secret_key_obj)
         output_tx = []
 
-        output_tx.append({
-            'amount': amount,
-            'address': to_address
-        })
+        for to_address, payment_amount in payments:
+            output_tx.append({
+                'amount': payment_amount,
+                'address': to_address
+            })
 
         if(changeAmount > 0):
             output_tx.append({
                 'amount': changeAmount,
                 'address': change_address
             })
-        else:
+        elif(changeAmount < 0):
             raise WalletException("Sender does not have enough to pay for the transaction")
         
         tx = Transaction(CryptoUtil.random_id(), TRANSACTION_TYPE_REGULAR, input_tx, output_tx)
-        return tx.confirm()
\ No newline at end of file
+        return tx.confirm()
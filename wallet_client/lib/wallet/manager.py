@@ -0,0 +1,201 @@
+import threading
+import time
+import weakref
+
+from collections import OrderedDict
+
+from lib.config import WALLET_CACHE_SIZE, WALLET_CACHE_TTL
+from lib.config.log import Logger
+from lib.cryptoUtil import CryptoUtil
+from lib.metrics import METRICS
+from lib.wallet import Wallet
+
+CACHE_HITS = METRICS.counter('wallet_cache_hits_total', 'Unlocked wallets found in the cache')
+CACHE_MISSES = METRICS.counter('wallet_cache_misses_total', 'Wallets not in the cache, loaded from the database or locked')
+#reason is size, expired or locked
+CACHE_EVICTIONS = {reason: METRICS.counter('wallet_cache_evictions_total', 'Wallets removed from the cache', reason=reason)
+    for reason in ('size', 'expired', 'locked')}
+
+class WalletManager():
+    """
+        Unlocked wallets by id, at most size of them and each one ttl seconds after its last use, least recently used first out.
+        Key pairs are saved as soon as they are added. A wallet leaving the cache is saved and wiped
+        under its wallet lock, so a call still using it finishes first
+    """
+    def __init__(self, size=WALLET_CACHE_SIZE, ttl=WALLET_CACHE_TTL, clock=time.monotonic) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        #wallet id -> [wallet, last use], least recently used first
+        self.entries = OrderedDict()
+        #password hash -> wallet id, so a login of a cached wallet skips the database
+        self.password_hashes = {}
+        #kept while a wallet is cached or a call holds it, a wallet loaded again while the previous one is wiped gets the same lock
+        self.locks = weakref.WeakValueDictionary()
+        #removed from the cache, not wiped yet
+        self.releasing = []
+        self.lock = threading.Lock()
+
+    def wallet_lock(self, wallet_id) -> threading.Lock:
+        """
+            Lock serialising the calls on wallet_id
+        """
+        with self.lock:
+            lock = self.locks.get(wallet_id)
+            if lock is None:
+                lock = self.locks[wallet_id] = threading.Lock()
+            return lock
+
+    def _pop(self, wallet_id):
+        wallet, _, _ = self.entries.pop(wallet_id)
+        if self.password_hashes.get(wallet.password_hash) == wallet_id:
+            del self.password_hashes[wallet.password_hash]
+        return wallet
+
+    def _expired(self, now) -> list:
+        expired = []
+        while self.entries:
+            wallet_id, (_, last_use, _) = next(iter(self.entries.items()))
+            if now - last_use < self.ttl:
+                break
+            expired.append(self._pop(wallet_id))
+        return expired
+
+    def _release(self, wallets, reason, wait=False):
+        for wallet in wallets:
+            CACHE_EVICTIONS[reason].inc()
+            Logger.debug('Wallet %s removed from the cache (%s)', wallet.id, reason)
+        with self.lock:
+            self.releasing.extend(wallets)
+        self.wipe_released(wait)
+
+    def wipe_released(self, wait=False):
+        """
+            Save and wipe the wallets removed from the cache. A wallet a call still holds is wiped by a later sweep
+            unless wait is True, so an access never waits for a call on another wallet
+        """
+        with self.lock:
+            wallets, self.releasing = self.releasing, []
+        busy = []
+        for wallet in wallets:
+            lock = self.wallet_lock(wallet.id)
+            if not lock.acquire(blocking=wait):
+                busy.append(wallet)
+                continue
+            try:
+                if wallet._new_key_pairs:
+                    wallet.save()
+                wallet.wipe()
+            finally:
+                lock.release()
+        if busy:
+            with self.lock:
+                self.releasing.extend(busy)
+
+    def get(self, wallet_id) -> Wallet:
+        """
+            The unlocked wallet, None if it was never unlocked, is locked or expired
+        """
+        with self.lock:
+            expired = self._expired(self.clock())
+            entry = self.entries.get(wallet_id)
+            if entry is not None:
+                entry[1] = self.clock()
+                self.entries.move_to_end(wallet_id)
+        self._release(expired, 'expired')
+        (CACHE_MISSES if entry is None else CACHE_HITS).inc()
+        return None if entry is None else entry[0]
+
+    def add(self, wallet) -> Wallet:
+        """
+            Keep an unlocked wallet, its key pairs not saved yet are saved first. Return the wallet to use:
+            when another object of the same wallet is cached (two logins missed together, a wallet created again)
+            the cached one is kept, reloads its keys from the database and the new one is wiped
+        """
+        if not wallet._saved or wallet._new_key_pairs:
+            wallet.save()
+        cached = None
+        with self.lock:
+            now = self.clock()
+            expired = self._expired(now)
+            entry = self.entries.get(wallet.id)
+            if entry is not None and entry[0] is not wallet:
+                cached = entry[0]
+                entry[1] = now
+            else:
+                #the wallet lock is kept alive by the entry
+                self.entries[wallet.id] = [wallet, now, self.locks.setdefault(wallet.id, threading.Lock())]
+                self.password_hashes[wallet.password_hash] = wallet.id
+            self.entries.move_to_end(wallet.id)
+            evicted = [self._pop(next(iter(self.entries))) for _ in range(len(self.entries) - self.size)]
+        self._release(expired, 'expired')
+        self._release(evicted, 'size')
+        if cached is None:
+            return wallet
+        wallet.wipe()
+        with self.wallet_lock(cached.id):
+            #the keys the other object saved are read again, the cached wallet saves its own first
+            if cached._new_key_pairs:
+                cached.save()
+            cached.key_pairs = None
+        return cached
+
+    def login(self, password) -> Wallet:
+        """
+            The cached wallet of password, loaded from the database and cached on a miss
+        """
+        password_hash = CryptoUtil.hash(password)
+        with self.lock:
+            wallet_id = self.password_hashes.get(password_hash)
+        wallet = self.get(wallet_id) if wallet_id is not None else None
+        if wallet is None:
+            if wallet_id is None:
+                CACHE_MISSES.inc()
+            wallet = self.add(Wallet.load_wallet_from_password(password))
+        return wallet
+
+    def generate_address(self, wallet_id):
+        """
+            New address of a cached wallet, written through to the database before it is returned. None if the wallet is not cached
+        """
+        wallet = self.get(wallet_id)
+        if wallet is None:
+            return None
+        address = wallet.generate_address()
+        wallet.save()
+        return address
+
+    def remove(self, wallet_id) -> bool:
+        with self.lock:
+            wallet = self._pop(wallet_id) if wallet_id in self.entries else None
+        if wallet is not None:
+            self._release([wallet], 'locked')
+        return wallet is not None
+
+    def prune(self) -> int:
+        """
+            Remove the expired wallets now instead of on the next access and wipe the ones left busy, return how many expired
+        """
+        with self.lock:
+            expired = self._expired(self.clock())
+        self._release(expired, 'expired')
+        return len(expired)
+
+    def clear(self):
+        """
+            Lock every wallet, waiting for the calls still running on them
+        """
+        with self.lock:
+            wallets = [self._pop(wallet_id) for wallet_id in list(self.entries)]
+        self._release(wallets, 'locked', wait=True)
+
+    def __contains__(self, wallet_id) -> bool:
+        with self.lock:
+            return wallet_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def ids(self) -> list:
+        with self.lock:
+            return list(self.entries)
@@ -0,0 +1,85 @@
+from lib.wallet.exception import WalletException
+from lib.config import COIN_SELECTION_BNB_MAX_TRIES, CONSOLIDATE_MAX_INPUTS
+
+def _amount(tx):
+    return tx["amount"]
+
+def _check_funds(uxto, target):
+    total = sum(map(_amount, uxto))
+    if total < target:
+        raise WalletException("Sender does not have enough to pay for the transaction, got {} need {}".format(total, target))
+
+def largest_first(uxto, target) -> list:
+    """
+        Spend the biggest outputs first, this is the smallest number of inputs able to pay target
+    """
+    _check_funds(uxto, target)
+    selected = []
+    total = 0
+    for tx in sorted(uxto, key=_amount, reverse=True):
+        if total >= target:
+            break
+        selected.append(tx)
+        total += tx["amount"]
+    return selected
+
+def branch_and_bound(uxto, target, max_tries=COIN_SELECTION_BNB_MAX_TRIES) -> list:
+    """
+        Depth first search for a set of outputs paying exactly target so the transaction needs no change output,
+        fall back to largest first when no exact match is found within max_tries steps
+    """
+    _check_funds(uxto, target)
+    pool = sorted(uxto, key=_amount, reverse=True)
+    amounts = [tx["amount"] for tx in pool]
+    #remaining[i] is what outputs i.. could still add
+    remaining = [0] * (len(pool) + 1)
+    for i in reversed(range(len(pool))):
+        remaining[i] = remaining[i + 1] + amounts[i]
+
+    selected = []
+    total = 0
+    i = 0
+    for _ in range(max_tries):
+        if total == target:
+            return [pool[index] for index in selected]
+        if total > target or total + remaining[i] < target:
+            #this branch can not reach target, drop the last included output and try without it
+            if not selected:
+                break
+            i = selected.pop()
+            total -= amounts[i]
+            i += 1
+            continue
+        selected.append(i)
+        total += amounts[i]
+        i += 1
+    return largest_first(uxto, target)
+
+def consolidate(uxto, target, max_inputs=CONSOLIDATE_MAX_INPUTS) -> list:
+    """
+        Pay target and sweep as many small outputs as max_inputs allows into the change output
+    """
+    selected = largest_first(uxto, target)
+    chosen = set(map(id, selected))
+    for tx in sorted(uxto, key=_amount):
+        if max_inputs is not None and len(selected) >= max_inputs:
+            break
+        if id(tx) not in chosen:
+            selected.append(tx)
+    return selected
+
+COIN_SELECTION = {
+    'largest_first': largest_first,
+    'branch_and_bound': branch_and_bound,
+    'consolidate': consolidate,
+}
+
+def get_coin_selection(selection):
+    """
+        Return the selection function from its name, a callable (uxto, target) -> list is returned as is
+    """
+    if callable(selection):
+        return selection
+    if selection not in COIN_SELECTION:
+        raise WalletException("Unknown coin selection {}".format(selection))
+    return COIN_SELECTION[selection]
@@ -0,0 +1,137 @@
+import hashlib
+import math
+import threading
+import weakref
+
+from lib.config import WATCH_BLOOM_ERROR_RATE
+
+class BloomFilter():
+    """
+        Bit array answering "maybe" or "no" for 32-byte keys. Addresses are ed25519 public keys, already uniformly
+        distributed, so the bit positions are read from the key bytes instead of hashing it
+    """
+    __slots__ = ('capacity', 'size', 'hashes', 'bits')
+
+    def __init__(self, capacity, error_rate=WATCH_BLOOM_ERROR_RATE) -> None:
+        self.capacity = max(capacity, 1)
+        self.size = max(64, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        #8 windows of 4 bytes in a 32-byte key
+        self.hashes = max(1, min(8, round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key: bytes):
+        size = self.size
+        return [int.from_bytes(key[i:i + 4], 'little') % size for i in range(0, self.hashes * 4, 4)]
+
+    def add(self, key: bytes):
+        bits = self.bits
+        for position in self.positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        bits = self.bits
+        size = self.size
+        #a foreign key usually misses on the first or second bit, stop there
+        for i in range(0, self.hashes * 4, 4):
+            position = int.from_bytes(key[i:i + 4], 'little') % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
+
+def address_key(address) -> bytes:
+    """
+        Raw 32 bytes of a hex public key, other addresses are hashed to 32 bytes so they can be watched too
+    """
+    try:
+        key = bytes.fromhex(address)
+        if len(key) == 32:
+            return key
+    except (TypeError, ValueError):
+        pass
+    return hashlib.blake2b(str(address).encode(), digest_size=32).digest()
+
+class AddressFilter():
+    """
+        Membership index of watched addresses: a set of raw 32-byte keys, a third less memory than the hex strings.
+        The optional Bloom filter in front (about 1.2 bytes an address at 1%) rejects most foreign addresses before the set lookup,
+        it is rebuilt twice as large when full. Read from Python it is slower than the set alone so it is off by default
+    """
+    def __init__(self, addresses=(), bloom=False, error_rate=WATCH_BLOOM_ERROR_RATE) -> None:
+        self.keys = set()
+        self.error_rate = error_rate
+        self.bloom = BloomFilter(1024, error_rate) if bloom else None
+        self.lock = threading.Lock()
+        self.update(addresses)
+
+    def _grow(self, count):
+        if self.bloom is not None and count > self.bloom.capacity:
+            bloom = BloomFilter(max(count, self.bloom.capacity * 2), self.error_rate)
+            for key in self.keys:
+                bloom.add(key)
+            self.bloom = bloom
+
+    def add(self, address):
+        self.update((address,))
+
+    def update(self, addresses):
+        keys = [address_key(address) for address in addresses]
+        with self.lock:
+            self._grow(len(self.keys) + len(keys))
+            self.keys.update(keys)
+            if self.bloom is not None:
+                for key in keys:
+                    self.bloom.add(key)
+
+    def __contains__(self, address) -> bool:
+        key = address_key(address)
+        if self.bloom is not None and key not in self.bloom:
+            return False
+        return key in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def match_outputs(self, transactions):
+        """
+            (transaction, output index, output) of every output paying a watched address
+        """
+        for transaction in transactions:
+            for index, output in enumerate(transaction["data"]["outputs"]):
+                if output["address"] in self:
+                    yield transaction, index, output
+
+class WatchedAddresses(AddressFilter):
+    """
+        AddressFilter of the utxo_address table, the addresses of every wallet saved in the database.
+        sync() only reads the rows added since the last call, by this process or another one
+    """
+    def __init__(self, db, bloom=False) -> None:
+        super(WatchedAddresses, self).__init__(bloom=bloom)
+        self.db = db
+        self.last_rowid = 0
+        self.sync_lock = threading.Lock()
+
+    def sync(self):
+        with self.sync_lock:
+            rows = self.db.fetch_all('select rowid, address from utxo_address where rowid>:rowid order by rowid', {'rowid': self.last_rowid})
+            if rows:
+                self.update(row["address"] for row in rows)
+                self.last_rowid = rows[-1]["rowid"]
+        return self
+
+_SHARED = weakref.WeakKeyDictionary()
+_SHARED_LOCK = threading.Lock()
+
+def watched_addresses(db, sync=True) -> WatchedAddresses:
+    """
+        The WatchedAddresses of db shared by every wallet and scanner of this process, synced with the table unless sync is False
+    """
+    with _SHARED_LOCK:
+        watched = _SHARED.get(db)
+        if watched is None:
+            watched = _SHARED[db] = WatchedAddresses(db)
+    return watched.sync() if sync else watched
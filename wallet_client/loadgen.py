@@ -0,0 +1,232 @@
+import argparse
+import atexit
+import math
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import ujson
+
+#the tracked data/wallet.db and log.txt are left alone: importing lib.config opens the database of WALLET_DATA_PATH
+DATA_PATH = tempfile.mkdtemp(prefix='wallet-loadgen-')
+atexit.register(shutil.rmtree, DATA_PATH, True)
+os.environ.setdefault('WALLET_DATA_PATH', DATA_PATH)
+os.environ.setdefault('WALLET_LOG_FILE', os.path.join(DATA_PATH, 'log.txt'))
+
+from concurrent.futures import ThreadPoolExecutor
+from lib.db import Database
+from lib.config import CLIENT_CONFIG
+from lib.api import NaiveCoinApi, TranscationUpdater, TICK_ERRORS
+from lib.api.session import HttpClient
+from lib.wallet import Wallet
+from lib.cryptoUtil import CryptoUtil
+from lib.metrics import METRICS
+from stub_node import StubNode
+
+STAGES = ('create', 'generate_address', 'send', 'confirm')
+
+def percentile(values, p):
+    """
+        Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+class StageStats():
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def summary(self, elapsed) -> dict:
+        latencies = sorted(self.latencies)
+        ms = lambda value: None if value is None else value * 1000
+        return {
+            'count': len(latencies),
+            'errors': self.errors,
+            'throughput': len(latencies) / elapsed if elapsed else 0,
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p95_ms': ms(percentile(latencies, 95)),
+            'p99_ms': ms(percentile(latencies, 99)),
+            'max_ms': ms(latencies[-1] if latencies else None),
+        }
+
+class LoadGenerator():
+    """
+        Run simulated wallets through create -> generate_address -> send -> confirmation against a StubNode,
+        with the client stack (NaiveCoinApi, local database, TranscationUpdater) of this process
+    """
+    def __init__(self, node: StubNode, wallets=10, sends=5, amount=10, concurrency=None, updater_interval=0.2, timeout=60, push=False) -> None:
+        self.node = node
+        self.wallets = wallets
+        self.sends = sends
+        self.amount = amount
+        self.concurrency = concurrency or wallets
+        self.updater_interval = updater_interval
+        self.timeout = timeout
+        self.push = push
+        self.stats = {stage: StageStats() for stage in STAGES}
+        self.sent_at = {} #transaction id -> time the node accepted it
+        self.sent_lock = threading.Lock()
+        self.included = set()
+        self._stop = threading.Event()
+
+    def timed(self, stage, fn):
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except Exception:
+            self.stats[stage].error()
+            raise
+        self.stats[stage].record(time.perf_counter() - start)
+        return result
+
+    def run_wallet(self, _):
+        def create():
+            wallet = Wallet.from_password(CryptoUtil.random_id())
+            wallet.save()
+            return wallet
+        wallet = self.timed('create', create)
+
+        def generate_address():
+            address = wallet.generate_address()
+            wallet.save()
+            return address
+        address = self.timed('generate_address', generate_address)
+        #the fee is paid by every send, fund enough for the change to cover the next one
+        self.node.fund(address, (self.amount + 1) * self.sends + 1)
+
+        for _ in range(self.sends):
+            try:
+                transaction = self.timed('send', lambda: wallet.send(CryptoUtil.random_id(), address, self.amount).save())
+            except Exception:
+                continue
+            with self.sent_lock:
+                self.sent_at[transaction.id] = time.perf_counter()
+
+    def collect(self, updater: TranscationUpdater):
+        """
+            Read the events the updater loop puts on its queue until stopped
+        """
+        while not self._stop.is_set() or not updater.queue.empty():
+            try:
+                events = updater.queue.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            now = time.perf_counter()
+            with self.sent_lock:
+                for id, confirmations in events:
+                    #latency to the first block holding the transaction
+                    if confirmations > 0 and id in self.sent_at and id not in self.included:
+                        self.included.add(id)
+                        self.stats['confirm'].record(now - self.sent_at[id])
+
+    def run(self) -> dict:
+        updater = TranscationUpdater(queue.Queue(), subscribe=self.push)
+        updater.wake = threading.Event()
+        if self.push:
+            updater.start_subscription(node=self.node.url, port=0)
+        #the shipped loop is measured, a pushed block wakes it before the interval
+        tick_errors = TICK_ERRORS.value
+        threads = [threading.Thread(target=updater.loop, args=(self._stop, self.updater_interval), daemon=True),
+            threading.Thread(target=self.collect, args=(updater,), daemon=True)]
+        for thread in threads:
+            thread.start()
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                list(executor.map(self.run_wallet, range(self.wallets)))
+            sends_done = time.perf_counter()
+            #wait for the updater to see every accepted transaction in a block
+            deadline = sends_done + self.timeout
+            while len(self.stats['confirm'].latencies) < len(self.sent_at) and time.perf_counter() < deadline:
+                time.sleep(0.05)
+        finally:
+            self._stop.set()
+            updater.wake.set()
+            for thread in threads:
+                thread.join()
+            self.stats['confirm'].errors += TICK_ERRORS.value - tick_errors
+            if updater.subscription is not None:
+                updater.subscription.stop()
+        elapsed = time.perf_counter() - start
+        return {
+            'wallets': self.wallets,
+            'sends_per_wallet': self.sends,
+            'concurrency': self.concurrency,
+            'latency': self.node.latency,
+            'block_interval': self.node.block_interval,
+            'push': self.push,
+            'elapsed': elapsed,
+            'sends_per_second': len(self.stats['send'].latencies) / (sends_done - start),
+            'unconfirmed': len(self.sent_at) - len(self.stats['confirm'].latencies),
+            'stages': {stage: stats.summary(elapsed) for stage, stats in self.stats.items()},
+            'http': NaiveCoinApi.client.stats(),
+            'metrics': METRICS.snapshot(),
+        }
+
+def run(wallets=10, sends=5, concurrency=None, latency=0.0, jitter=0.0, block_interval=1.0, updater_interval=0.2, verify=False, timeout=60, push=False) -> dict:
+    """
+        Start a stub node and a throwaway database, run the load and put the client configuration back
+    """
+    client, default_node, db = NaiveCoinApi.client, NaiveCoinApi.node, CLIENT_CONFIG.db
+    with tempfile.TemporaryDirectory() as tmp, StubNode(latency=latency, jitter=jitter, block_interval=block_interval, verify=verify) as node:
+        loadgen_db = Database.create_schema('loadgen.db', path=tmp + '/')
+        CLIENT_CONFIG.config_database(loadgen_db)
+        NaiveCoinApi.configure(HttpClient(pool_size=concurrency or wallets), node=node.url)
+        METRICS.reset()
+        try:
+            return LoadGenerator(node, wallets, sends, concurrency=concurrency, updater_interval=updater_interval, timeout=timeout, push=push).run()
+        finally:
+            NaiveCoinApi.client.close()
+            NaiveCoinApi.configure(client, node=default_node)
+            CLIENT_CONFIG.config_database(db)
+            loadgen_db.close()
+
+def print_report(report, stream=sys.stdout):
+    print("{} wallets x {} sends, concurrency {}, node latency {:.0f} ms, block every {}s, {}".format(
+        report["wallets"], report["sends_per_wallet"], report["concurrency"], report["latency"] * 1000, report["block_interval"],
+        'blocks pushed' if report["push"] else 'updater polling'), file=stream)
+    print("{:<18} {:>7} {:>7} {:>10} {:>10} {:>10} {:>10}".format('stage', 'count', 'errors', 'per sec', 'p50 ms', 'p95 ms', 'p99 ms'), file=stream)
+    for stage, summary in report["stages"].items():
+        print("{:<18} {:>7} {:>7} {:>10.1f} {:>10} {:>10} {:>10}".format(stage, summary["count"], summary["errors"], summary["throughput"],
+            *('-' if summary[key] is None else '{:.1f}'.format(summary[key]) for key in ('p50_ms', 'p95_ms', 'p99_ms'))), file=stream)
+    print("sends/s {:.1f}, {} unconfirmed after the timeout".format(report["sends_per_second"], report["unconfirmed"]), file=stream)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Drive simulated wallets against an in-process stub node')
+    parser.add_argument('--wallets', type=int, default=10)
+    parser.add_argument('--sends', type=int, default=5, help='sends per wallet')
+    parser.add_argument('--concurrency', type=int, help='wallets running at once (default every wallet)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stub node waits before each response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds added to the latency')
+    parser.add_argument('--block-interval', type=float, default=1.0, help='seconds between mined blocks')
+    parser.add_argument('--updater-interval', type=float, default=0.2, help='seconds between updater ticks')
+    parser.add_argument('--push', action='store_true', help='subscribe the updater to the blocks pushed by the stub node, the interval is then only a fallback')
+    parser.add_argument('--verify', action='store_true', help='verify signatures in the stub node, it shares the cpu with the client')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for confirmations after the last send')
+    parser.add_argument('--json', metavar='PATH', help="write the report as json to PATH, '-' for stdout")
+    args = parser.parse_args(argv)
+
+    report = run(args.wallets, args.sends, args.concurrency, args.latency, args.jitter, args.block_interval, args.updater_interval, args.verify, args.timeout, args.push)
+    print_report(report, sys.stderr if args.json == '-' else sys.stdout)
+    if args.json == '-':
+        print(ujson.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as report_file:
+            ujson.dump(report, report_file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,14 @@ import logging
 
 from multiprocessing import Queue
 from lib.api import TranscationUpdater
+from lib.config import METRICS_PATH
+from lib.config.log import LOG_FILE
+from lib.metrics import METRICS
 from client import ECLIENT_EXIT, ECLIENT_FORCE_EXIT, Client
 
 processes = []
 
-logging.basicConfig(format="%(asctime)s-[%(levelname)s]:%(message)s", filename='log.txt')
+logging.basicConfig(format="%(asctime)s-[%(levelname)s]:%(message)s", filename=LOG_FILE)
 
 def main():
     queue = Queue()
@@ -29,5 +32,8 @@ def main():
 
     updater.terminate() 
 
+    if METRICS_PATH:
+        METRICS.write(METRICS_PATH.format(process='client'))
+
 if __name__ == "__main__":
     main()
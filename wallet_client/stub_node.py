@@ -0,0 +1,213 @@
+import random
+import re
+import threading
+import time
+import requests
+import ujson
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from lib.cryptoUtil import CryptoUtil
+from lib.transaction import Transaction, TRANSACTION_TYPE_REWARD
+from lib.transaction.exception import TransactionInvalidException
+
+class StubNode():
+    """
+        In-process stand-in for the naivecoin HTTP API the wallet client uses, for load tests and benchmarks.
+        Transactions are kept in memory and mined into a new block every block_interval seconds when there are any (or by mine()),
+        every request waits latency seconds plus a random jitter to look like a remote node
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, block_interval=1.0, verify=False) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.block_interval = block_interval
+        self.verify = verify
+        self.lock = threading.Lock()
+        self.blocks = [self.make_block(0, '0', [])]
+        self.transactions = []
+        self.transactions_id = set()
+        self.unspent = {} #(transaction id, output index) -> unspent output in the node format
+        self.unspent_by_address = {}
+        self.block_of_transaction = {}
+        self.peers = [] #{'url': ...} registered with POST /node/peers, new blocks are pushed to them
+        self._stop = threading.Event()
+        self._threads = []
+        self.server = ThreadingHTTPServer((host, port), StubNodeHandler)
+        self.server.daemon_threads = True
+        self.server.node = self
+
+    @property
+    def url(self) -> str:
+        return 'http://{}:{}'.format(*self.server.server_address)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._threads = [threading.Thread(target=self.server.serve_forever, daemon=True)]
+        if self.block_interval:
+            self._threads.append(threading.Thread(target=self._miner, daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _miner(self):
+        while not self._stop.wait(self.block_interval):
+            if self.transactions:
+                self.mine()
+
+    @staticmethod
+    def make_block(index, previous_hash, transactions) -> dict:
+        timestamp = int(time.time())
+        return {'index': index, 'previousHash': previous_hash, 'timestamp': timestamp, 'nonce': 0, 'transactions': transactions,
+            'hash': CryptoUtil.hash(str(index) + previous_hash + str(timestamp) + ujson.dumps(transactions) + '0')}
+
+    def mine(self) -> dict:
+        """
+            Put every pending transaction into a new block
+        """
+        with self.lock:
+            block = self.make_block(len(self.blocks), self.blocks[-1]["hash"], self.transactions)
+            self.blocks.append(block)
+            for transaction in self.transactions:
+                self.block_of_transaction[transaction["id"]] = block
+            self.transactions = []
+        self.broadcast(block)
+        return block
+
+    def broadcast(self, block):
+        #like the node, a peer that does not answer is only logged and kept
+        for peer in list(self.peers):
+            threading.Thread(target=self._push, args=(peer["url"], block), daemon=True).start()
+
+    @staticmethod
+    def _push(url, block):
+        try:
+            requests.put(url + '/blockchain/blocks/latest', json=block, timeout=5)
+        except requests.exceptions.RequestException:
+            pass
+
+    def fund(self, address, amount) -> dict:
+        """
+            Pay amount to address with a reward transaction, it is unspent at once and mined in the next block
+        """
+        transaction = Transaction(CryptoUtil.random_id(), TRANSACTION_TYPE_REWARD, [], [{'amount': amount, 'address': address}]).confirm()
+        with self.lock:
+            self._accept(transaction)
+        return transaction
+
+    def _accept(self, transaction):
+        for tx_input in transaction["data"]["inputs"]:
+            key = (tx_input["transaction"], int(tx_input["index"]))
+            del self.unspent_by_address[self.unspent.pop(key)["address"]][key]
+        for index, output in enumerate(transaction["data"]["outputs"]):
+            key = (transaction["id"], index)
+            self.unspent[key] = {'transaction': transaction["id"], 'index': index, 'amount': output["amount"], 'address': output["address"]}
+            self.unspent_by_address.setdefault(output["address"], {})[key] = self.unspent[key]
+        self.transactions.append(transaction)
+        self.transactions_id.add(transaction["id"])
+
+    def add_transaction(self, transaction):
+        """
+            Return (status, body) like the node POST /blockchain/transactions
+        """
+        if self.verify:
+            try:
+                Transaction.verify(Transaction.from_json(transaction))
+            except TransactionInvalidException as ex:
+                return 400, {'status': str(ex)}
+        with self.lock:
+            if transaction["id"] in self.transactions_id:
+                return 409, {'status': "Transaction '{}' already exists".format(transaction["id"])}
+            spent = [(tx_input["transaction"], int(tx_input["index"])) for tx_input in transaction["data"]["inputs"]]
+            if any(key not in self.unspent for key in spent) or len(set(spent)) != len(spent):
+                return 400, {'status': 'Transaction {} spends an unknown or spent output'.format(transaction["id"])}
+            self._accept(transaction)
+        return 201, transaction
+
+    def unspent_for_address(self, address) -> list:
+        with self.lock:
+            return list(self.unspent_by_address.get(address, {}).values())
+
+    def route(self, method, path, query, body):
+        """
+            Return (status, json body) of a request
+        """
+        if method == 'GET':
+            if path == '/blockchain/blocks':
+                return 200, self.blocks
+            if path == '/blockchain/blocks/latest':
+                return 200, self.blocks[-1]
+            match = re.fullmatch(r'/blockchain/blocks/transactions/([a-zA-Z0-9]{64})', path)
+            if match:
+                block = self.block_of_transaction.get(match.group(1))
+                return (200, block) if block else (404, {'status': "Transaction '{}' not found in any block".format(match.group(1))})
+            match = re.fullmatch(r'/blockchain/blocks/([a-zA-Z0-9]{64})', path)
+            if match:
+                block = next((block for block in self.blocks if block["hash"] == match.group(1)), None)
+                return (200, block) if block else (404, {'status': "Block not found with hash '{}'".format(match.group(1))})
+            match = re.fullmatch(r'/blockchain/blocks/(\d+)', path)
+            if match:
+                index = int(match.group(1))
+                return (200, self.blocks[index]) if index < len(self.blocks) else (404, {'status': "Block not found with index '{}'".format(index)})
+            if path == '/blockchain/transactions':
+                return 200, self.transactions
+            if path == '/node/peers':
+                return 200, self.peers
+            if path == '/blockchain/transactions/unspent':
+                return 200, self.unspent_for_address(query.get('address', [None])[0])
+            match = re.fullmatch(r'/operator/([^/]+)/balance', path)
+            if match:
+                unspent = self.unspent_for_address(match.group(1))
+                if not unspent:
+                    #the node raises an ArgumentError, sent back as a plain text 404
+                    return 404, "No transactions found for address '{}'".format(match.group(1))
+                return 200, {'balance': sum(output["amount"] for output in unspent)}
+        elif method == 'POST' and path == '/blockchain/transactions':
+            return self.add_transaction(body)
+        elif method == 'POST' and path == '/node/peers':
+            with self.lock:
+                if not any(peer["url"] == body["url"] for peer in self.peers):
+                    self.peers.append({'url': body["url"]})
+            return 201, body
+        return 404, {'status': 'Not found {} {}'.format(method, path)}
+
+class StubNodeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #keep-alive, like the node
+    disable_nagle_algorithm = True
+
+    def handle_request(self, method):
+        node = self.server.node
+        if node.latency or node.jitter:
+            time.sleep(node.latency + random.uniform(0, node.jitter))
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = ujson.loads(self.rfile.read(length)) if length else None
+        try:
+            status, res = node.route(method, url.path, parse_qs(url.query), body)
+        except (KeyError, TypeError, ValueError) as ex:
+            status, res = 400, {'status': 'Bad request: {}'.format(ex)}
+        #error messages of the node are plain text
+        data = res.encode() if isinstance(res, str) else ujson.dumps(res).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8' if isinstance(res, str) else 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def log_message(self, format, *args):
+        pass
@@ -1,7 +1,55 @@
+import atexit
+import copy
+import io
 import unittest
+import tempfile
+import time
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import asyncio
+import aiohttp
+import threading
+import requests
+import ujson
+import queue
 
-from lib.transaction import Transaction
+#the tracked data/wallet.db and log.txt are left alone: importing lib.config opens the database of WALLET_DATA_PATH
+DATA_PATH = tempfile.mkdtemp(prefix='wallet-test-')
+atexit.register(shutil.rmtree, DATA_PATH, True)
+os.environ.setdefault('WALLET_DATA_PATH', DATA_PATH)
+os.environ.setdefault('WALLET_LOG_FILE', os.path.join(DATA_PATH, 'log.txt'))
+
+import loadgen
+
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from aiohttp.test_utils import TestClient, TestServer
+
+from lib.db import Database
+from lib.config import CLIENT_CONFIG, CONFIRMATION_DEPTH
+from lib.api import NaiveCoinApi
+from lib.api import TranscationUpdater
+from lib.api.session import HttpClient
+from lib.api.exception import TransactionRequestException
+from lib.api.aio import AsyncNaiveCoinApi
+from lib.utxo import UtxoIndex
+from lib.balance import BalanceCache
+from lib.history import TransactionHistory, ADDRESS_SUMMARY
+from lib.rescan import ChainRescan
+from lib.wallet import Wallet, DERIVATION_CHAIN, DERIVATION_INDEX
+from lib.wallet.exception import WalletException
+from lib.wallet.manager import WalletManager, CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS
+from lib.wallet.selection import largest_first, branch_and_bound, consolidate
+from lib.transaction import Transaction, TxInput
 from lib.transaction.exception import TransactionInvalidException
+from lib.cryptoUtil import CryptoUtil
+from lib.metrics import Metrics
+from lib.rpc import JsonRpcServer, WalletService
+from lib.watch import AddressFilter, BloomFilter, watched_addresses
+from stub_node import StubNode
 tx = {
             "id": "c3c1e6fbff949042b065dc9e22d065a54ab826595fd8877d2be8ddb8cbb0e27f",
             "hash": "3b5bbf698031e437787fe7b31f098e214a1eeff01fee9b95c22bccf20146982c",
@@ -35,7 +83,7 @@ class TestTransaction(unittest.TestCase):
         # we parse the JSON data into our Tranasction object for verifying
         test_tx = Transaction.from_json(tx)
         # if some one intercept the transaction infomation e.g modify the inputs transaction id 
-        test_tx.data["inputs"][0]["transation"] = "3b5bbf698031e437787fe7b31f098e214a1eeff01fee9b95c22bccf20146982c"
+        test_tx.data["inputs"][0]["transaction"] = "3b5bbf698031e437787fe7b31f098e214a1eeff01fee9b95c22bccf20146982c"
         #we confirm the transaction to recalc the tx hash
         test_tx.confirm()
         # now we verfify it, the verify must throw the InvalidSignature if the transaction signature invalid
@@ -51,5 +99,1033 @@ class TestTransaction(unittest.TestCase):
         with self.assertRaises(TransactionInvalidException):
             Transaction.verify(test_tx)
 
+    def test_cached_hash_matches_node_serialization(self):
+        fixture = copy.deepcopy(tx)
+        test_tx = Transaction.from_json(ujson.dumps(fixture))
+        self.assertEqual(test_tx.data.json, ujson.dumps(fixture["data"]))
+        self.assertEqual(test_tx.calc_hash(), CryptoUtil.hash(fixture["id"] + fixture["type"] + ujson.dumps(fixture["data"])))
+        # a change of an input or output must drop the cached hash
+        test_tx.data["outputs"][1].amount -= 1
+        fixture["data"]["outputs"][1]["amount"] -= 1
+        self.assertEqual(test_tx.calc_hash(), CryptoUtil.hash(fixture["id"] + fixture["type"] + ujson.dumps(fixture["data"])))
+        test_tx.data["outputs"].append({'address': 'b' * 64, 'amount': 1})
+        fixture["data"]["outputs"].append({'address': 'b' * 64, 'amount': 1})
+        self.assertEqual(test_tx.calc_hash(), CryptoUtil.hash(fixture["id"] + fixture["type"] + ujson.dumps(fixture["data"])))
+        self.assertEqual(test_tx.confirm()["data"], fixture["data"])
+
+class TestVerifyMany(unittest.TestCase):
+    # TestTransaction modifies tx in place, keep the original
+    fixture = copy.deepcopy(tx)
+
+    def test_report_every_invalid_transaction(self):
+        tx = self.fixture
+        bad_signature = copy.deepcopy(tx)
+        bad_signature["data"]["inputs"][0]["signature"] = '0' * 128
+        bad_amount = copy.deepcopy(tx)
+        bad_amount["data"]["outputs"][0]["amount"] = 10000000000
+        reward = {'id': 'a' * 64, 'hash': None, 'type': 'reward', 'data': {'inputs': [], 'outputs': [{'amount': 50, 'address': 'b' * 64}]}}
+        tx_objs = [Transaction.from_json(data) for data in (copy.deepcopy(tx), bad_signature, bad_amount, reward)]
+        for tx_obj in tx_objs[1:]:
+            tx_obj.confirm()
+
+        # serial by default, the pool when configured for a batch large enough
+        for options in ({}, {'max_workers': 2, 'chunk_size': 1, 'parallel_min': 0}):
+            invalid = Transaction.verify_many(tx_objs, **options)
+            self.assertEqual([tx_objs.index(tx_obj) for tx_obj, _ in invalid], [1, 2])
+            for _, errors in invalid:
+                self.assertTrue(all(isinstance(error, TransactionInvalidException) for error in errors))
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_exec_many_in_transaction(self):
+        rows = [{'transaction_id': str(i), 'hash': 'h', 'type': 'regular', 'data': '{}', 'confirmed': False} for i in range(100)]
+        with self.db.transaction():
+            self.db.exec_many('insert into tx (transaction_id, hash, type, data, confirmed) values(:transaction_id, :hash, :type, :data, :confirmed)', rows)
+        self.assertEqual(self.db.fetch_one('select count(*) from tx')[0], 100)
+
+    def test_transaction_rollback(self):
+        # an exception inside the block must discard every statement of the block
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.db.exec('insert into tx (transaction_id, hash, type, data, confirmed) values(:transaction_id, :hash, :type, :data, :confirmed)', {'transaction_id': '1', 'hash': 'h', 'type': 'regular', 'data': '{}', 'confirmed': False}, commit=True)
+                raise ValueError()
+        self.assertEqual(self.db.fetch_one('select count(*) from tx')[0], 0)
+
+    def test_migrate_tx_without_primary_key(self):
+        legacy = Database('legacy.db', path=self.tmp.name + '/')
+        legacy.exec("create table tx (transaction_id, hash, type, data, confirmed)")
+        legacy.exec_many('insert into tx values(:transaction_id, :hash, :type, :data, :confirmed)',
+            [{'transaction_id': id, 'hash': hash, 'type': 'regular', 'data': '{}', 'confirmed': True} for id, hash in (('b', 'first'), ('a', 'h'), ('b', 'duplicate'))])
+        legacy.close()
+
+        db = Database.create_schema('legacy.db', path=self.tmp.name + '/')
+        self.assertEqual([row[1] for row in db.fetch_all('pragma table_info(tx)') if row[5]], ['transaction_id'])
+        self.assertEqual([tuple(row) for row in db.fetch_all('select transaction_id, hash from tx order by rowid')], [('b', 'first'), ('a', 'h')])
+        self.assertIsNotNone(db.fetch_one('select created_at from tx')[0])
+        db.close()
+
+class TestTransactionHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        self.history = TransactionHistory(self.db)
+        # 2500 transactions one second apart, every third one pays address 'x' and every fifth one is confirmed
+        rows = [{'transaction_id': '{:064x}'.format(i), 'data': ujson.dumps({'inputs': [], 'outputs': [{'amount': 1, 'address': 'x' if i % 3 == 0 else 'y'}]}),
+            'confirmed': i % 5 == 0, 'block_index': 1 if i % 5 == 0 else None, 'created_at': 1000 + i} for i in range(2500)]
+        with self.db.transaction():
+            self.db.exec_many('insert into tx (transaction_id, hash, type, data, confirmed, block_index, created_at) values(:transaction_id, :transaction_id, :transaction_id, :data, :confirmed, :block_index, :created_at)', rows)
+            self.db.exec_many('insert into tx_output values(:transaction_id, 0, :address, 1)',
+                ({'transaction_id': row["transaction_id"], 'address': ujson.loads(row["data"])["outputs"][0]["address"]} for row in rows))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_pages_newest_first(self):
+        seen = []
+        cursor = None
+        while True:
+            page = self.history.page(limit=300, cursor=cursor, status='confirmed', address='x')
+            seen.extend(tx["transaction_id"] for tx in page["transactions"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, ['{:064x}'.format(i) for i in reversed(range(2500)) if i % 15 == 0])
+
+    def test_date_range_and_pending(self):
+        page = self.history.page(limit=10, status='pending', since=1000, until=1010)
+        self.assertEqual([tx["created_at"] for tx in page["transactions"]], [1009, 1008, 1007, 1006, 1004, 1003, 1002, 1001])
+        with self.assertRaises(ValueError):
+            self.history.page(status='lost')
+
+    def test_export_streams_in_batches(self):
+        stream = io.StringIO()
+        with mock.patch.object(self.history, 'rows', wraps=self.history.rows) as rows:
+            self.assertEqual(self.history.export(stream, 'jsonl', batch_size=1000), 2500)
+        self.assertEqual(rows.call_count, 3)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(ujson.loads(lines[0])["data"]["outputs"][0]["address"], 'x')
+        self.assertEqual(ujson.loads(lines[-1])["transaction_id"], '0' * 64)
+
+        stream = io.StringIO()
+        self.assertEqual(self.history.export(stream, 'csv', address='x'), 834)
+        self.assertEqual(stream.getvalue().splitlines()[0], 'transaction_id,type,status,confirmations,block_index,block_hash,created_at,confirmed_at')
+
+class TestTransactionItems(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        self.default_db = CLIENT_CONFIG.db
+        CLIENT_CONFIG.config_database(self.db)
+
+    def tearDown(self):
+        CLIENT_CONFIG.config_database(self.default_db)
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_save_and_address_summary(self):
+        reward = Transaction('a' * 64, 'reward', [], [{'amount': 50, 'address': 'x'}])
+        reward.hash = reward.calc_hash()
+        reward.save()
+        spend = Transaction('b' * 64, 'regular', [{'transaction': 'a' * 64, 'index': 0, 'amount': 50, 'address': 'x', 'signature': 's'}],
+            [{'amount': 20, 'address': 'y'}, {'amount': 29, 'address': 'x'}])
+        spend.hash = spend.calc_hash()
+        spend.save()
+        # saved twice, no duplicated rows
+        spend.save()
+
+        history = TransactionHistory(self.db)
+        self.assertEqual(history.address_summary('x'), {'address': 'x', 'received': 79, 'sent': 50, 'balance': 29, 'transactions': 2})
+        self.assertEqual(history.address_summary('y'), {'address': 'y', 'received': 20, 'sent': 0, 'balance': 20, 'transactions': 1})
+        plan = ' '.join(row[3] for row in self.db.fetch_all('explain query plan ' + ADDRESS_SUMMARY, {'address': 'x'}))
+        self.assertNotIn('SCAN tx_', plan)
+
+    def test_backfill_of_saved_transactions(self):
+        data = {'inputs': [{'transaction': 'a' * 64, 'index': 0, 'amount': 5, 'address': 'x', 'signature': 's'}], 'outputs': [{'amount': 4, 'address': 'y'}]}
+        self.db.exec('insert into tx (transaction_id, hash, type, data, confirmed) values(:id, :id, :type, :data, 0)', {'id': 'b' * 64, 'type': 'regular', 'data': ujson.dumps(data)}, commit=True)
+        self.db.exec('delete from sync_state', commit=True)
+        self.db.close()
+
+        db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        self.assertEqual([tuple(row) for row in db.fetch_all('select * from tx_input')], [('b' * 64, 0, 'a' * 64, 0, 'x', 5)])
+        self.assertEqual([tuple(row) for row in db.fetch_all('select * from tx_output')], [('b' * 64, 0, 'y', 4)])
+        db.close()
+
+class TestTransactionUpdater(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        self.queue = queue.Queue()
+        self.updater = TranscationUpdater(self.queue, self.db)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def insert_pending(self, pending_id):
+        with self.db.transaction():
+            self.db.exec_many('insert into tx (transaction_id, hash, type, data, confirmed) values(:transaction_id, :hash, :type, :data, :confirmed)',
+                ({'transaction_id': id, 'hash': 'h', 'type': 'regular', 'data': '{}', 'confirmed': False} for id in pending_id))
+
+    def test_confirm_many_pending_transactions(self):
+        pending_id = ['{:064x}'.format(i) for i in range(10000)]
+        self.insert_pending(pending_id)
+        # the block also holds transactions that are not ours
+        blocks = [{'index': 1, 'hash': 'b1', 'previousHash': 'b0', 'transactions': [{'id': '{:064x}'.format(i)} for i in range(20000)]}]
+
+        start = time.perf_counter()
+        with self.db.transaction():
+            included = self.updater.include_transactions(blocks)
+            confirmed = self.updater.confirm_transactions(CONFIRMATION_DEPTH)
+        self.assertLess(time.perf_counter() - start, 5)
+
+        self.assertEqual(len(included), 10000)
+        self.assertEqual(len(confirmed), 10000)
+        self.assertEqual(self.updater.pending_transactions_id(), [])
+
+    def chain(self, length, transactions={}, forks=()):
+        # blocks after each fork index get other hashes
+        blocks = []
+        previous_hash = '0'
+        for index in range(length):
+            hash = 'f{}-{}'.format(sum(1 for fork in forks if fork <= index), index)
+            blocks.append({'index': index, 'hash': hash, 'previousHash': previous_hash, 'transactions': [{'id': id, 'data': {'inputs': [], 'outputs': []}} for id in transactions.get(index, [])]})
+            previous_hash = hash
+        return blocks
+
+    def tick(self, chain):
+        with mock.patch.object(NaiveCoinApi, 'get_block_by_index', side_effect=lambda index: chain[index]):
+            self.updater.tick(chain[-1])
+        return dict(self.queue.get_nowait()) if not self.queue.empty() else {}
+
+    def test_confirmations_up_to_depth(self):
+        id = 'a' * 64
+        self.insert_pending([id])
+        with self.db.transaction():
+            self.updater.save_cursor(0)
+        self.assertEqual(self.tick(self.chain(2, {1: [id]})), {id: 1})
+        self.assertEqual(self.tick(self.chain(CONFIRMATION_DEPTH, {1: [id]})), {})
+        self.assertEqual(self.tick(self.chain(CONFIRMATION_DEPTH + 1, {1: [id]})), {id: CONFIRMATION_DEPTH})
+        self.assertTrue(self.db.fetch_one('select confirmed from tx where transaction_id=:id', {'id': id})["confirmed"])
+
+    def test_reorg_rolls_back_replaced_blocks(self):
+        id = 'a' * 64
+        self.insert_pending([id])
+        with self.db.transaction():
+            self.updater.save_cursor(0)
+        self.tick(self.chain(1))
+        self.assertEqual(self.tick(self.chain(4, {2: [id]})), {id: 2})
+        # block 2 and after are replaced, the transaction is in the new block 3
+        self.assertEqual(self.tick(self.chain(5, {3: [id]}, forks=(2,))), {id: 2})
+        row = self.db.fetch_one('select block_index, block_hash from tx where transaction_id=:id', {'id': id})
+        self.assertEqual((row["block_index"], row["block_hash"]), (3, 'f1-3'))
+        self.assertEqual(self.updater.load_cursor(), 4)
+        # replaced again by a chain without it
+        self.assertEqual(self.tick(self.chain(5, {}, forks=(2, 3))), {id: 0})
+        self.assertEqual(self.updater.pending_transactions_id(), [id])
+
+    def test_loop_survives_failed_ticks(self):
+        stop = threading.Event()
+        errors = [KeyError('index'), TypeError('not a block'), sqlite3.OperationalError('database is locked'), requests.exceptions.ConnectionError()]
+        ticks = []
+        def tick(pushed_block):
+            ticks.append(pushed_block)
+            if errors:
+                raise errors.pop(0)
+            stop.set()
+            self.updater.wake.set()
+        with mock.patch.object(self.updater, 'tick', side_effect=tick), mock.patch('lib.api.UPDATER_BACKOFF', 0.001):
+            self.updater.loop(stop)
+        self.assertEqual(len(ticks), 5)
+
+class TestHttpClient(unittest.TestCase):
+
+    def test_get_retried_post_not(self):
+        # grab a free port and close it so every connection is refused
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:{}/'.format(sock.getsockname()[1])
+        client = HttpClient(retries=2, backoff=0)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.get('get', url)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.post('post', url)
+        stats = client.stats()
+        self.assertEqual((stats['get']['requests'], stats['get']['retries']), (3, 2))
+        self.assertEqual((stats['post']['requests'], stats['post']['retries']), (1, 0))
+
+class BlockLookupHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        transaction_id = self.path.rsplit('/', 1)[-1]
+        if transaction_id.startswith('f'):
+            status, content_type, body = 404, 'text/html', "Transaction '{}' not found in any block".format(transaction_id)
+        else:
+            status, content_type, body = 200, 'application/json', ujson.dumps({'index': 1, 'transactions': [{'id': transaction_id}]})
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+class TestAsyncNaiveCoinApi(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BlockLookupHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.node = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_gather_partial_results(self):
+        transaction_id = ['{:064x}'.format(i) for i in range(200)] + ['f' * 64]
+
+        async def query():
+            async with AsyncNaiveCoinApi(self.node, concurrency=8) as api:
+                return await api.gather(api.get_block_by_transaction_id(id) for id in transaction_id)
+        results = asyncio.run(query())
+
+        self.assertEqual(len(results), 201)
+        self.assertTrue(all(result.ok for result in results[:200]))
+        self.assertFalse(results[200].ok)
+
+class TestUtxoIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        self.utxo = UtxoIndex(self.db)
+        self.address = 'a' * 64
+        self.utxo.reconcile(self.address, [
+            {'transaction': '1' * 64, 'index': 0, 'amount': 10, 'address': self.address},
+            {'transaction': '2' * 64, 'index': 1, 'amount': 5, 'address': self.address},
+        ])
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_ingest_block(self):
+        block = {'index': 1, 'transactions': [{
+            'id': '3' * 64,
+            'data': {
+                'inputs': [{'transaction': '1' * 64, 'index': 0, 'amount': 10, 'address': self.address}],
+                'outputs': [{'amount': 4, 'address': 'b' * 64}, {'amount': 5, 'address': self.address}],
+            }
+        }]}
+        self.utxo.ingest_blocks([block])
+        self.assertEqual(sorted((tx["transaction"], tx["index"]) for tx in self.utxo.unspent(self.address)), [('2' * 64, 1), ('3' * 64, 1)])
+        self.assertEqual(self.utxo.balance(self.address), 10)
+
+    def test_apply_transaction(self):
+        # our own transaction spends its inputs before being mined and its change can be spent right away
+        self.utxo.apply_transaction({'id': '4' * 64, 'data': {
+            'inputs': [{'transaction': '2' * 64, 'index': 1, 'amount': 5, 'address': self.address}],
+            'outputs': [{'amount': 1, 'address': 'b' * 64}, {'amount': 3, 'address': self.address}],
+        }})
+        self.assertEqual(self.utxo.balance(self.address), 13)
+
+class TestAddressFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        patch_db = mock.patch.object(CLIENT_CONFIG, 'db', self.db)
+        patch_db.start()
+        self.addCleanup(patch_db.stop)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_membership(self):
+        ours = [CryptoUtil.random_id() for _ in range(3000)] + ['not-a-public-key']
+        others = [CryptoUtil.random_id() for _ in range(3000)]
+        for bloom in (False, True):
+            addresses = AddressFilter(ours[:10], bloom=bloom)
+            # the bloom filter is rebuilt larger past its capacity and still has no false negative
+            addresses.update(ours[10:])
+            self.assertEqual(len(addresses), len(ours))
+            self.assertTrue(all(address in addresses for address in ours))
+            self.assertFalse(any(address in addresses for address in others))
+        self.assertGreaterEqual(addresses.bloom.capacity, len(ours))
+
+    def test_bloom_error_rate(self):
+        bloom = BloomFilter(10000, 0.01)
+        for _ in range(10000):
+            bloom.add(bytes.fromhex(CryptoUtil.random_id()))
+        false_positives = sum(bytes.fromhex(CryptoUtil.random_id()) in bloom for _ in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_incremental_sync(self):
+        watched = watched_addresses(self.db)
+        self.assertIs(watched_addresses(self.db), watched)
+        # rows written through another connection, e.g. by another process, are read on the next sync
+        other = Database.create_schema('test.db', path=self.tmp.name + '/')
+        address = CryptoUtil.random_id()
+        UtxoIndex(other).watch([address])
+        self.assertNotIn(address, watched)
+        self.assertIn(address, watched_addresses(self.db))
+        self.assertEqual(watched.last_rowid, 1)
+        other.close()
+
+    def test_generate_address(self):
+        wallet = Wallet.from_password('this is my strong password')
+        address = wallet.generate_address()
+        # matched by the blocks ingested before the wallet is saved
+        self.assertIn(address, watched_addresses(self.db, sync=False))
+        block = {'index': 1, 'transactions': [{'id': '3' * 64, 'data': {'inputs': [], 'outputs': [{'amount': 4, 'address': address}]}}]}
+        UtxoIndex(self.db).ingest_blocks([block])
+        self.assertEqual(self.db.fetch_one('select amount from utxo where address=:address', {'address': address})["amount"], 4)
+
+def make_uxto(amounts, address='a' * 64):
+    return [{'transaction': '{:064x}'.format(i), 'index': 0, 'amount': amount, 'address': address} for i, amount in enumerate(amounts)]
+
+class TestCoinSelection(unittest.TestCase):
+
+    def test_largest_first(self):
+        selected = largest_first(make_uxto([1, 7, 3, 5]), 8)
+        self.assertEqual([tx["amount"] for tx in selected], [7, 5])
+
+    def test_branch_and_bound_exact_match(self):
+        selected = branch_and_bound(make_uxto([1, 7, 3, 5]), 8)
+        self.assertEqual(sum(tx["amount"] for tx in selected), 8)
+
+    def test_branch_and_bound_fallback(self):
+        selected = branch_and_bound(make_uxto([10, 20]), 15)
+        self.assertEqual([tx["amount"] for tx in selected], [20])
+
+    def test_consolidate(self):
+        selected = consolidate(make_uxto([1, 1, 1, 50]), 10, max_inputs=3)
+        self.assertEqual([tx["amount"] for tx in selected], [50, 1, 1])
+
+    def test_not_enough_funds(self):
+        for selection in (largest_first, branch_and_bound, consolidate):
+            with self.assertRaises(WalletException):
+                selection(make_uxto([1, 2]), 4)
+
+    def test_sign_and_create_transaction_selects_inputs(self):
+        wallet = Wallet.from_password('this is my strong password')
+        address = wallet.generate_address()
+        uxto = make_uxto([1] * 1000 + [100], address)
+        signed_transaction = wallet.sign_and_create_transaction(uxto, 'b' * 64, address, 10, 1)
+        self.assertEqual(len(signed_transaction["data"]["inputs"]), 1)
+        Transaction.verify(Transaction.from_json(signed_transaction))
+
+class TestSendMany(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        patch_db = mock.patch.object(CLIENT_CONFIG, 'db', self.db)
+        # the node accepts every transaction as is
+        patch_send = mock.patch.object(NaiveCoinApi, 'send_transaction', side_effect=lambda signed_transaction: signed_transaction)
+        for patch in (patch_db, patch_send):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.wallet = Wallet.from_password('this is my strong password')
+        self.address = self.wallet.generate_address()
+        UtxoIndex(self.db).reconcile(self.address, make_uxto([1000, 1000], self.address))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_send_many_from_file(self):
+        path = self.tmp.name + '/payments.jsonl'
+        with open(path, 'w') as payment_file:
+            for i in range(600):
+                payment_file.write(ujson.dumps({'address': '{:064x}'.format(i), 'amount': 1}) + '\n')
+            payment_file.write(ujson.dumps({'address': 'b' * 64, 'amount': -1}) + '\n')
+
+        transactions, results = self.wallet.send_many(Wallet.read_payments(path), self.address, max_outputs=250)
+
+        self.assertEqual(len(transactions), 3)
+        self.assertEqual(len(results), 601)
+        self.assertEqual(sum(1 for result in results if result["error"]), 1)
+        # 600 paid plus one fee per transaction
+        self.assertEqual(UtxoIndex(self.db).balance(self.address), 2000 - 600 - 3)
+
+    def test_node_errors_keep_sent_transactions(self):
+        responses = iter([None, requests.exceptions.ConnectionError('connection reset'), ValueError('invalid json'), None])
+        def send_transaction(signed_transaction):
+            response = next(responses)
+            if response is not None:
+                raise response
+            return signed_transaction
+        payments = [('{:064x}'.format(i), 1) for i in range(8)]
+        with mock.patch.object(NaiveCoinApi, 'send_transaction', side_effect=send_transaction):
+            transactions, results = self.wallet.send_many(payments, self.address, max_outputs=2)
+        self.assertEqual(len(transactions), 2)
+        self.assertEqual([result["transaction_id"] is not None for result in results], [True, True, False, False, False, False, True, True])
+        self.assertEqual(results[2]["error"], 'connection reset')
+        # anything else stops the batches, what was sent is still returned
+        responses = iter([None, RuntimeError('boom')])
+        with mock.patch.object(NaiveCoinApi, 'send_transaction', side_effect=send_transaction):
+            transactions, results = self.wallet.send_many(payments, self.address, max_outputs=2)
+        self.assertEqual(len(transactions), 1)
+        self.assertEqual(len(results), 8)
+        self.assertEqual([result["error"] for result in results[2:5]], ['boom', 'boom', 'Not sent: boom'])
+
+    def test_malformed_payment_file_keeps_sent_transactions(self):
+        path = self.tmp.name + '/payments.csv'
+        with open(path, 'w') as payment_file:
+            payment_file.write('{},1\n{},1\n{},not a number\n'.format('a' * 64, 'b' * 64, 'c' * 64))
+        transactions, results = self.wallet.send_many(Wallet.read_payments(path), self.address, max_outputs=1)
+        self.assertEqual(len(transactions), 2)
+        self.assertTrue(results[-1]["error"].startswith('Invalid payment'))
+        # a row holding only an address
+        with open(path, 'w') as payment_file:
+            payment_file.write('{},1\n{}\n'.format('d' * 64, 'e' * 64))
+        transactions, results = self.wallet.send_many(Wallet.read_payments(path), self.address, max_outputs=1)
+        self.assertEqual(len(transactions), 1)
+        self.assertIn('Line 2', results[-1]["error"])
+
+class BalanceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    funded = set()
+    failing = False
+
+    def do_GET(self):
+        # like the node: a plain text 404 for an address without outputs
+        address = self.path.split('/')[2]
+        if self.failing:
+            status, content_type, body = 500, 'text/html; charset=utf-8', b'Internal error'
+        elif address in self.funded:
+            status, content_type, body = 200, 'application/json', ujson.dumps({'balance': 10}).encode()
+        else:
+            status, content_type, body = 404, 'text/html; charset=utf-8', "No transactions found for address '{}'".format(address).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestWalletStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        patch_db = mock.patch.object(CLIENT_CONFIG, 'db', self.db)
+        patch_db.start()
+        self.addCleanup(patch_db.stop)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_append_only_keys(self):
+        wallet = Wallet.from_password('this is my strong password')
+        wallet.generate_address()
+        wallet.save()
+        wallet.generate_address()
+        wallet.save()
+        self.assertEqual(self.db.fetch_one('select count(*) from wallet_key')[0], 2)
+
+        loaded = Wallet.load_wallet_from_password('this is my strong password')
+        # signing only looks the key up, the key pairs are loaded on demand
+        self.assertIsNotNone(loaded.get_signing_key(wallet.addresses[1]))
+        self.assertIsNone(loaded._key_pairs)
+        loaded.generate_address()
+        wallet.generate_address()
+        self.assertEqual(loaded.addresses, wallet.addresses)
+        self.assertEqual([p["publicKey"] for p in loaded.iter_key_pairs(page_size=1)], list(wallet.addresses[:2]))
+
+    def test_migrate_key_pair_blob(self):
+        key_pairs = [Wallet.make_key_pair(i, '{:064x}'.format(i), '{:064x}'.format(i + 100)) for i in range(3)]
+        self.db.exec('insert into wallet (wallet_id, password_hash, secret, key_pair) values(:wallet_id, :password_hash, :secret, :key_pair)',
+            {'wallet_id': 'w', 'password_hash': 'h', 'secret': 's', 'key_pair': ujson.dumps(key_pairs)}, commit=True)
+        self.db.migrate_wallet_key()
+        wallet = Wallet('w', 'h', 's', None)
+        self.assertEqual(wallet.key_pairs, key_pairs)
+        self.assertIsNone(self.db.fetch_one('select key_pair from wallet')[0])
+
+class TestWalletManager(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        patch_db = mock.patch.object(CLIENT_CONFIG, 'db', self.db)
+        patch_db.start()
+        self.addCleanup(patch_db.stop)
+        self.now = 0
+        self.manager = WalletManager(size=2, ttl=60, clock=lambda: self.now)
+        self.passwords = ['wallet password {}'.format(i) for i in range(3)]
+        for password in self.passwords:
+            wallet = Wallet.from_password(password)
+            wallet.generate_address()
+            wallet.save()
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_login_hit_and_miss(self):
+        hits, misses = CACHE_HITS.value, CACHE_MISSES.value
+        wallet = self.manager.login(self.passwords[0])
+        with mock.patch.object(Wallet, 'load_wallet_from_password') as load:
+            self.assertIs(self.manager.login(self.passwords[0]), wallet)
+            self.assertIs(self.manager.get(wallet.id), wallet)
+        load.assert_not_called()
+        self.assertEqual((CACHE_HITS.value - hits, CACHE_MISSES.value - misses), (2, 1))
+        self.assertIsNone(self.manager.get('unknown'))
+        with self.assertRaises(WalletException):
+            self.manager.login('not a wallet')
+
+    def test_least_recently_used_evicted_and_wiped(self):
+        evictions = CACHE_EVICTIONS['size'].value
+        first, second = (self.manager.login(password) for password in self.passwords[:2])
+        address, second_address = first.addresses[0], second.addresses[0]
+        self.manager.get(first.id)
+        self.manager.login(self.passwords[2])
+        # the second wallet was used least recently
+        self.assertEqual(len(self.manager), 2)
+        self.assertIn(first.id, self.manager)
+        self.assertNotIn(second.id, self.manager)
+        self.assertEqual(CACHE_EVICTIONS['size'].value - evictions, 1)
+        self.assertIsNone(second.secret)
+        self.assertEqual(second.key_pairs, [])
+        self.assertIsNone(second.get_signing_key(second_address))
+        self.assertIsNotNone(first.get_signing_key(address))
+
+    def test_expired_after_ttl(self):
+        wallet = self.manager.login(self.passwords[0])
+        self.now = 30
+        self.assertIs(self.manager.get(wallet.id), wallet)
+        # the ttl counts from the last use
+        self.now = 80
+        self.assertEqual(self.manager.prune(), 0)
+        self.now = 91
+        self.assertEqual(self.manager.prune(), 1)
+        self.assertIsNone(self.manager.get(wallet.id))
+        self.assertIsNone(wallet.secret)
+
+    def test_busy_wallet_wiped_after_its_call(self):
+        wallet = self.manager.login(self.passwords[0])
+        with self.manager.wallet_lock(wallet.id):
+            self.assertTrue(self.manager.remove(wallet.id))
+            # a call still signs with it
+            self.assertIsNotNone(wallet.get_signing_key(wallet.addresses[0]))
+        self.manager.wipe_released()
+        self.assertEqual(wallet.key_pairs, [])
+
+    def test_same_wallet_added_twice(self):
+        # two logins missed together, or a wallet created again with its password
+        wallet = self.manager.login(self.passwords[0])
+        other = Wallet.load_wallet_from_password(self.passwords[0])
+        address = other.generate_address()
+        self.assertIs(self.manager.add(other), wallet)
+        self.assertEqual(len(self.manager), 1)
+        self.assertIsNone(other.secret)
+        # the key the other object saved is loaded by the cached wallet
+        self.assertIn(address, wallet.addresses)
+        self.assertIsNotNone(wallet.get_signing_key(address))
+
+    def test_generate_address_written_through(self):
+        wallet = self.manager.login(self.passwords[0])
+        address = self.manager.generate_address(wallet.id)
+        self.assertEqual(Wallet.load_wallet_from_password(self.passwords[0]).addresses, (wallet.addresses[0], address))
+        self.assertIsNone(self.manager.generate_address('unknown'))
+
+class TestAddressDerivation(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        patch_db = mock.patch.object(CLIENT_CONFIG, 'db', self.db)
+        patch_db.start()
+        self.addCleanup(patch_db.stop)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_random_access(self):
+        wallet = Wallet.from_password('this is my strong password')
+        addresses = [wallet.generate_address() for _ in range(4)]
+        other = Wallet.from_password('this is my strong password')
+        self.assertEqual(other.derive_key_pair(3)["publicKey"], addresses[3])
+
+    def test_chain_wallet_still_loads(self):
+        wallet = Wallet.from_password('this is my strong password', DERIVATION_CHAIN)
+        wallet.generate_address()
+        wallet.save()
+        loaded = Wallet.load_wallet_from_password('this is my strong password')
+        self.assertEqual(loaded.derivation, DERIVATION_CHAIN)
+        loaded.generate_address()
+        wallet.generate_address()
+        self.assertEqual(loaded.addresses, wallet.addresses)
+
+    def test_save_keeps_stored_wallet(self):
+        wallet = Wallet.from_password('this is my strong password', DERIVATION_CHAIN)
+        funded = wallet.generate_address()
+        wallet.save()
+        # created again with the password, by default with index derivation
+        other = Wallet.from_password('this is my strong password')
+        other.generate_address()
+        other.generate_address()
+        other.save()
+        self.assertEqual((other.id, other.derivation, other.addresses), (wallet.id, DERIVATION_CHAIN, (funded,)))
+        loaded = Wallet.load_wallet_from_password('this is my strong password')
+        self.assertEqual(loaded.derivation, DERIVATION_CHAIN)
+        self.assertIsNotNone(loaded.get_secret_key_by_address(funded))
+        # same derivation, only the missing index is inserted
+        again = Wallet.from_password('this is my strong password', DERIVATION_CHAIN)
+        again.generate_address()
+        second = again.generate_address()
+        again.save()
+        self.assertEqual(Wallet.load_wallet_from_password('this is my strong password').addresses, (funded, second))
+
+    def test_restore_from_password(self):
+        wallet = Wallet.from_password('this is my strong password', DERIVATION_INDEX)
+        addresses = [wallet.generate_address() for _ in range(6)]
+        BalanceHandler.funded = {addresses[1], addresses[5]}
+        server = ThreadingHTTPServer(('127.0.0.1', 0), BalanceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            restored = Wallet.restore_from_password('this is my strong password', gap_limit=4, max_workers=2,
+                node='http://127.0.0.1:{}'.format(server.server_address[1]))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(list(restored.addresses), addresses)
+
+    def test_restore_spent_address_and_node_error(self):
+        wallet = Wallet.from_password('this is my strong password', DERIVATION_INDEX)
+        addresses = [wallet.generate_address() for _ in range(6)]
+        # address 1 was spent out, only the local history has it
+        self.db.exec('insert into tx_input values(:transaction_id, 0, :source, 0, :address, 10)',
+            {'transaction_id': '1' * 64, 'source': '2' * 64, 'address': addresses[1]}, commit=True)
+        BalanceHandler.funded = {addresses[4]}
+        server = ThreadingHTTPServer(('127.0.0.1', 0), BalanceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        node = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        try:
+            restored = Wallet.restore_from_password('this is my strong password', gap_limit=3, max_workers=2, node=node)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(list(restored.addresses), addresses[:5])
+        # the node is gone, nothing is restored rather than a single address
+        with self.assertRaises(WalletException):
+            Wallet.restore_from_password('this is my strong password', gap_limit=3, max_workers=2, node=node)
+
+    def test_restore_through_node_404_and_server_error(self):
+        wallet = Wallet.from_password('this is my strong password', DERIVATION_INDEX)
+        addresses = [wallet.generate_address() for _ in range(3)]
+        # every address but the first is a 404 of the node, the scan stops at the gap limit
+        BalanceHandler.funded = {addresses[0]}
+        server = ThreadingHTTPServer(('127.0.0.1', 0), BalanceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        node = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        try:
+            restored = Wallet.restore_from_password('this is my strong password', gap_limit=5, max_workers=2, node=node)
+            BalanceHandler.failing = True
+            with self.assertRaises(WalletException):
+                Wallet.restore_from_password('this is my strong password', gap_limit=5, max_workers=2, node=node)
+        finally:
+            BalanceHandler.failing = False
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(list(restored.addresses), addresses[:1])
+
+class TestBlockSubscription(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        self.node = StubNode(block_interval=None).start()
+        patch_node = mock.patch.object(NaiveCoinApi, 'node', self.node.url)
+        patch_node.start()
+        self.addCleanup(patch_node.stop)
+
+    def tearDown(self):
+        self.node.stop()
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_pushed_block_confirms_without_polling(self):
+        updater = TranscationUpdater(queue.Queue(), self.db)
+        updater.start_subscription(port=0)
+        self.assertTrue(updater.subscription.subscribed)
+        stop = threading.Event()
+        thread = threading.Thread(target=updater.loop, args=(stop,))
+        thread.start()
+        try:
+            transaction = self.node.fund('a' * 64, 5)
+            self.db.exec('insert into tx (transaction_id, hash, type, data, confirmed) values(:transaction_id, :hash, :type, :data, :confirmed)',
+                {'transaction_id': transaction["id"], 'hash': transaction["hash"], 'type': transaction["type"], 'data': '{}', 'confirmed': False}, commit=True)
+            self.node.mine()
+            # the poll interval is 10s, only the push can confirm it this fast
+            self.assertEqual(updater.queue.get(timeout=2), [(transaction["id"], 1)])
+        finally:
+            stop.set()
+            updater.wake.set()
+            thread.join()
+            updater.subscription.stop()
+
+    def test_subscribe_again_when_node_forgets_peer(self):
+        updater = TranscationUpdater(queue.Queue(), self.db)
+        updater.start_subscription(port=0)
+        self.node.peers.clear()
+        self.assertTrue(updater.subscription.check())
+        self.assertEqual(self.node.peers, [{'url': updater.subscription.url}])
+        updater.subscription.stop()
+
+class TestBalanceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        self.node = StubNode(block_interval=None).start()
+        patch_node = mock.patch.object(NaiveCoinApi, 'node', self.node.url)
+        patch_node.start()
+        self.addCleanup(patch_node.stop)
+
+    def tearDown(self):
+        self.node.stop()
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_only_touched_addresses_fetched_again(self):
+        addresses = [CryptoUtil.random_id() for _ in range(300)]
+        for address in addresses[:3]:
+            self.node.fund(address, 10)
+        self.node.mine()
+        updater = TranscationUpdater(queue.Queue(), self.db)
+        updater.tick()
+        cache = BalanceCache(self.db)
+
+        balances = cache.balances(addresses)
+        self.assertEqual((balances["fetched"], balances["cached"], balances["total"]), (300, 0, 30))
+        balances = cache.balances(addresses)
+        self.assertEqual((balances["fetched"], balances["cached"], balances["total"]), (0, 300, 30))
+
+        # a new block paying one address
+        self.node.fund(addresses[0], 5)
+        updater.tick(self.node.mine())
+        balances = cache.balances(addresses)
+        self.assertEqual((balances["fetched"], balances["cached"]), (1, 299))
+        self.assertEqual(balances["addresses"][addresses[0]], 15)
+
+        # our own send spending from an address
+        cache.apply_transaction({'data': {'inputs': [{'address': addresses[1]}], 'outputs': [{'address': addresses[2], 'amount': 1}]}})
+        self.assertEqual(cache.balances(addresses)["fetched"], 2)
+
+    def test_new_tip_not_scanned_fetches_again(self):
+        address = CryptoUtil.random_id()
+        cache = BalanceCache(self.db)
+        cache.balances([address])
+        self.node.fund(address, 10)
+        self.node.mine()
+        balances = cache.balances([address])
+        self.assertEqual((balances["fetched"], balances["total"]), (1, 10))
+
+class TestChainRescan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        self.node = StubNode(block_interval=None).start()
+        # 30 blocks, blocks 3, 13 and 23 pay one of our addresses, the others pay someone else
+        self.ours = [CryptoUtil.random_id() for _ in range(2)]
+        self.found = []
+        for index in range(1, 31):
+            transaction = self.node.fund(self.ours[index % 2] if index % 10 == 3 else CryptoUtil.random_id(), index)
+            if index % 10 == 3:
+                self.found.append(transaction["id"])
+            self.node.mine()
+
+    def tearDown(self):
+        self.node.stop()
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_resume_from_checkpoint(self):
+        rescan = ChainRescan(self.ours, self.db, node=self.node.url, window=8)
+        get_block_by_index = AsyncNaiveCoinApi.get_block_by_index
+        async def interrupted(api, index):
+            if index == 20:
+                raise aiohttp.ClientError('connection reset')
+            return await get_block_by_index(api, index)
+        with mock.patch.object(AsyncNaiveCoinApi, 'get_block_by_index', interrupted):
+            with self.assertRaises(TransactionRequestException):
+                rescan.run()
+        # blocks 0 to 15 were written with their checkpoint
+        self.assertEqual(rescan.load_checkpoint(), 15)
+        self.assertEqual(self.db.fetch_one('select count(*) from tx')[0], 2)
+
+        progress = []
+        report = rescan.run(progress=progress.append)
+        self.assertEqual((report["from_index"], report["to_index"], report["blocks"], report["found"]), (16, 30, 15, 1))
+        self.assertGreater(report["blocks_per_second"], 0)
+        self.assertEqual([step["block_index"] for step in progress], [23, 30])
+
+        history = TransactionHistory(self.db).page(address=self.ours)
+        self.assertEqual([tx["transaction_id"] for tx in history["transactions"]], self.found[::-1])
+        self.assertEqual([tx["status"] for tx in history["transactions"]], ['confirmed'] * 3)
+        self.assertEqual(history["transactions"][0]["created_at"], self.node.blocks[23]["timestamp"])
+        # nothing new, nothing read
+        self.assertEqual(rescan.run()["blocks"], 0)
+
+class TestJsonRpcServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database.create_schema('test.db', path=self.tmp.name + '/')
+        self.default_db = CLIENT_CONFIG.db
+        CLIENT_CONFIG.config_database(self.db)
+        self.node = StubNode(block_interval=None).start()
+        patch_node = mock.patch.object(NaiveCoinApi, 'node', self.node.url)
+        patch_node.start()
+        self.addCleanup(patch_node.stop)
+
+    def tearDown(self):
+        CLIENT_CONFIG.config_database(self.default_db)
+        self.node.stop()
+        self.db.close()
+        self.tmp.cleanup()
+
+    def serve(self, scenario):
+        async def run():
+            server = JsonRpcServer(workers=4)
+            async with TestClient(TestServer(server.app())) as client:
+                async def call(body):
+                    response = await client.post('/', data=ujson.dumps(body))
+                    return None if response.status == 204 else await response.json()
+                await scenario(call)
+        asyncio.run(run())
+
+    def test_batch_send_and_confirmation_event(self):
+        async def scenario(call):
+            created = await call({'jsonrpc': '2.0', 'method': 'create_wallet', 'params': {'password': 'rpc wallet', 'addresses': 2}, 'id': 1})
+            wallet_id = created["result"]["wallet_id"]
+            responses = await call([
+                {'jsonrpc': '2.0', 'method': 'list_addresses', 'params': [wallet_id], 'id': 'a'},
+                {'jsonrpc': '2.0', 'method': 'list_wallets'},
+                {'jsonrpc': '2.0', 'method': 'nope', 'id': 'b'},
+                {'jsonrpc': '2.0', 'method': 'balance', 'params': ['locked'], 'id': 'c'},
+                {'jsonrpc': '2.0', 'method': 'send', 'params': {'wallet_id': wallet_id}, 'id': 'd'},
+                {'method': 'list_wallets', 'id': 'e'},
+            ])
+            # the notification has no response
+            responses = {response["id"]: response for response in responses}
+            self.assertEqual(len(responses), 5)
+            from_address, to_address = responses["a"]["result"]
+            self.assertEqual(responses["b"]["error"]["code"], -32601)
+            self.assertEqual(responses["c"]["error"]["code"], -32002)
+            self.assertEqual(responses["d"]["error"]["code"], -32602)
+            self.assertEqual(responses["e"]["error"]["code"], -32600)
+
+            self.node.fund(from_address, 100)
+            sent = await call({'jsonrpc': '2.0', 'method': 'send', 'params': [wallet_id, from_address, to_address, 10], 'id': 2})
+            transaction_id = sent["result"]["transaction_id"]
+            self.node.mine()
+            events = []
+            for _ in range(50):
+                events = (await call({'jsonrpc': '2.0', 'method': 'get_events', 'params': [0], 'id': 3}))["result"]
+                if events:
+                    break
+                await asyncio.sleep(0.1)
+            self.assertEqual([(event["transaction_id"], event["confirmations"]) for event in events], [(transaction_id, 1)])
+            history = await call({'jsonrpc': '2.0', 'method': 'history', 'params': [wallet_id], 'id': 4})
+            page = history["result"]
+            self.assertEqual([(tx["transaction_id"], tx["status"], tx["confirmations"]) for tx in page["transactions"]], [(transaction_id, 'included', 1)])
+            self.assertIsNone(page["next_cursor"])
+            balance = await call({'jsonrpc': '2.0', 'method': 'balance', 'params': [wallet_id], 'id': 5})
+            self.assertEqual(balance["result"]["addresses"][to_address], 10)
+        self.serve(scenario)
+
+    def test_invalid_params_and_internal_error(self):
+        async def scenario(call):
+            responses = await call([
+                {'jsonrpc': '2.0', 'method': 'create_wallet', 'params': {'password': 'rpc wallet', 'addresses': 10 ** 9}, 'id': 'a'},
+                {'jsonrpc': '2.0', 'method': 'create_wallet', 'params': ['rpc wallet', 'two'], 'id': 'b'},
+                {'jsonrpc': '2.0', 'method': 'get_events', 'params': ['0'], 'id': 'c'},
+                {'jsonrpc': '2.0', 'method': 'balance', 'params': [['not', 'an', 'id']], 'id': 'd'},
+            ])
+            for response in responses:
+                self.assertEqual(response["error"]["code"], -32602)
+            created = await call({'jsonrpc': '2.0', 'method': 'create_wallet', 'params': ['rpc wallet'], 'id': 1})
+            wallet_id = created["result"]["wallet_id"]
+            responses = await call([
+                {'jsonrpc': '2.0', 'method': 'send_many', 'params': [wallet_id, 'a' * 64, {'address': 'b' * 64}], 'id': 'a'},
+                {'jsonrpc': '2.0', 'method': 'history', 'params': {'wallet_id': wallet_id, 'status': 'lost'}, 'id': 'b'},
+                {'jsonrpc': '2.0', 'method': 'send', 'params': [wallet_id, 'a' * 64, 'b' * 64, '10'], 'id': 'c'},
+            ])
+            for response in responses:
+                self.assertEqual(response["error"]["code"], -32602)
+            # a bug inside a method is an internal error, not a wallet error
+            with mock.patch.object(WalletService, 'list_wallets', side_effect=KeyError('boom')):
+                response = await call({'jsonrpc': '2.0', 'method': 'list_wallets', 'id': 2})
+            self.assertEqual(response["error"], {'code': -32603, 'message': 'Internal error'})
+        self.serve(scenario)
+
+    def test_empty_batch_invalid(self):
+        async def scenario(call):
+            self.assertEqual((await call([]))["error"]["code"], -32600)
+        self.serve(scenario)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_snapshot_and_prometheus(self):
+        metrics = Metrics()
+        metrics.counter('requests_total', 'Requests', endpoint='a').inc(3)
+        histogram = metrics.histogram('latency_seconds', endpoint='a')
+        for value in (0.0002, 0.003, 20):
+            histogram.observe(value)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["requests_total"], [{'labels': {'endpoint': 'a'}, 'value': 3}])
+        self.assertEqual(snapshot["latency_seconds"][0]["count"], 3)
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertIn('latency_seconds_bucket{endpoint="a",le="0.005"} 2', text)
+        self.assertIn('latency_seconds_bucket{endpoint="a",le="+Inf"} 3', text)
+        self.assertIn('requests_total{endpoint="a"} 3', text)
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics.write(tmp + '/metrics.json')
+            with open(tmp + '/metrics.json') as metrics_file:
+                self.assertEqual(ujson.load(metrics_file), snapshot)
+
+    def test_sign_per_uxto_does_not_format_without_debug(self):
+        wallet = Wallet.from_password('this is my strong password')
+        address = wallet.generate_address()
+        uxto = [{'transaction': '{:064x}'.format(i), 'index': 0, 'amount': 10, 'address': address} for i in range(3)]
+        with mock.patch.object(TxInput, 'to_json') as to_json:
+            wallet.sign_per_uxto(uxto, wallet.get_signing_key(address))
+        to_json.assert_not_called()
+
+class TestLoadGenerator(unittest.TestCase):
+
+    def test_every_send_confirmed(self):
+        db = CLIENT_CONFIG.db
+        report = loadgen.run(wallets=2, sends=2, block_interval=0.1, updater_interval=0.05, timeout=10)
+        self.assertIs(CLIENT_CONFIG.db, db)
+        self.assertEqual(report["stages"]["send"]["count"], 4)
+        self.assertEqual(report["stages"]["confirm"]["count"], 4)
+        self.assertEqual(report["unconfirmed"], 0)
+
 if __name__== "__main__":
     unittest.main()
\ No newline at end of file